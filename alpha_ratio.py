@@ -1,18 +1,22 @@
 import parselmouth
 import numpy as np
 from numpy.linalg import lstsq
-import matplotlib.pyplot as plt
 import time
 import os
 import csv
+from analysis import RecordingAnalysis, as_analysis, pitch_values_at_times
+from feature_store import check_output_format, save_feature
+from cache import cached_feature
+from tracing import span
 
 # # snd = "raw_audio/hoarse_test_voice.wav"
 # snd = "raw_audio/testsoundmono.mp3" # gives mean alpha ratio 2.8307666078269107 w/ log10
 snd = "raw_audio/high_pitch.wav" # gives mean alpha ratio of 1.4452959901226703 w/ log10
 
 
+@cached_feature
 def alpha_ratio( #TODO ask if I should add masking to alpha_ratio
-    sound_path: str,
+    sound_path: str | RecordingAnalysis | parselmouth.Sound | np.ndarray,
     csv_folder_name: str,
     time_step: float = 0.01, 
     window_length: float = 0.025,
@@ -22,77 +26,98 @@ def alpha_ratio( #TODO ask if I should add masking to alpha_ratio
     f_high2: float = 5000.0,
     pitch_floor: float = 75.0,
     pitch_ceiling: float = 500.0,
-    stats: bool = True
+    stats: bool = True,
+    sample_rate_hz: float = 0.0, # only needed when sound_path is a NumPy array of samples
+    output_format: str = "csv" # "csv", or "npy" for the columnar binary store in feature_store.py
 ):
     """
     Linear alpha ratio per frame:
          alpha(t) = log10(sum(E[50-1000 Hz]) / sum(E[1000-5000 Hz]))
          
     Args:
-    sound_path: path to .csv sound file
+    sound_path: path to .csv sound file, a RecordingAnalysis shared with the other feature functions, or an in-memory parselmouth.Sound or NumPy array of samples (with sample_rate_hz)
+    sample_rate_hz (float): sample rate of sound_path when it is a NumPy array
     csv_folder_name (str): name of folder where stats csv file should be placed (doesn't matter if stats is False).
     stats (bool): Whether the function should output a csv including time taken to execute and other metadata.
     
+    Frames are kept when they are voiced (f0 defined at the frame time) and both band powers are finite and > 0.
+    The voicing mask and the ratios are computed over whole arrays, and speaking_times[k] is always the time of alpha_ratio_per_frame[k].
+    
      Returns: speaking_times (s), alpha_ratio_per_frame, alpha_ratio_mean
     """
+    analysis = as_analysis(sound_path, sample_rate_hz)
+    check_output_format(output_format)
+
     if(stats):
         start_time = time.perf_counter()
-        wav_base = os.path.splitext(os.path.basename(sound_path))[0]
+        wav_base = analysis.wav_base
         func_name = alpha_ratio.__name__
         stats_csv_file_name = f"{csv_folder_name}/{wav_base}_{func_name}.csv"
     
     #NEW: FOR MASKING USING F0 (PITCH):
     # pitch = sound.to_pitch(time_step=time_step, pitch_floor=pitch_floor, pitch_ceiling=pitch_ceiling)
     
-    sound = parselmouth.Sound(sound_path)
-    sampling_hz = sound.sampling_frequency
+    sampling_hz = analysis.sampling_hz
 
-    pitch = sound.to_pitch(time_step=time_step, pitch_floor=pitch_floor, pitch_ceiling=pitch_ceiling)
+    pitch = analysis.pitch(time_step, pitch_floor, pitch_ceiling)
     
-    spectrogram = sound.to_spectrogram(
-         window_length=window_length,
-         time_step=time_step,
-         maximum_frequency=f_high2
-    )
+    spectrogram = analysis.spectrogram(window_length, time_step, f_high2)
     
-    frequency_PSDs = spectrogram.values # power spectrum densities (PSD)
-    freqs = spectrogram.ys()
-    times = spectrogram.xs()
+    with span("alpha_ratio", "numpy"):
+        frequency_PSDs = spectrogram.values # power spectrum densities (PSD)
+        freqs = spectrogram.ys()
+        times = spectrogram.xs()
 
     
-    low_freq_mask = (freqs >= f_low1) & (freqs < f_high1)
-    high_freq_mask = (freqs >= f_low2) & (freqs <= f_high2)
+        low_freq_mask = (freqs >= f_low1) & (freqs < f_high1)
+        high_freq_mask = (freqs >= f_low2) & (freqs <= f_high2)
     
-    low_freq_PSDs = frequency_PSDs[low_freq_mask, :]
-    high_freq_PSDs = frequency_PSDs[high_freq_mask, :]
+        low_freq_PSDs = frequency_PSDs[low_freq_mask, :]
+        high_freq_PSDs = frequency_PSDs[high_freq_mask, :]
     
-    low_freq_summed_power = np.sum(low_freq_PSDs, axis=0)  # sum of PSD over low band per frame
-    high_freq_summed_power = np.sum(high_freq_PSDs, axis=0)  # sum of PSD over high band per frame
-
-    alpha_ratios = []
-    speaking_times = []
-    for j, t in enumerate(times):
-        f0 = pitch.get_value_at_time(float(t))
-        if np.isnan(f0):
-            continue  # person is not speaking
-        speaking_times.append(t)
-
-        # Avoid divide-by-zero; skip frames where high-band energy is 0 or non-finite.
-        denom = high_freq_summed_power[j]
-        num = low_freq_summed_power[j]
-        if (not np.isfinite(num)) or (not np.isfinite(denom)) or denom <= 0 or num <= 0:
-            continue
-
-        alpha_ratios.append(np.log10(num / denom))
-
-    alpha_ratios = np.array(alpha_ratios)
-    alpha_ratio_mean = float(np.mean(alpha_ratios)) if alpha_ratios.size else float("nan")
-    speaking_times = np.array(speaking_times)
+        low_freq_summed_power = np.sum(low_freq_PSDs, axis=0)  # sum of PSD over low band per frame
+        high_freq_summed_power = np.sum(high_freq_PSDs, axis=0)  # sum of PSD over high band per frame
+
+        voiced_mask = ~np.isnan(pitch_values_at_times(pitch, times))  # False where person is not speaking
+
+        # Avoid divide-by-zero; skip frames where either band energy is 0 or non-finite.
+        num = low_freq_summed_power
+        denom = high_freq_summed_power
+        valid_mask = voiced_mask & np.isfinite(num) & np.isfinite(denom) & (num > 0) & (denom > 0)
+
+        speaking_times = analysis.original_times(times[valid_mask])
+        alpha_ratios = np.log10(num[valid_mask] / denom[valid_mask])
+        alpha_ratio_mean = float(np.mean(alpha_ratios)) if alpha_ratios.size else float("nan")
     
-    if stats:
+    if stats and output_format == "npy":
+        elapsed_sec = time.perf_counter() - start_time
+        save_feature(
+            csv_folder_name,
+            wav_base,
+            func_name,
+            {
+                "sound_path": analysis.file_name,
+                "sample_rate_hz": sampling_hz,
+                "time_step": time_step,
+                "window_length": window_length,
+                "f_low1": f_low1,
+                "f_high1": f_high1,
+                "f_low2": f_low2,
+                "f_high2": f_high2,
+                "pitch_floor": pitch_floor,
+                "pitch_ceiling": pitch_ceiling,
+                "alpha_ratio_mean": alpha_ratio_mean,
+                "elapsed_seconds": elapsed_sec,
+            },
+            {
+                "time_seconds": speaking_times,
+                "alpha_ratio": alpha_ratios,
+            },
+        )
+    elif stats:
         # Timing:
         elapsed_sec = time.perf_counter() - start_time
-        with open(stats_csv_file_name, "x", newline="") as f:
+        with span("stats_csv", "io"), open(stats_csv_file_name, "x", newline="") as f:
             writer = csv.writer(f)
             writer.writerow([
                 "sound_path",
@@ -112,7 +137,7 @@ def alpha_ratio( #TODO ask if I should add masking to alpha_ratio
             ])
             if alpha_ratios.size == 0:
                 writer.writerow([
-                    os.path.basename(sound_path),
+                    analysis.file_name,
                     sampling_hz,
                     time_step,
                     window_length,
@@ -130,7 +155,7 @@ def alpha_ratio( #TODO ask if I should add masking to alpha_ratio
             else:
                 for i, (t, a) in enumerate(zip(speaking_times, alpha_ratios)):
                     writer.writerow([
-                        os.path.basename(sound_path) if i == 0 else "",
+                        analysis.file_name if i == 0 else "",
                         sampling_hz if i == 0 else "",
                         time_step if i == 0 else "",
                         window_length if i == 0 else "",
@@ -153,50 +178,41 @@ def save_alpha_ratio_plot(
     ratios: np.ndarray,
     alpha_ratio_mean: float,
     output_path: str,
+    ax=None, # draw on these (reused) axes instead of a new figure, see render.py
 ):
     """Save alpha ratio plot in the same format as the TESTING section."""
+    import matplotlib.pyplot as plt
     if ts.size == 0 or ratios.size == 0:
         return
 
-    plt.figure()
-    plt.scatter(ts, ratios, color='blue', label='Data Points')
-    plt.axhline(y=alpha_ratio_mean, color='r', linestyle='-',
-                label=f'Alpha ratio mean: {alpha_ratio_mean}')
-    plt.title("Alpha ratios over time")
-    plt.xlabel("Time (in seconds)")
-    plt.ylabel("Alpha ratio")
-    plt.legend()
-    plt.savefig(output_path, dpi=300, bbox_inches='tight')
-    plt.close()
+    reuse = ax is not None
+    fig, ax = (ax.figure, ax) if reuse else plt.subplots()
+    ax.scatter(ts, ratios, color='blue', label='Data Points')
+    ax.axhline(y=alpha_ratio_mean, color='r', linestyle='-',
+               label=f'Alpha ratio mean: {alpha_ratio_mean}')
+    ax.set_title("Alpha ratios over time")
+    ax.set_xlabel("Time (in seconds)")
+    ax.set_ylabel("Alpha ratio")
+    ax.legend()
+    fig.savefig(output_path, dpi=300, bbox_inches='tight')
+    if not reuse:
+        plt.close(fig)
 
 
 def main():
-    patient_raw_data_directory = '/data_store2/resection/neuropsych_video/presidio/Stage2/PR05/home/'
+    from batch import find_recordings, run_batch
 
-    alpha_ratio_csv_output_directory = '/userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_alpha_ratio_metadata'
-    alpha_ratio_plot_output_directory = '/userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_alpha_ratio_plots'
-
-    os.makedirs(alpha_ratio_csv_output_directory, exist_ok=True)
-    os.makedirs(alpha_ratio_plot_output_directory, exist_ok=True)
-
-    for num in range(579, 611):
-        audio_name_without_wav = str(num)
-        audio_name = audio_name_without_wav + '_audio.wav'
-        sound_path = os.path.join(patient_raw_data_directory, audio_name)
-
-        if not os.path.exists(sound_path):
-            continue
-
-        ts, ratios, alpha_ratio_mean, s_hz = alpha_ratio(
-            sound_path,
-            alpha_ratio_csv_output_directory,
-        )
+    patient_raw_data_directory = '/data_store2/resection/neuropsych_video/presidio/Stage2/PR05/home/'
 
-        plot_path = os.path.join(
-            alpha_ratio_plot_output_directory,
-            'sub-PR05_stage-2_audio-audiotype_preproc_' + audio_name_without_wav + '_alpha_ratio.png'
-        )
-        save_alpha_ratio_plot(ts, ratios, alpha_ratio_mean, plot_path)
+    # Outputs go to /userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_alpha_ratio_metadata and /userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_alpha_ratio_plots
+    # Plots are named sub-PR05_stage-2_audio-audiotype_preproc_<recording>_alpha_ratio.png (e.g. ..._579_audio_alpha_ratio.png); the old loop wrote ..._579_alpha_ratio.png
+    run_batch(
+        find_recordings(patient_raw_data_directory, '*_audio.wav'),
+        ['alpha_ratio'],
+        '/userdata/msharma',
+        prefix='sub-PR05_stage-2_audio-audiotype_preproc_',
+        jobs=os.cpu_count(),
+    )
 
 
 if __name__ == "__main__":
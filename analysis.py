@@ -0,0 +1,358 @@
+import parselmouth
+import numpy as np
+from parselmouth.praat import call
+import hashlib
+import os
+from scipy.io import wavfile
+from tracing import span
+from vad import detect_speech, speech_only_samples, original_times, concatenated_times
+from chunked import analyse_chunked, FormantTrack
+from stft import stft_spectrogram
+from pcm_cache import load_sound, read_pcm, pcm_cache
+
+
+class RecordingAnalysis:
+    """
+    Per-recording analysis context.
+
+    Lazily builds the Sound, Pitch, PointProcess, Spectrogram, Formant and Intensity
+    objects of one recording and memoizes each of them keyed by its parameters, so that
+    running every feature function on the same recording decodes the file and runs the
+    pitch tracker only once.
+
+    Every feature function (pitches, relative_energy_formant, alpha_ratio, loudness_in_db,
+    jitter, shimmer_apqN) accepts a RecordingAnalysis in place of a sound path.
+
+    The recording is loaded through the decoded-PCM cache when one is configured (see pcm_cache.py).
+
+    If sound is given (e.g. samples already filtered in memory by preprocessing), it is used
+    instead of reading sound_path, which then only names the recording in the stats csv files.
+
+    If cache (a cache.FeatureCache) is given, the Praat analyses are also stored on disk under the
+    recording's content hash, and the feature functions cache their results there too.
+
+    With speech_only, the speech segments are found first (vad.detect_speech, with vad_params) and the
+    Praat analyses run on the concatenated speech only; the feature functions map their times back to
+    the timeline of the recording with original_times. A recording without speech raises ValueError.
+
+    With chunk_seconds, recordings longer than two chunks get their pitch, formant and intensity tracks from
+    chunked.analyse_chunked, on jobs processes; the point process always uses the unchunked pitch, and
+    spectrograms are never chunked.
+
+    With spectrogram_engine="numpy", spectrograms are computed by stft.stft_spectrogram (float32) instead of Praat.
+    """
+
+    def __init__(
+        self,
+        sound_path: str,
+        sound: parselmouth.Sound = None,
+        cache=None,
+        speech_only: bool = False,
+        vad_params: dict = None,
+        chunk_seconds: float = 0.0,
+        jobs: int = 1,
+        spectrogram_engine: str = "praat",
+    ):
+        self.sound_path = sound_path
+        self.file_name = os.path.basename(sound_path)   # written to the stats csv files
+        self.wav_base = os.path.splitext(self.file_name)[0]  # used to name the stats csv files
+        self.cache = cache
+        self.speech_only = speech_only
+        self.vad_params = vad_params or {}
+        self.chunk_seconds = chunk_seconds
+        self.jobs = jobs
+        self.spectrogram_engine = spectrogram_engine
+        self._sound = sound
+        self._speech = None
+        self._in_memory = sound is not None
+        self._content_hash = None
+        self._cache = {}
+
+    @property
+    def sound(self) -> parselmouth.Sound:
+        if self._sound is None:
+            with span("load", "load", sound_path=self.sound_path):
+                self._sound = load_sound(self.sound_path)
+        return self._sound
+
+    @property
+    def sampling_hz(self) -> float:
+        return self.sound.sampling_frequency
+
+    @property
+    def duration(self) -> float:
+        """Length of the recording (s), read from the WAV header (or the PCM cache) when the sound is not decoded yet."""
+        if self._sound is None and pcm_cache() is not None:
+            sampling_hz, data = read_pcm(self.sound_path) # memory-mapped
+            return data.shape[0] / sampling_hz
+        if self._sound is None and self.sound_path.lower().endswith(".wav"):
+            try:
+                sampling_hz, data = wavfile.read(self.sound_path, mmap=True)
+                return data.shape[0] / sampling_hz
+            except ValueError:
+                pass # a WAV variant scipy cannot map; Praat reads it below
+        return self.sound.duration
+
+    @property
+    def content_hash(self) -> str:
+        """sha256 of the recording: of the file for a path, of the samples for an in-memory sound."""
+        if self._content_hash is None:
+            if self._in_memory:
+                h = hashlib.sha256(repr((self.sound.sampling_frequency, self.sound.xmin)).encode())
+                h.update(np.ascontiguousarray(self.sound.values).tobytes())
+                self._content_hash = h.hexdigest()
+            else:
+                self._content_hash = self.cache.file_hash(self.sound_path)
+        return self._content_hash
+
+    @property
+    def analysis_hash(self) -> str:
+        """content_hash, plus the VAD parameters with speech_only: identifies what the Praat analyses run on."""
+        if not self.speech_only:
+            return self.content_hash
+        return hashlib.sha256(repr((self.content_hash, sorted(self.vad_params.items()))).encode()).hexdigest()
+
+    def speech_segments(self) -> np.ndarray:
+        """Start and end times (s) of the speech segments, see vad.detect_speech. Cached like the Praat analyses."""
+        key = ("speech_segments",) + tuple(sorted(self.vad_params.items()))
+        if key not in self._cache:
+            cache_key = self.cache.key(self.content_hash, key[0], key[1:]) if self.cache is not None else None
+            segments = self.cache.get(cache_key) if cache_key else None
+            if segments is None:
+                sound = self.sound
+                with span("speech_segments", "numpy"):
+                    segments = detect_speech(sound.values, sound.sampling_frequency, **self.vad_params)
+                if cache_key:
+                    self.cache.put(cache_key, segments)
+            self._cache[key] = segments
+        return self._cache[key]
+
+    @property
+    def analysed_sound(self) -> parselmouth.Sound:
+        """The sound the Praat analyses run on: the whole recording, or its concatenated speech with speech_only."""
+        if not self.speech_only:
+            return self.sound
+        if self._speech is None:
+            segments = self.speech_segments()
+            if segments.shape[0] == 0:
+                raise ValueError(f"No speech detected in {self.file_name}")
+            values, sample_offsets, concatenated_starts = speech_only_samples(
+                self.sound.values, self.sampling_hz, segments
+            )
+            self._speech = (
+                parselmouth.Sound(values, sampling_frequency=self.sampling_hz),
+                sample_offsets,
+                concatenated_starts,
+            )
+        return self._speech[0]
+
+    def original_times(self, times: np.ndarray) -> np.ndarray:
+        """Maps times of the Praat analyses back to the recording's timeline (unchanged without speech_only)."""
+        if not self.speech_only:
+            return times
+        self.analysed_sound
+        return original_times(times, self.sampling_hz, self._speech[1], self._speech[2])
+
+    def analysed_times(self, times: np.ndarray) -> np.ndarray:
+        """Maps times of the recording onto the timeline of the Praat analyses (inverse of original_times)."""
+        if not self.speech_only:
+            return np.asarray(times, dtype=np.float64)
+        self.analysed_sound
+        return concatenated_times(times, self.sampling_hz, self._speech[1], self._speech[2])
+
+    def whole_recording(self) -> "RecordingAnalysis":
+        """
+        The analyses of the whole recording (itself without speech_only), sharing the loaded sound and the
+        cache, e.g. for plots drawn on the recording's timeline.
+        """
+        if not self.speech_only:
+            return self
+        if ("whole_recording",) not in self._cache:
+            whole = RecordingAnalysis(
+                self.sound_path,
+                self.sound,
+                cache=self.cache,
+                chunk_seconds=self.chunk_seconds,
+                jobs=self.jobs,
+                spectrogram_engine=self.spectrogram_engine,
+            )
+            whole._in_memory = self._in_memory # same content hash as this analysis
+            whole._content_hash = self._content_hash
+            self._cache[("whole_recording",)] = whole
+        return self._cache[("whole_recording",)]
+
+    def _memoized(self, key: tuple, build):
+        if key not in self._cache:
+            if self.cache is None:
+                self.analysed_sound # decode first, so loading is not counted as Praat analysis time
+                with span(key[0], "praat", params=key[1:]):
+                    self._cache[key] = build()
+            else:
+                cache_key = self.cache.key(self.analysis_hash, key[0], key[1:])
+                with span(key[0], "cache", params=key[1:]):
+                    obj = self.cache.get_praat(cache_key)
+                    if obj is None:
+                        obj = self.cache.get(cache_key) # a stitched chunked track
+                if obj is None:
+                    self.analysed_sound
+                    with span(key[0], "praat", params=key[1:]):
+                        obj = build()
+                    with span(key[0], "cache", params=key[1:]):
+                        if isinstance(obj, parselmouth.Data):
+                            self.cache.put_praat(cache_key, obj)
+                        else:
+                            self.cache.put(cache_key, obj)
+                self._cache[key] = obj
+        return self._cache[key]
+
+    def _track(self, key: tuple, time_step: float, build):
+        """Like _memoized, but analyses the sound in chunks in parallel when chunk_seconds is set."""
+        if not self.chunk_seconds:
+            return self._memoized(key, build)
+
+        def build_chunked():
+            track = analyse_chunked(self.analysed_sound, key[0], key[1:], time_step, self.chunk_seconds, jobs=self.jobs)
+            return build() if track is None else track
+
+        return self._memoized(key + (("chunked", self.chunk_seconds),), build_chunked)
+
+    def pitch(self, time_step: float = 0.01, pitch_floor: float = 75.0, pitch_ceiling: float = 500.0):
+        """Praat autocorrelation pitch track (Sound: To Pitch)."""
+        return self._track(
+            ("pitch", time_step, pitch_floor, pitch_ceiling),
+            time_step,
+            lambda: self.analysed_sound.to_pitch(time_step=time_step, pitch_floor=pitch_floor, pitch_ceiling=pitch_ceiling),
+        )
+
+    def point_process(self, time_step: float = 0.01, pitch_floor: float = 75.0, pitch_ceiling: float = 500.0):
+        """Glottal pulses from the cross-correlation point process (Sound & Pitch: To PointProcess (cc))."""
+        return self._memoized(
+            ("point_process", time_step, pitch_floor, pitch_ceiling),
+            lambda: call([self.analysed_sound, self._praat_pitch(time_step, pitch_floor, pitch_ceiling)], "To PointProcess (cc)"),
+        )
+
+    def _praat_pitch(self, time_step: float, pitch_floor: float, pitch_ceiling: float) -> parselmouth.Pitch:
+        """The unchunked Praat Pitch (To PointProcess (cc) needs the Praat object)."""
+        return self._memoized(
+            ("pitch", time_step, pitch_floor, pitch_ceiling),
+            lambda: self.analysed_sound.to_pitch(time_step=time_step, pitch_floor=pitch_floor, pitch_ceiling=pitch_ceiling),
+        )
+
+    def spectrogram(self, window_length: float = 0.025, time_step: float = 0.01, maximum_frequency: float = 5000.0):
+        if self.spectrogram_engine == "numpy":
+            return self._memoized(
+                ("spectrogram", window_length, time_step, maximum_frequency, "stft"),
+                lambda: stft_spectrogram(self.analysed_sound, window_length, time_step, maximum_frequency),
+            )
+        return self._memoized(
+            ("spectrogram", window_length, time_step, maximum_frequency),
+            lambda: self.analysed_sound.to_spectrogram(
+                window_length=window_length,
+                time_step=time_step,
+                maximum_frequency=maximum_frequency,
+            ),
+        )
+
+    def formant(
+        self,
+        time_step: float = 0.01,
+        n_formants: int = 5,
+        max_formant_hz: float = 5500.0,
+        window_length: float = 0.025,
+        pre_emphasis_from_hz: float = 50.0,
+    ):
+        """Burg formant track (Sound: To Formant (burg)...)."""
+        return self._track(
+            ("formant", time_step, n_formants, max_formant_hz, window_length, pre_emphasis_from_hz),
+            time_step,
+            lambda: call(
+                self.analysed_sound,
+                "To Formant (burg)...",
+                time_step,
+                n_formants,
+                max_formant_hz,
+                window_length,
+                pre_emphasis_from_hz,
+            ),
+        )
+
+    def intensity(self, pitch_floor: float = 75.0, time_step: float = 0.01, subtract_mean: bool = True):
+        return self._track(
+            ("intensity", pitch_floor, time_step, subtract_mean),
+            time_step,
+            lambda: call(self.analysed_sound, "To Intensity...", pitch_floor, time_step, subtract_mean),
+        )
+
+
+def values_at_times(
+    frame_values: np.ndarray,
+    x1: float,
+    dx: float,
+    xmin: float,
+    xmax: float,
+    times: np.ndarray,
+) -> np.ndarray:
+    """
+    Vectorized equivalent of Praat's linear "Get value at time..." on a sampled track.
+
+    frame_values holds one value per frame (NaN where Praat would report undefined, e.g. unvoiced
+    pitch frames). Like Praat, a time is undefined if its nearest frame is undefined or it lies
+    outside [xmin, xmax], and takes the nearest frame's value if the other neighbour is undefined.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    nx = frame_values.shape[0]
+
+    index = (times - x1) / dx
+    ileft = np.floor(index).astype(np.int64)
+    phase = index - ileft
+    near_is_left = phase < 0.5
+    inear = np.where(near_is_left, ileft, ileft + 1)
+    ifar = np.where(near_is_left, ileft + 1, ileft)
+    phase = np.where(near_is_left, phase, 1.0 - phase)
+
+    f_near = frame_values[np.clip(inear, 0, nx - 1)]
+    f_far = frame_values[np.clip(ifar, 0, nx - 1)]
+    f_near = np.where((inear >= 0) & (inear < nx) & (times >= xmin) & (times <= xmax), f_near, np.nan)
+    f_far = np.where((ifar >= 0) & (ifar < nx), f_far, np.nan)
+
+    return np.where(np.isnan(f_far), f_near, f_near + phase * (f_far - f_near))
+
+
+def pitch_values_at_times(pitch: parselmouth.Pitch, times: np.ndarray) -> np.ndarray:
+    """f0 (Hz) at each time, NaN where unvoiced; matches pitch.get_value_at_time(t) for every t."""
+    f0 = pitch.selected_array["frequency"].astype(np.float64)
+    f0[f0 == 0] = np.nan
+    return values_at_times(f0, pitch.x1, pitch.dx, pitch.xmin, pitch.xmax, times)
+
+
+def formant_values_at_times(formant, formant_number: int, times: np.ndarray) -> np.ndarray:
+    """
+    Frequency (Hz) of formant_number at each time, NaN where undefined; matches
+    call(formant, "Get value at time...", formant_number, t, "Hertz", "Linear") for every t.
+    """
+    # Formant: To Matrix stores 0 for frames that have fewer than formant_number formants
+    if isinstance(formant, FormantTrack):
+        f_i = formant.frequencies(formant_number).astype(np.float64)
+    else:
+        f_i = call(formant, "To Matrix...", formant_number).values[0].astype(np.float64)
+    f_i[f_i == 0] = np.nan
+    return values_at_times(f_i, formant.x1, formant.dx, formant.xmin, formant.xmax, times)
+
+
+def as_analysis(sound, sample_rate_hz: float = 0.0, sound_path: str = "") -> RecordingAnalysis:
+    """
+    Returns sound unchanged if it is already a RecordingAnalysis, otherwise wraps it in one.
+
+    sound may be a path, a parselmouth.Sound, or a NumPy array of samples (shape (n_samples,) or
+    (n_samples, n_channels), scaled to [-1, 1]) together with sample_rate_hz. For in-memory sounds,
+    sound_path is only used to name the recording in the stats csv files.
+    """
+    if isinstance(sound, RecordingAnalysis):
+        return sound
+    if isinstance(sound, parselmouth.Sound):
+        return RecordingAnalysis(sound_path or sound.name or "sound", sound)
+    if isinstance(sound, np.ndarray):
+        if sample_rate_hz <= 0:
+            raise ValueError("sample_rate_hz must be given (> 0) when the sound is a NumPy array")
+        return RecordingAnalysis(sound_path or "sound", parselmouth.Sound(sound.T, sampling_frequency=sample_rate_hz))
+    return RecordingAnalysis(sound)
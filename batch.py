@@ -0,0 +1,772 @@
+import multiprocessing
+import contextlib
+from multiprocessing.connection import wait
+import argparse
+import hashlib
+import inspect
+import shutil
+import json
+import glob
+import time
+import os
+import csv
+
+from analysis import RecordingAnalysis, as_analysis
+from feature_store import OUTPUT_FORMATS, check_output_format
+from cache import FeatureCache, _NON_RESULT_ARGS
+from pcm_cache import using_pcm_cache_dir
+from tracing import span, take_spans, summarize, tracing, TRACE_FORMATS
+from render import RENDERERS, render_plots
+from pipeline import analysis_inputs, analysis_stage, run_stages
+from plotting import AUDIO_PLOT_NAME
+from pitch import pitches
+from formants import relative_energy_formant, relative_energy_formants
+from alpha_ratio import alpha_ratio
+from loudness import loudness_in_db
+from jitter import jitter
+from shimmer import shimmer_apqN
+from perturbation import perturbation, jitter_shimmer_windows
+
+
+# Each feature task gets the shared RecordingAnalysis, its csv folder and the output format of its stats ("csv" or
+# "npy", see feature_store.py), and passes its feature function the arguments in FEATURE_INPUTS. Plots are drawn
+# afterwards from the stored stats (see render.py).
+
+def _pitch_task(analysis, csv_folder_name, output_format):
+    pitches(analysis, csv_folder_name, output_format=output_format)
+
+
+def _f3_task(analysis, csv_folder_name, output_format):
+    relative_energy_formant(analysis, csv_folder_name, **FEATURE_INPUTS["f3"][1], output_format=output_format)
+
+
+def _formants_task(analysis, csv_folder_name, output_format):
+    relative_energy_formants(analysis, csv_folder_name, output_format=output_format)
+
+
+def _alpha_ratio_task(analysis, csv_folder_name, output_format):
+    alpha_ratio(analysis, csv_folder_name, output_format=output_format)
+
+
+def _loudness_task(analysis, csv_folder_name, output_format):
+    loudness_in_db(analysis, csv_folder_name, output_format=output_format)
+
+
+def _jitter_task(analysis, csv_folder_name, output_format):
+    jitter(analysis, csv_folder_name, output_format=output_format)
+
+
+def _shimmer_task(analysis, csv_folder_name, output_format):
+    shimmer_apqN(analysis, csv_folder_name, **FEATURE_INPUTS["shimmer"][1], output_format=output_format)
+
+
+def _perturbation_task(analysis, csv_folder_name, output_format):
+    perturbation(analysis, csv_folder_name, output_format=output_format)
+
+
+def _perturbation_windows_task(analysis, csv_folder_name, output_format):
+    jitter_shimmer_windows(analysis, csv_folder_name, output_format=output_format)
+
+
+def _audio_plots_task(analysis, csv_folder_name, output_format):
+    from plotting import save_audio_plot_data
+    # always an npy store (2-D arrays); the settings of alpha_ratio / the formant energies, so the plot reuses
+    # their spectrogram (except with vad: the plot shows the whole recording, they analyse the speech only)
+    save_audio_plot_data(analysis, csv_folder_name, **FEATURE_INPUTS["audio"][1])
+
+
+# feature name -> (task, name of the feature function writing the stats, writes plots)
+FEATURES = {
+    "pitch": (_pitch_task, "pitches", True),
+    "f3": (_f3_task, "relative_energy_formant", True),
+    "formants": (_formants_task, "relative_energy_formants", False),
+    "alpha_ratio": (_alpha_ratio_task, "alpha_ratio", True),
+    "loudness": (_loudness_task, "loudness_in_db", True),
+    "jitter": (_jitter_task, "jitter", False),
+    "shimmer": (_shimmer_task, "shimmer_apqN", False),
+    "perturbation": (_perturbation_task, "perturbation", False),
+    "perturbation_windows": (_perturbation_windows_task, "jitter_shimmer_windows", False),
+    "audio": (_audio_plots_task, "audio_plot_data", True),
+}
+
+
+# The Praat analyses the feature tasks read: (RecordingAnalysis method, names of the feature function arguments
+# it is called with). Stage inputs of the scheduler in pipeline.py (run_batch(..., stage_jobs=...)).
+PITCH_INPUT = ("pitch", ("time_step", "pitch_floor", "pitch_ceiling"))
+POINT_PROCESS_INPUT = ("point_process", ("pitch_time_step", "pitch_floor", "pitch_ceiling"))
+FORMANT_ENERGY_INPUTS = [
+    ("formant", ("time_step", "n_formants", "max_formant_hz", "formant_window_length", "pre_emphasis_from_hz")),
+    ("spectrogram", ("spec_window_length", "time_step", "max_freq_hz")),
+    PITCH_INPUT,
+]
+
+# feature name -> (feature function of its task, arguments the task passes it, analyses it reads)
+FEATURE_INPUTS = {
+    "pitch": (pitches, {}, [PITCH_INPUT]),
+    "f3": (relative_energy_formant, {"formant": 3}, FORMANT_ENERGY_INPUTS),
+    "formants": (relative_energy_formants, {}, FORMANT_ENERGY_INPUTS),
+    "alpha_ratio": (alpha_ratio, {}, [PITCH_INPUT, ("spectrogram", ("window_length", "time_step", "f_high2"))]),
+    "loudness": (loudness_in_db, {}, [("intensity", ("pitch_floor", "time_step", "subtract_mean"))]),
+    "jitter": (jitter, {}, [POINT_PROCESS_INPUT]),
+    "shimmer": (shimmer_apqN, {"N": 5}, [POINT_PROCESS_INPUT]),
+    "perturbation": (perturbation, {}, [POINT_PROCESS_INPUT]),
+    "perturbation_windows": (jitter_shimmer_windows, {}, [POINT_PROCESS_INPUT]),
+    "audio": (None, {"window_length": 0.025, "time_step": 0.01, "maximum_frequency": 5000.0}, [
+        ("spectrogram", ("window_length", "time_step", "maximum_frequency")),
+    ]),
+}
+
+
+def _feature_stages(features: list, output_directory: str, prefix: str, output_format: str) -> dict:
+    """
+    The stages (see pipeline.run_stages) of features: the analyses they read, then the features themselves
+    (named after the feature). The point process reads the pitch track of the same settings.
+    """
+    analyses = {}
+    feature_stages = {}
+    for feature in features:
+        func, task_kwargs, inputs = FEATURE_INPUTS[feature]
+        names = []
+        for name, method, params in analysis_inputs(func, inputs, task_kwargs):
+            if method == "point_process" and analysis_stage("pitch", params) not in analyses:
+                analyses[analysis_stage("pitch", params)] = ([], lambda a, params=params: a.pitch(*params))
+            if name not in analyses:
+                pitch_input = [analysis_stage("pitch", params)] if method == "point_process" else []
+                analyses[name] = (pitch_input, lambda a, method=method, params=params: getattr(a, method)(*params))
+            names.append(name)
+        csv_folder_name, _ = _feature_folders(feature, output_directory, prefix)
+
+        def run(analysis, feature=feature, csv_folder_name=csv_folder_name):
+            with span(feature, "task", sound_path=analysis.sound_path):
+                FEATURES[feature][0](analysis, csv_folder_name, output_format)
+
+        feature_stages[feature] = (names, run)
+    return {**analyses, **feature_stages}
+
+
+def find_recordings(patient_input: str, pattern: str = "*.wav") -> list:
+    """
+    Returns the sorted recording paths of a patient directory (matching pattern), or of a glob.
+    """
+    if os.path.isdir(patient_input):
+        patient_input = os.path.join(patient_input, pattern)
+    return sorted(glob.glob(patient_input))
+
+
+def _feature_folders(feature: str, output_directory: str, prefix: str):
+    _, func_name, writes_plots = FEATURES[feature]
+    csv_folder_name = os.path.join(output_directory, f"{prefix}{feature}_metadata") if func_name else ""
+    plot_folder_name = os.path.join(output_directory, f"{prefix}{feature}_plots") if writes_plots else ""
+    return csv_folder_name, plot_folder_name
+
+
+def _stats_path(feature: str, sound_path: str, output_directory: str, prefix: str, output_format: str) -> str:
+    """The stats file (or npy store folder) that one feature writes for one recording, "" if none."""
+    func_name = FEATURES[feature][1]
+    if not func_name:
+        return ""
+    csv_folder_name, _ = _feature_folders(feature, output_directory, prefix)
+    wav_base = os.path.splitext(os.path.basename(sound_path))[0]
+    if output_format == "npy" or feature == "audio":
+        return os.path.join(csv_folder_name, f"{wav_base}_{func_name}")
+    return os.path.join(csv_folder_name, f"{wav_base}_{func_name}.csv")
+
+
+def _plot_paths(feature: str, sound_path: str, output_directory: str, prefix: str) -> list:
+    """The plots drawn (by render.py) for one feature of one recording."""
+    _, plot_folder_name = _feature_folders(feature, output_directory, prefix)
+    wav_base = os.path.splitext(os.path.basename(sound_path))[0]
+    if feature == "audio":
+        return [
+            os.path.join(plot_folder_name, f"{wav_base}_{AUDIO_PLOT_NAME}_waveform.png"),
+            os.path.join(plot_folder_name, f"{wav_base}_{AUDIO_PLOT_NAME}_spectrogram.png"),
+        ]
+    if plot_folder_name:
+        return [os.path.join(plot_folder_name, f"{prefix}{wav_base}_{feature}.png")]
+    return []
+
+
+def _feature_outputs(feature: str, sound_path: str, output_directory: str, prefix: str, output_format: str) -> list:
+    """Paths of every file (or npy store folder) that one feature writes for one recording."""
+    stats_path = _stats_path(feature, sound_path, output_directory, prefix, output_format)
+    return ([stats_path] if stats_path else []) + _plot_paths(feature, sound_path, output_directory, prefix)
+
+
+def find_plot_jobs(output_directory: str, prefix: str, features: list) -> list:
+    """
+    The plot jobs (see render.py) of every recording whose stats of features are in output_directory, e.g. to
+    draw the plots of an earlier run again.
+    """
+    plot_jobs = []
+    for feature in features:
+        func_name = FEATURES[feature][1]
+        if feature not in RENDERERS:
+            continue
+        csv_folder_name, plot_folder_name = _feature_folders(feature, output_directory, prefix)
+        os.makedirs(plot_folder_name, exist_ok=True)
+        suffix = f"_{func_name}"
+        for stats_path in sorted(glob.glob(os.path.join(csv_folder_name, f"*{suffix}*"))):
+            stats_name = os.path.basename(stats_path)
+            if stats_name.endswith(".csv"):
+                stats_name = stats_name[:-len(".csv")]
+            if not stats_name.endswith(suffix):
+                continue
+            wav_base = stats_name[:-len(suffix)]
+            plot_jobs.append((wav_base, feature, stats_path, _plot_paths(feature, wav_base, output_directory, prefix)))
+    return plot_jobs
+
+
+def _feature_params(feature: str) -> tuple:
+    """
+    What a feature's task runs its function with: the function's default arguments (those changing the result)
+    updated with the arguments the task passes (FEATURE_INPUTS, e.g. shimmer_apqN's N).
+    """
+    func, task_kwargs, _ = FEATURE_INPUTS[feature]
+    arguments = {}
+    if func is not None:
+        arguments = {
+            name: p.default for name, p in inspect.signature(func).parameters.items()
+            if p.default is not inspect.Parameter.empty and name not in _NON_RESULT_ARGS
+        }
+    arguments.update(task_kwargs)
+    return tuple(sorted(arguments.items()))
+
+
+def _param_hash(
+    feature: str,
+    sound_path: str,
+    preprocess: bool,
+    output_format: str,
+    vad: bool = False,
+    chunk_seconds: float = 0.0,
+    spectrogram_engine: str = "praat",
+    preprocess_dtype: str = "float64",
+) -> str:
+    """
+    Identifies what a manifest entry was computed from: the feature, its settings, the arguments of its function
+    (_feature_params, so a changed default reruns it on resume) and the input file version.
+    """
+    st = os.stat(sound_path)
+    settings = (feature, preprocess, output_format, vad, chunk_seconds, _feature_params(feature))
+    if spectrogram_engine != "praat":
+        settings += (spectrogram_engine,) # keeps the hashes of earlier manifests
+    if preprocess and preprocess_dtype != "float64":
+        settings += (preprocess_dtype,)
+    return hashlib.sha256(repr(settings + (st.st_size, st.st_mtime_ns)).encode()).hexdigest()[:16]
+
+
+def _read_manifest(manifest_path: str) -> dict:
+    """(sound_path, feature) -> latest manifest record. A truncated last line (killed mid-write) is ignored."""
+    latest = {}
+    if not os.path.exists(manifest_path):
+        return latest
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            latest[(record["sound_path"], record["feature"])] = record
+    return latest
+
+
+def _read_summary(summary_path: str) -> dict:
+    """sound_path -> row of an earlier batch_summary.csv."""
+    if not os.path.exists(summary_path):
+        return {}
+    with open(summary_path, newline="") as f:
+        return {row["sound_path"]: row for row in csv.DictReader(f)}
+
+
+def _append_manifest(manifest_file, record: dict):
+    manifest_file.write(json.dumps(record) + "\n")
+    manifest_file.flush()
+    os.fsync(manifest_file.fileno()) # checkpoint: survives the node going down right after
+
+
+def _remove_outputs(outputs: list):
+    for path in outputs:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def _process_recording(
+    sound_path: str,
+    features: list,
+    output_directory: str,
+    prefix: str,
+    preprocess: bool,
+    preprocess_dtype: str,
+    output_format: str,
+    cache_dir: str,
+    cache_max_bytes: int,
+    vad: bool,
+    chunk_seconds: float,
+    chunk_jobs: int,
+    spectrogram_engine: str,
+    stage_jobs: int,
+    conn,
+):
+    """
+    Worker: runs every requested feature on one recording with a shared RecordingAnalysis, so the
+    file is decoded and pitch-tracked once. A failing feature is recorded and the others still run.
+
+    With preprocess, the recording is demeaned and high-pass filtered in memory first and the features
+    run on the filtered samples, without writing or re-reading a processed WAV (in preprocess_dtype, see
+    preprocessing._scaled_zero_phase_highpass).
+
+    Sends ("start", feature) before and ("done", feature, error or "", elapsed seconds, tracing spans) after
+    each feature, so the parent can checkpoint every feature as soon as it finishes, and finally
+    ("duration", recording length in seconds).
+
+    With vad, the Praat analyses run on the speech segments only (see vad.py). A recording without
+    speech sends ("no_speech", spans) and runs no feature.
+
+    With chunk_seconds, long recordings are pitch-tracked etc. in chunks on chunk_jobs processes (see chunked.py).
+
+    spectrogram_engine selects Praat or stft.stft_spectrogram for the spectrograms of the recording.
+
+    With stage_jobs > 1, the analyses and features run as a DAG of stages, up to stage_jobs of them at a time
+    (see pipeline.py); the spans of the analysis stages are sent as ("spans", spans).
+    """
+    take_spans() # drop any inherited from the parent
+    cache = FeatureCache(cache_dir, cache_max_bytes) if cache_dir else None
+    if preprocess:
+        from preprocessing import demean_and_butterworth_highpass_filter
+        preprocess_csv_folder_name = os.path.join(output_directory, f"{prefix}preprocess_metadata")
+        wav_base = os.path.splitext(os.path.basename(sound_path))[0]
+        preprocess_csv_file_name = f"{preprocess_csv_folder_name}/{wav_base}_demean_and_butterworth_highpass_filter.csv"
+        try:
+            with span("preprocess", "task", sound_path=sound_path):
+                samples, sampling_hz = demean_and_butterworth_highpass_filter(
+                    sound_path,
+                    "",
+                    preprocess_csv_folder_name,
+                    dtype=preprocess_dtype,
+                    stats=not os.path.exists(preprocess_csv_file_name), # already written by an interrupted run
+                    return_samples=True,
+                )
+        except Exception as e:
+            error = f"preprocess: {type(e).__name__}: {' '.join(str(e).split())}"
+            for feature in features:
+                conn.send(("done", feature, error, 0.0, take_spans()))
+            conn.close()
+            return
+        analysis = as_analysis(samples, sampling_hz, sound_path)
+        analysis.cache = cache
+        analysis.speech_only = vad
+        analysis.chunk_seconds = chunk_seconds
+        analysis.jobs = chunk_jobs
+        analysis.spectrogram_engine = spectrogram_engine
+    else:
+        analysis = RecordingAnalysis(
+            sound_path,
+            cache=cache,
+            speech_only=vad,
+            chunk_seconds=chunk_seconds,
+            jobs=chunk_jobs,
+            spectrogram_engine=spectrogram_engine,
+        )
+    if vad:
+        try:
+            no_speech = analysis.speech_segments().shape[0] == 0
+        except Exception:
+            no_speech = False # unreadable recording: let the features report the error
+        if no_speech:
+            conn.send(("no_speech", take_spans()))
+            conn.send(("duration", analysis.duration))
+            conn.close()
+            return
+    if stage_jobs > 1:
+        def on_start(name):
+            if name in features:
+                conn.send(("start", name))
+
+        def on_done(name, error, elapsed_sec, spans):
+            spans += take_spans() # loading, here before the stages started
+            if name in features:
+                conn.send(("done", name, error, elapsed_sec, spans))
+            else:
+                conn.send(("spans", spans)) # analysis stage: its errors reach the features reading it
+
+        run_stages(analysis, _feature_stages(features, output_directory, prefix, output_format), stage_jobs, on_start, on_done)
+    else:
+        for feature in features:
+            task = FEATURES[feature][0]
+            conn.send(("start", feature))
+            start = time.perf_counter()
+            try:
+                csv_folder_name, _ = _feature_folders(feature, output_directory, prefix)
+                with span(feature, "task", sound_path=sound_path):
+                    task(analysis, csv_folder_name, output_format)
+                error = ""
+            except Exception as e:
+                error = f"{type(e).__name__}: {' '.join(str(e).split())}"
+            conn.send(("done", feature, error, time.perf_counter() - start, take_spans()))
+    try:
+        conn.send(("duration", analysis.duration))
+    except Exception:
+        pass # unreadable recording, already reported as failed
+    conn.close()
+
+
+def run_batch(
+    sound_paths: list,
+    features: list,
+    output_directory: str,
+    prefix: str = "",
+    jobs: int = 1,
+    timeout: float = 0.0, # per recording, in seconds; 0 means no timeout
+    preprocess: bool = False, # demean + high-pass filter each recording in memory before extracting features
+    preprocess_dtype: str = "float64", # float type of the preprocessing, "float64" or "float32"
+    output_format: str = "csv", # stats format of the features, "csv" or "npy" (see feature_store.py)
+    cache_dir: str = "", # if given, cache Praat analyses and feature results there (see cache.py)
+    cache_size_gb: float = 20.0,
+    pcm_cache_dir: str = "", # if given, decode every recording once into memory-mappable PCM there (see pcm_cache.py)
+    pcm_cache_size_gb: float = 100.0,
+    resume: bool = False, # skip what the manifest of an earlier run records as done
+    vad: bool = False, # run the Praat analyses on the detected speech only, skip recordings without speech
+    chunk_seconds: float = 0.0, # if given, analyse recordings longer than two chunks in parallel chunks (see chunked.py)
+    spectrogram_engine: str = "praat", # "praat" or "numpy" (float32 STFT, see stft.py)
+    stage_jobs: int = 1, # if > 1, run the independent analyses and features of a recording concurrently (see pipeline.py)
+    trace_path: str = "", # if given, export the tracing spans of every worker there (see tracing.py)
+    trace_format: str = "chrome", # "chrome" (chrome://tracing, Perfetto) or "json"
+) -> list:
+    """
+    Runs the requested features over many recordings, one worker process per recording and at most
+    jobs at a time. A recording that raises, crashes its worker (e.g. OOM kill) or runs longer than
+    timeout is recorded as failed without stopping or holding up the rest of the batch.
+
+    With cache_dir, re-running a batch reuses every Praat analysis and feature result whose recording
+    and parameters did not change, and restores deleted stats files instead of recomputing them.
+
+    With pcm_cache_dir, every recording is decoded (or copied from the network mount) once and later runs
+    memory-map the local PCM copy instead of decoding the input again.
+
+    Outputs go to {output_directory}/{prefix}{feature}_metadata and {prefix}{feature}_plots (plots are
+    named {prefix}{wav_base}_{feature}.png, wav_base being the file name without .wav, e.g. 579_audio),
+    and a summary of every recording is written to {output_directory}/{prefix}batch_summary.csv. The plots
+    are drawn after the features, from their stored stats, on a pool of jobs processes (see render.py); a
+    plot that fails marks its feature as failed.
+
+    Every feature of every recording is checkpointed in {output_directory}/{prefix}batch_manifest.jsonl
+    (status "running", "ok" or "failed", output paths, parameter hash, timing) as soon as it starts and
+    finishes. With resume, features whose latest record is "ok" with the same parameter hash (the batch
+    settings, the arguments of the feature function including its defaults, and the file version) and whose
+    outputs still exist are skipped; the partial outputs of features that were running or failed are
+    deleted and those features are run again, so the finished outputs are the same as those of an
+    uninterrupted run (byte for byte with cache_dir; otherwise up to the elapsed_seconds timing column).
+    The summary keeps the rows of the earlier runs: a skipped recording keeps its earlier row (or one made
+    from its manifest records if the earlier run ended before writing the summary).
+
+    With vad, recordings in which no speech is detected are skipped early and reported with status "no_speech".
+
+    With chunk_seconds, the Praat analyses of long recordings are split into chunks run on a pool of
+    cpu_count // (jobs * stage_jobs) processes (at least one) per recording, so that a few long sessions no
+    longer run single-threaded at the end of the batch without oversubscribing the cores.
+
+    With spectrogram_engine="numpy", spectrograms (alpha ratio, formant energies, spectrogram plots) are computed
+    by a float32 NumPy STFT instead of Praat (see stft.py).
+
+    With stage_jobs > 1, every recording runs as a DAG of stages (the Praat analyses and the features reading
+    them, see FEATURE_INPUTS and pipeline.py) with up to stage_jobs independent stages at a time, so it takes
+    about as long as its critical path; up to jobs * stage_jobs stage processes run at once (with chunk_seconds,
+    each with the chunk pool above).
+
+    The throughput of the batch (audio seconds per wall second, files per minute) and the time spent
+    loading, in Praat, in NumPy post-processing, writing outputs and plotting are printed at the end, and saved
+    with the spans when trace_path is given.
+
+    Returns: list of dicts with sound_path, status ("ok", "failed", "crashed", "timeout", "no_speech" or "skipped"), errors,
+    elapsed_seconds, duration_seconds (length of the recording, NaN if unknown)
+    """
+    batch_start = time.perf_counter()
+    check_output_format(output_format)
+    if trace_format not in TRACE_FORMATS:
+        raise ValueError(f"trace_format must be one of {list(TRACE_FORMATS)}")
+    pcm_cache_context = using_pcm_cache_dir(pcm_cache_dir, int(pcm_cache_size_gb * 1024**3)) if pcm_cache_dir else contextlib.nullcontext()
+    with pcm_cache_context, tracing(): # inherited by the workers, restored afterwards
+        for feature in features:
+            if feature not in FEATURES:
+                raise ValueError(f"Unknown feature {feature!r}. Options: {', '.join(FEATURES)}")
+            for folder_name in _feature_folders(feature, output_directory, prefix):
+                if folder_name:
+                    os.makedirs(folder_name, exist_ok=True)
+        if preprocess:
+            os.makedirs(os.path.join(output_directory, f"{prefix}preprocess_metadata"), exist_ok=True)
+
+        manifest_path = os.path.join(output_directory, f"{prefix}batch_manifest.jsonl")
+        previous = _read_manifest(manifest_path) if resume else {}
+        summary_path = os.path.join(output_directory, f"{prefix}batch_summary.csv")
+        summary = _read_summary(summary_path) if resume else {}
+        manifest_file = open(manifest_path, "a" if resume else "w")
+
+        def record(sound_path, feature, status, error="", elapsed_sec=0.0):
+            _append_manifest(manifest_file, {
+                "sound_path": sound_path,
+                "feature": feature,
+                "status": status,
+                "outputs": _feature_outputs(feature, sound_path, output_directory, prefix, output_format),
+                "param_hash": _param_hash(feature, sound_path, preprocess, output_format, vad, chunk_seconds, spectrogram_engine, preprocess_dtype),
+                "error": error,
+                "elapsed_seconds": elapsed_sec,
+            })
+
+        pending = [] # (sound_path, features still to run)
+        results = []
+        plot_jobs = [] # (key, feature, stats path, plot paths) of the features that finished, drawn at the end
+        for sound_path in sound_paths:
+            todo = []
+            for feature in features:
+                done = previous.get((sound_path, feature))
+                current = done is not None and done["param_hash"] == _param_hash(
+                    feature, sound_path, preprocess, output_format, vad, chunk_seconds, spectrogram_engine, preprocess_dtype
+                )
+                if current and (
+                    done["status"] == "no_speech"
+                    or done["status"] == "ok" and all(os.path.exists(path) for path in done["outputs"])
+                ):
+                    continue
+                stats_path = _stats_path(feature, sound_path, output_directory, prefix, output_format)
+                if current and done["status"] == "ok" and feature in RENDERERS and os.path.exists(stats_path):
+                    # only plots are missing: draw them from the stats
+                    plot_jobs.append(((sound_path, feature), feature, stats_path, _plot_paths(feature, sound_path, output_directory, prefix)))
+                    continue
+                if done is not None:
+                    _remove_outputs(done["outputs"]) # left over from an interrupted or failed attempt
+                todo.append(feature)
+            if todo:
+                pending.append((sound_path, todo))
+            else:
+                results.append({
+                    "sound_path": sound_path,
+                    "status": "skipped",
+                    "errors": {},
+                    "elapsed_seconds": 0.0,
+                    "duration_seconds": float("nan"),
+                })
+                print(f"[{len(results)}/{len(sound_paths)}] skipped (done in an earlier run): {sound_path}")
+
+        running = {} # process sentinel -> (process, parent conn, sound_path, features, errors, features in progress, start time)
+        spans = []
+        durations = {}
+
+        no_speech = set()
+
+        def receive(sound_path, todo, parent_conn, errors, in_progress):
+            while parent_conn.poll():
+                try:
+                    message = parent_conn.recv()
+                except EOFError:
+                    return
+                if message[0] == "start":
+                    in_progress.add(message[1])
+                    record(sound_path, message[1], "running")
+                elif message[0] == "duration":
+                    durations[sound_path] = message[1]
+                elif message[0] == "spans":
+                    spans.extend(message[1])
+                elif message[0] == "no_speech":
+                    spans.extend(message[1])
+                    no_speech.add(sound_path)
+                    for feature in todo:
+                        record(sound_path, feature, "no_speech")
+                else:
+                    _, feature, error, elapsed_sec, worker_spans = message
+                    spans.extend(worker_spans)
+                    in_progress.discard(feature)
+                    if error:
+                        errors[feature] = error
+                    elif feature in RENDERERS:
+                        plot_jobs.append((
+                            (sound_path, feature),
+                            feature,
+                            _stats_path(feature, sound_path, output_directory, prefix, output_format),
+                            _plot_paths(feature, sound_path, output_directory, prefix),
+                        ))
+                    record(sound_path, feature, "failed" if error else "ok", error, elapsed_sec)
+
+        while pending or running:
+            while pending and len(running) < max(1, jobs):
+                sound_path, todo = pending.pop(0)
+                parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(
+                    target=_process_recording,
+                    args=(
+                        sound_path,
+                        todo,
+                        output_directory,
+                        prefix,
+                        preprocess,
+                        preprocess_dtype,
+                        output_format,
+                        cache_dir,
+                        int(cache_size_gb * 1024**3),
+                        vad,
+                        chunk_seconds,
+                        max(1, (os.cpu_count() or 1) // (max(1, jobs) * max(1, stage_jobs))), # chunk pool: its share of the cores
+                        spectrogram_engine,
+                        stage_jobs,
+                        child_conn,
+                    ),
+                )
+                process.start()
+                child_conn.close()
+                running[process.sentinel] = (process, parent_conn, sound_path, todo, {}, set(), time.perf_counter())
+
+            if timeout > 0:
+                now = time.perf_counter()
+                wait_sec = max(0.0, min(entry[-1] + timeout for entry in running.values()) - now)
+            else:
+                wait_sec = None
+            ready = wait(list(running) + [entry[1] for entry in running.values()], timeout=wait_sec)
+
+            now = time.perf_counter()
+            for sentinel in list(running):
+                process, parent_conn, sound_path, todo, errors, in_progress, start = running[sentinel]
+                receive(sound_path, todo, parent_conn, errors, in_progress)
+                if sentinel in ready:
+                    process.join()
+                    receive(sound_path, todo, parent_conn, errors, in_progress)
+                    if process.exitcode == 0:
+                        status = "no_speech" if sound_path in no_speech else "failed" if errors else "ok"
+                    else:
+                        errors["worker"] = f"exited with code {process.exitcode}"
+                        status = "crashed"
+                elif timeout > 0 and now - start >= timeout:
+                    process.terminate()
+                    process.join()
+                    errors["worker"] = f"timed out after {timeout} s"
+                    status = "timeout"
+                else:
+                    continue
+                for feature in in_progress:
+                    record(sound_path, feature, "failed", errors["worker"])
+                parent_conn.close()
+                del running[sentinel]
+                results.append({
+                    "sound_path": sound_path,
+                    "status": status,
+                    "errors": errors,
+                    "elapsed_seconds": now - start,
+                    "duration_seconds": durations.get(sound_path, float("nan")),
+                })
+                print(f"[{len(results)}/{len(sound_paths)}] {status}: {sound_path}")
+
+        # draw the plots from the stored stats (render.py), on the same number of processes
+        result_of = {result["sound_path"]: result for result in results}
+        plot_failures = 0
+        for (sound_path, feature), error, worker_spans in render_plots(plot_jobs, max(1, jobs)):
+            spans.extend(worker_spans)
+            if error:
+                plot_failures += 1
+                error = f"plot: {error}"
+                record(sound_path, feature, "failed", error)
+                result = result_of[sound_path]
+                result["errors"][feature] = error
+                if result["status"] in ("ok", "skipped"):
+                    result["status"] = "failed"
+                print(f"failed: {feature} plot of {sound_path}: {error}")
+        if plot_jobs:
+            print(f"{len(plot_jobs) - plot_failures} of {len(plot_jobs)} plot jobs drawn")
+
+        manifest_file.close()
+
+        batch_elapsed_sec = time.perf_counter() - batch_start
+        processed = [result for result in results if result["status"] != "skipped"]
+        if vad:
+            print(f"no speech detected in {sum(result['status'] == 'no_speech' for result in results)} files")
+        audio_sec = sum(result["duration_seconds"] for result in processed if result["duration_seconds"] == result["duration_seconds"])
+        throughput = {
+            "wall_seconds": batch_elapsed_sec,
+            "files": len(processed),
+            "audio_seconds": audio_sec,
+            "audio_seconds_per_wall_second": audio_sec / batch_elapsed_sec,
+            "files_per_minute": 60 * len(processed) / batch_elapsed_sec,
+        }
+        print(
+            f"{len(processed)} files, {audio_sec:.1f} s of audio in {batch_elapsed_sec:.1f} s: "
+            f"{throughput['audio_seconds_per_wall_second']:.1f} audio s / wall s, {throughput['files_per_minute']:.1f} files / min"
+        )
+        print("time in " + ", ".join(f"{category}: {seconds:.2f} s" for category, seconds in summarize(spans).items()))
+        if trace_path:
+            TRACE_FORMATS[trace_format](spans, trace_path, throughput)
+
+        for result in results:
+            earlier = summary.get(result["sound_path"])
+            if result["status"] == "skipped" and earlier is not None and earlier["features"] == " ".join(features):
+                continue # keeps the row of the run that computed it
+            status = result["status"]
+            elapsed_sec = result["elapsed_seconds"]
+            if status == "skipped": # the earlier run ended before writing the summary: its manifest records
+                done = [previous[(result["sound_path"], feature)] for feature in features]
+                status = "no_speech" if any(record["status"] == "no_speech" for record in done) else "ok"
+                elapsed_sec = sum(record["elapsed_seconds"] for record in done)
+            summary[result["sound_path"]] = {
+                "sound_path": result["sound_path"],
+                "status": status,
+                "features": " ".join(features),
+                "errors": "; ".join(f"{k}: {v}" for k, v in result["errors"].items()),
+                "elapsed_seconds": f"{elapsed_sec:.6f}",
+                "duration_seconds": f"{result['duration_seconds']:.6f}" if result["duration_seconds"] == result["duration_seconds"] else "",
+            }
+        with open(summary_path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["sound_path", "status", "features", "errors", "elapsed_seconds", "duration_seconds"])
+            writer.writeheader()
+            writer.writerows(summary.values())
+
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract audio features from many recordings in parallel.")
+    parser.add_argument("input", help="patient directory (all *.wav files in it) or a glob of recordings")
+    parser.add_argument("--features", nargs="+", default=list(FEATURES), choices=list(FEATURES))
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--prefix", default="", help="prefix of the output folder names")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--timeout", type=float, default=0.0, help="per recording, in seconds (0 = no timeout)")
+    parser.add_argument("--preprocess", action="store_true", help="demean + high-pass filter in memory before extracting features")
+    parser.add_argument("--preprocess-dtype", default="float64", choices=["float64", "float32"], help="float type of --preprocess")
+    parser.add_argument("--output-format", default="csv", choices=OUTPUT_FORMATS, help="stats as csv files or as .npy columns (feature_store.py)")
+    parser.add_argument("--cache-dir", default="", help="cache of Praat analyses and feature results (cache.py)")
+    parser.add_argument("--cache-size-gb", type=float, default=20.0)
+    parser.add_argument("--pcm-cache-dir", default="", help="local cache of decoded recordings (pcm_cache.py)")
+    parser.add_argument("--pcm-cache-size-gb", type=float, default=100.0)
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run from its batch_manifest.jsonl")
+    parser.add_argument("--vad", action="store_true", help="analyse only the detected speech; skip recordings without speech (vad.py)")
+    parser.add_argument("--chunk-seconds", type=float, default=0.0, help="analyse long recordings in parallel chunks of this length (chunked.py)")
+    parser.add_argument("--spectrogram-engine", default="praat", choices=["praat", "numpy"], help="spectrograms from Praat or a float32 NumPy STFT (stft.py)")
+    parser.add_argument("--stage-jobs", type=int, default=1, help="independent stages of a recording run at once (pipeline.py)")
+    parser.add_argument("--trace", default="", help="export the timing spans of the run to this file (tracing.py)")
+    parser.add_argument("--trace-format", default="chrome", choices=list(TRACE_FORMATS))
+    args = parser.parse_args()
+
+    run_batch(
+        find_recordings(args.input),
+        args.features,
+        args.output_dir,
+        prefix=args.prefix,
+        jobs=args.jobs,
+        timeout=args.timeout,
+        preprocess=args.preprocess,
+        preprocess_dtype=args.preprocess_dtype,
+        output_format=args.output_format,
+        cache_dir=args.cache_dir,
+        cache_size_gb=args.cache_size_gb,
+        pcm_cache_dir=args.pcm_cache_dir,
+        pcm_cache_size_gb=args.pcm_cache_size_gb,
+        resume=args.resume,
+        vad=args.vad,
+        chunk_seconds=args.chunk_seconds,
+        spectrogram_engine=args.spectrogram_engine,
+        stage_jobs=args.stage_jobs,
+        trace_path=args.trace,
+        trace_format=args.trace_format,
+    )
+
+
+if __name__ == "__main__":
+    main()
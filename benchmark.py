@@ -0,0 +1,564 @@
+import multiprocessing
+import numpy as np
+import parselmouth
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import json
+import glob
+import time
+import sys
+import os
+import csv
+from scipy.io import wavfile
+from parselmouth.praat import call
+
+from pitch import pitches
+from formants import relative_energy_formant
+from alpha_ratio import alpha_ratio
+from loudness import loudness_in_db
+from jitter import jitter
+from shimmer import shimmer_apqN
+from perturbation import perturbation, jitter_shimmer_windows
+from stft import stft_spectrogram
+from preprocessing import demean_and_butterworth_highpass_filter, _open_wav_blocks, _close_wav_blocks
+from batch import find_recordings, run_batch
+from analysis import RecordingAnalysis
+from chunked import analyse_chunked, CHUNKED_INTENSITY_TOLERANCE_DB
+
+
+# Benchmarks of every feature extractor and of the preprocessing, on the samples in raw_audio/ and on
+# synthetic speech-like recordings of several lengths.
+#
+# Each stage runs in a fresh process on the recording's path (so it pays for its own decoding and Praat
+# analyses, as when called on its own) and writes its stats to a scratch folder. Reported per stage:
+#   wall_seconds   fastest of the repeats
+#   realtime_factor  wall_seconds / recording duration (< 1 is faster than real time)
+#   peak_rss_mb    peak resident memory of the process running the stage
+#   peak_delta_mb  how much of it the stage itself added
+#
+# Usage:
+#   python benchmark.py --save-baseline baseline.json              # record a baseline
+#   python benchmark.py --baseline baseline.json                   # compare; exits 1 on a regression
+#   python benchmark.py --lengths 60 --stages pitches jitter       # quick subset
+#   python benchmark.py --imports                                  # import-time budget; exits 1 when over it
+#   python benchmark.py --equivalence                              # fast paths vs reference; exits 1 on a mismatch
+#
+# The import check imports each library module in a fresh interpreter, as a spawned pool worker would, and
+# fails when one takes longer than the budget or loads a plotting library (those are only imported when a
+# plot is drawn).
+#
+# The equivalence checks (EQUIVALENCE_CHECKS) run the optimized code paths on synthetic recordings and compare
+# them with the reference computation they replace, within the tolerance each module documents.
+
+DEFAULT_LENGTHS_SECONDS = [60, 30 * 60, 3 * 60 * 60]
+
+# modules the batch workers import, checked by --imports
+IMPORT_MODULES = [
+    "analysis", "pitch", "formants", "alpha_ratio", "loudness", "jitter", "shimmer", "perturbation",
+    "preprocessing", "denoising", "pipeline", "render", "batch",
+]
+IMPORT_BUDGET_SECONDS = 1.0
+# loading any of these at import time fails the check
+DEFERRED_IMPORTS = ["matplotlib", "seaborn"]
+
+
+def _preprocess_stage(sound_path, csv_folder_name):
+    demean_and_butterworth_highpass_filter(sound_path, os.path.join(csv_folder_name, "preprocessed.wav"), csv_folder_name)
+
+
+def _preprocess_blocks_stage(sound_path, csv_folder_name):
+    demean_and_butterworth_highpass_filter(
+        sound_path, os.path.join(csv_folder_name, "preprocessed.wav"), csv_folder_name, block_seconds=60.0
+    )
+
+
+# stage name -> function(sound_path, csv_folder_name)
+STAGES = {
+    "pitches": lambda sound_path, csv_folder_name: pitches(sound_path, csv_folder_name),
+    "relative_energy_formant": lambda sound_path, csv_folder_name: relative_energy_formant(sound_path, csv_folder_name, 3),
+    "alpha_ratio": lambda sound_path, csv_folder_name: alpha_ratio(sound_path, csv_folder_name),
+    "loudness_in_db": lambda sound_path, csv_folder_name: loudness_in_db(sound_path, csv_folder_name),
+    "jitter": lambda sound_path, csv_folder_name: jitter(sound_path, csv_folder_name),
+    "shimmer_apqN": lambda sound_path, csv_folder_name: shimmer_apqN(sound_path, csv_folder_name, 5),
+    "demean_and_butterworth_highpass_filter": _preprocess_stage,
+    "demean_and_butterworth_highpass_filter_blocks": _preprocess_blocks_stage,
+}
+
+
+def make_synthetic_recording(
+    output_path: str,
+    duration_seconds: float,
+    sampling_hz: int = 16000,
+    seed: int = 0,
+    block_seconds: float = 60.0,
+):
+    """
+    Writes a deterministic speech-like mono 16-bit WAV: a harmonic voice source with drifting f0
+    (roughly 90-160 Hz, with vibrato and jitter), syllable-rate amplitude modulation, a pause every few
+    seconds and a low noise floor. Written block by block, so any length fits in memory.
+    """
+    rng = np.random.default_rng(seed)
+    block = int(block_seconds * sampling_hz)
+    n_samples = int(duration_seconds * sampling_hz)
+    n_harmonics = 12
+    harmonic_gains = 1.0 / np.arange(1, n_harmonics + 1) # -6 dB/octave source slope
+
+    f = _open_wav_blocks(output_path, sampling_hz, 1, np.dtype(np.int16))
+    data_bytes = 0
+    phase = 0.0
+    try:
+        for start in range(0, n_samples, block):
+            t = np.arange(start, min(start + block, n_samples)) / sampling_hz
+            f0 = (
+                125.0
+                + 25.0 * np.sin(2 * np.pi * 0.05 * t)
+                + 3.0 * np.sin(2 * np.pi * 5.5 * t)
+                + rng.normal(0.0, 1.0, t.shape[0])
+            )
+            phases = phase + 2 * np.pi * np.cumsum(f0) / sampling_hz
+            phase = phases[-1]
+            voice = np.zeros(t.shape[0])
+            for k, gain in enumerate(harmonic_gains, start=1):
+                voice += gain * np.sin(k * phases)
+            syllables = 0.5 * (1.0 - np.cos(2 * np.pi * 4.0 * t))
+            talking = (t % 5.0) < 4.0 # 1 s pause every 5 s
+            y = 0.25 * voice * syllables * talking + rng.normal(0.0, 0.002, t.shape[0])
+            y_out = (np.clip(y, -1.0, 1.0) * 32767).round().astype(np.int16)
+            f.write(y_out.tobytes())
+            data_bytes += y_out.nbytes
+    finally:
+        _close_wav_blocks(f, data_bytes)
+
+
+def synthetic_recordings(synthetic_dir: str, lengths_seconds: list, sampling_hz: int = 16000) -> list:
+    """Paths of the synthetic recordings of each length, generating the ones not already in synthetic_dir."""
+    os.makedirs(synthetic_dir, exist_ok=True)
+    paths = []
+    for duration_seconds in lengths_seconds:
+        path = os.path.join(synthetic_dir, f"synthetic_{int(duration_seconds)}s_{sampling_hz}hz.wav")
+        if not os.path.exists(path):
+            print(f"generating {path}")
+            make_synthetic_recording(path + ".tmp", duration_seconds, sampling_hz)
+            os.replace(path + ".tmp", path)
+        paths.append(path)
+    return paths
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+def _run_stage(stage: str, sound_path: str, conn):
+    """Worker: runs one stage once and sends (wall seconds, peak rss MB, peak delta MB) or the error."""
+    try:
+        rss_before_mb = _rss_mb()
+        with tempfile.TemporaryDirectory() as csv_folder_name:
+            start = time.perf_counter()
+            STAGES[stage](sound_path, csv_folder_name)
+            wall_seconds = time.perf_counter() - start
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # kB on Linux
+        conn.send((wall_seconds, peak_rss_mb, max(0.0, peak_rss_mb - rss_before_mb), ""))
+    except Exception as e:
+        conn.send((np.nan, np.nan, np.nan, f"{type(e).__name__}: {' '.join(str(e).split())}"))
+    conn.close()
+
+
+def benchmark_stage(stage: str, sound_path: str, repeat: int = 1) -> dict:
+    """
+    Runs one stage repeat times, each in a fresh process.
+
+    Returns: dict with recording, stage, duration_seconds, wall_seconds (fastest run), realtime_factor,
+    peak_rss_mb and peak_delta_mb (largest run), error
+    """
+    sampling_hz, data = wavfile.read(sound_path, mmap=True) # header only, so the parent stays small
+    duration_seconds = data.shape[0] / sampling_hz
+    walls, peaks, deltas, error = [], [], [], ""
+    for _ in range(repeat):
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_run_stage, args=(stage, sound_path, child_conn))
+        process.start()
+        child_conn.close()
+        try:
+            wall_seconds, peak_rss_mb, peak_delta_mb, error = parent_conn.recv()
+        except EOFError:
+            wall_seconds, peak_rss_mb, peak_delta_mb = np.nan, np.nan, np.nan
+            error = "worker died (e.g. out of memory)"
+        process.join()
+        if error:
+            break
+        walls.append(wall_seconds)
+        peaks.append(peak_rss_mb)
+        deltas.append(peak_delta_mb)
+    return {
+        "recording": os.path.basename(sound_path),
+        "stage": stage,
+        "duration_seconds": duration_seconds,
+        "wall_seconds": min(walls) if not error else np.nan,
+        "realtime_factor": min(walls) / duration_seconds if not error else np.nan,
+        "peak_rss_mb": max(peaks) if not error else np.nan,
+        "peak_delta_mb": max(deltas) if not error else np.nan,
+        "error": error,
+    }
+
+
+def run_benchmarks(sound_paths: list, stages: list, repeat: int = 1) -> list:
+    results = []
+    for sound_path in sound_paths:
+        for stage in stages:
+            result = benchmark_stage(stage, sound_path, repeat)
+            results.append(result)
+            print(
+                f"{result['recording']:<32} {stage:<46} {result['wall_seconds']:9.3f} s"
+                f"  RTF {result['realtime_factor']:.4f}  peak {result['peak_rss_mb']:8.1f} MB"
+                f" (+{result['peak_delta_mb']:.1f}) {result['error']}"
+            )
+    return results
+
+
+def measure_import(module: str) -> tuple:
+    """
+    Imports module in a fresh interpreter.
+
+    Returns: seconds, names of the DEFERRED_IMPORTS it loaded, error ("" if none)
+    """
+    code = (
+        "import time, sys, json\n"
+        "start = time.perf_counter()\n"
+        f"import {module}\n"
+        "seconds = time.perf_counter() - start\n"
+        f"print(json.dumps([seconds, [m for m in {DEFERRED_IMPORTS!r} if m in sys.modules]]))\n"
+    )
+    process = subprocess.run(
+        [sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        last_line = (process.stderr.strip().splitlines() or [f"exit code {process.returncode}"])[-1]
+        return np.nan, [], last_line
+    seconds, loaded = json.loads(process.stdout.strip().splitlines()[-1])
+    return seconds, loaded, ""
+
+
+def check_imports(modules: list, budget_seconds: float = IMPORT_BUDGET_SECONDS, repeat: int = 1) -> list:
+    """
+    Measures the import time of every module (fastest of repeat fresh interpreters).
+
+    Returns: list of messages for the modules over budget, loading a deferred import or failing to import
+    """
+    failures = []
+    for module in modules:
+        runs = [measure_import(module) for _ in range(max(1, repeat))]
+        seconds = min(run[0] for run in runs)
+        loaded = sorted({name for run in runs for name in run[1]})
+        error = next((run[2] for run in runs if run[2]), "")
+        print(f"{module:<16} {seconds:7.3f} s {' '.join(loaded)} {error}")
+        if error:
+            failures.append(f"{module}: import fails ({error})")
+        elif seconds > budget_seconds:
+            failures.append(f"{module}: imports in {seconds:.3f} s (budget {budget_seconds:.3f} s)")
+        if loaded:
+            failures.append(f"{module}: imports {', '.join(loaded)}")
+    return failures
+
+
+def _max_relative_difference(values, expected) -> float:
+    """Largest |values - expected| / |expected| (inf where only one of them is NaN, 0 where both are)."""
+    values = np.asarray(values, dtype=np.float64)
+    expected = np.asarray(expected, dtype=np.float64)
+    if values.shape != expected.shape or np.any(np.isnan(values) != np.isnan(expected)):
+        return np.inf
+    defined = ~np.isnan(expected)
+    difference = np.abs(values[defined] - expected[defined]) / np.maximum(np.abs(expected[defined]), 1e-300)
+    return float(difference.max(initial=0.0))
+
+
+def check_pulses(work_dir: str) -> list:
+    """The NumPy jitter and shimmer (engine="numpy", pulses.py) vs Praat's, to within 1e-9 relative."""
+    path = os.path.join(work_dir, "pulses.wav")
+    make_synthetic_recording(path, 20.0)
+    analysis = RecordingAnalysis(path) # one point process for both engines
+    runs = {
+        "jitter": lambda engine: jitter(analysis, work_dir, engine=engine, stats=False)[0],
+        "jitter (rap) 2-9 s": lambda engine: jitter(analysis, work_dir, "rap", from_time=2.0, to_time=9.0, engine=engine, stats=False)[0],
+        "shimmer_apqN (11)": lambda engine: shimmer_apqN(analysis, work_dir, 11, engine=engine, stats=False)[0],
+        "perturbation": lambda engine: list(perturbation(analysis, work_dir, engine=engine, stats=False)[0].values()),
+        "jitter_shimmer_windows": lambda engine: np.concatenate(
+            jitter_shimmer_windows(analysis, work_dir, window_seconds=2.0, engine=engine, stats=False)[2:5]
+        ),
+    }
+    failures = []
+    for name, run in runs.items():
+        difference = _max_relative_difference(run("numpy"), run("praat"))
+        print(f"{name + ' numpy vs praat':<32} max relative difference {difference:.3g}")
+        if difference > 1e-9:
+            failures.append(f"{name}: numpy engine differs from Praat by {difference:.3g} (relative, tolerance 1e-9)")
+    return failures
+
+
+def check_stft(work_dir: str) -> list:
+    """stft_spectrogram vs Praat's To Spectrogram: same frame grid and bands, equal to float rounding."""
+    failures = []
+    for sampling_hz in (16000, 44100):
+        path = os.path.join(work_dir, f"stft_{sampling_hz}hz.wav")
+        make_synthetic_recording(path, 10.0, sampling_hz)
+        sound = RecordingAnalysis(path).sound
+        for window_length, time_step in [(0.005, 0.002), (0.025, 0.01)]:
+            praat = sound.to_spectrogram(window_length=window_length, maximum_frequency=5000.0, time_step=time_step)
+            for dtype, tolerance in [(np.float64, 1e-9), (np.float32, 1e-5)]:
+                name = f"stft {window_length} s {np.dtype(dtype).name} at {sampling_hz} Hz"
+                track = stft_spectrogram(sound, window_length, time_step, 5000.0, dtype=dtype)
+                if track.values.shape != praat.values.shape or abs(track.x1 - praat.x1) > 1e-9 or abs(track.y1 - praat.y1) > 1e-9:
+                    failures.append(f"{name}: grid {track.values.shape} from {track.x1} s vs Praat's {praat.values.shape} from {praat.x1} s")
+                    continue
+                # relative to the loudest cell: the quiet cells are float rounding of the loud ones
+                difference = np.max(np.abs(track.values - praat.values)) / np.max(praat.values)
+                print(f"{name:<32} max difference {difference:.3g} of the peak")
+                if difference > tolerance:
+                    failures.append(f"{name}: differs from Praat by {difference:.3g} of the peak (tolerance {tolerance})")
+    return failures
+
+
+def check_highpass(work_dir: str) -> list:
+    """Block-wise vs in-memory demean + high-pass filter: within one integer step for 16-bit WAVs."""
+    path = os.path.join(work_dir, "highpass.wav")
+    make_synthetic_recording(path, 150.0, block_seconds=7.0)
+    failures = []
+    for dtype in ("float64", "float32"):
+        in_memory, _ = demean_and_butterworth_highpass_filter(
+            path, os.path.join(work_dir, "in_memory.wav"), work_dir, dtype=dtype, stats=False, return_samples=True
+        )
+        blocks, _ = demean_and_butterworth_highpass_filter(
+            path, os.path.join(work_dir, "blocks.wav"), work_dir, block_seconds=60.0, dtype=dtype, stats=False, return_samples=True
+        )
+        name = f"highpass blocks {dtype}"
+        if blocks.shape != in_memory.shape:
+            failures.append(f"{name}: {blocks.shape} samples vs {in_memory.shape}")
+            continue
+        difference = np.max(np.abs(blocks - in_memory)) * 32768
+        print(f"{name:<32} max difference {difference:.3g} integer steps")
+        if difference > 1.0:
+            failures.append(f"{name}: differs from the in-memory filter by {difference:.3g} integer steps (tolerance 1)")
+    return failures
+
+
+def check_resume(work_dir: str) -> list:
+    """run_batch(..., resume=True) skips the finished features and reruns only those whose outputs are gone."""
+    paths = []
+    for k in range(3):
+        paths.append(os.path.join(work_dir, f"resume_{k}.wav"))
+        make_synthetic_recording(paths[-1], 4.0, seed=k)
+    output_directory = os.path.join(work_dir, "out")
+    features = ["pitch", "shimmer"]
+
+    def outputs():
+        return {path: os.stat(path).st_mtime_ns for path in glob.glob(os.path.join(output_directory, "*_metadata", "*"))}
+
+    failures = []
+    first = run_batch(paths, features, output_directory, jobs=1)
+    before = outputs()
+    if [r["status"] for r in first] != ["ok"] * 3:
+        failures.append(f"resume: first run {[r['status'] for r in first]}")
+    resumed = run_batch(paths, features, output_directory, jobs=1, resume=True)
+    if [r["status"] for r in resumed] != ["skipped"] * 3 or outputs() != before:
+        failures.append(f"resume: a finished batch was not skipped as a whole ({[r['status'] for r in resumed]})")
+    removed = sorted(glob.glob(os.path.join(output_directory, "shimmer_metadata", "resume_1_*")))
+    for path in removed:
+        os.remove(path)
+    resumed = {r["sound_path"]: r["status"] for r in run_batch(paths, features, output_directory, jobs=1, resume=True)}
+    after = outputs()
+    if resumed != {paths[0]: "skipped", paths[2]: "skipped", paths[1]: "ok"}:
+        failures.append(f"resume: only {paths[1]} should rerun, got {resumed}")
+    elif not removed or not all(os.path.exists(path) for path in removed):
+        failures.append("resume: the removed shimmer output was not written again")
+    elif any(after[path] != mtime for path, mtime in before.items() if path not in removed):
+        failures.append("resume: outputs of finished features were rewritten")
+    with open(os.path.join(output_directory, "batch_summary.csv"), newline="") as f:
+        summary = {row["sound_path"]: row["status"] for row in csv.DictReader(f)}
+    if summary != {path: "ok" for path in paths}:
+        failures.append(f"resume: batch_summary.csv lost the earlier rows ({summary})")
+    print(f"{'resume':<32} {'ok' if not failures else 'FAILED'}")
+    return failures
+
+
+def check_chunked(work_dir: str) -> list:
+    """Stitched chunked pitch, formant and intensity tracks vs the unchunked analyses (chunked.py)."""
+    failures = []
+    for sampling_hz, duration_seconds in [(44100, 80.37), (16000, 61.23)]:
+        path = os.path.join(work_dir, f"chunked_{sampling_hz}hz.wav")
+        make_synthetic_recording(path, duration_seconds, sampling_hz)
+        analysis = RecordingAnalysis(path)
+        sound = analysis.sound
+        for stage, params, tolerance in [
+            ("pitch", (0.01, 75.0, 500.0), 0.0),
+            ("formant", (0.01, 5, 5500.0, 0.025, 50.0), 0.0),
+            ("intensity", (75.0, 0.01, True), CHUNKED_INTENSITY_TOLERANCE_DB),
+        ]:
+            name = f"chunked {stage} at {sampling_hz} Hz"
+            track = analyse_chunked(sound, stage, params, 0.01, chunk_seconds=10.0, jobs=2)
+            if track is None:
+                failures.append(f"{name}: not chunked")
+                continue
+            unchunked = getattr(analysis, stage)(*params)
+            if stage == "pitch":
+                expected = np.vstack([unchunked.selected_array["frequency"], unchunked.selected_array["strength"]])
+            elif stage == "formant":
+                expected = np.vstack([call(unchunked, "To Matrix...", k).values[0] for k in range(1, track.values.shape[0] + 1)])
+            else:
+                expected = unchunked.values
+            if track.values.shape != expected.shape or abs(track.x1 - unchunked.x1) > 1e-9:
+                failures.append(f"{name}: {track.values.shape} frames from {track.x1} s vs {expected.shape} from {unchunked.x1} s")
+                continue
+            difference = np.max(np.abs(track.values - expected))
+            print(f"{name:<32} max difference {difference:.3g}")
+            if difference > tolerance:
+                failures.append(f"{name}: differs by {difference:.3g} (tolerance {tolerance})")
+    return failures
+
+
+# name -> function(work_dir) returning failure messages, run by --equivalence
+EQUIVALENCE_CHECKS = {
+    "pulses": check_pulses,
+    "stft": check_stft,
+    "highpass": check_highpass,
+    "chunked": check_chunked,
+    "resume": check_resume,
+}
+
+
+def check_equivalence(names: list) -> list:
+    failures = []
+    for name in names:
+        with tempfile.TemporaryDirectory() as work_dir:
+            failures += EQUIVALENCE_CHECKS[name](work_dir)
+    return failures
+
+
+def save_baseline(results: list, baseline_path: str):
+    with open(baseline_path, "w") as f:
+        json.dump(
+            {
+                "machine": {
+                    "platform": platform.platform(),
+                    "processor": platform.processor(),
+                    "cpu_count": os.cpu_count(),
+                    "python": platform.python_version(),
+                    "numpy": np.__version__,
+                    "parselmouth": parselmouth.__version__,
+                },
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "results": [{k: (None if isinstance(v, float) and np.isnan(v) else v) for k, v in r.items()} for r in results],
+            },
+            f,
+            indent=1,
+        )
+
+
+def compare_to_baseline(
+    results: list,
+    baseline_path: str,
+    time_threshold: float = 0.10, # allowed relative slowdown
+    memory_threshold: float = 0.10, # allowed relative growth of peak memory
+    min_seconds: float = 0.05, # slowdowns smaller than this are timer noise, not regressions
+) -> list:
+    """
+    Returns: list of regression messages (empty if none); (recording, stage) pairs missing from the baseline are ignored.
+    """
+    with open(baseline_path) as f:
+        baseline = {(r["recording"], r["stage"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        base = baseline.get((result["recording"], result["stage"]))
+        if base is None:
+            continue
+        name = f"{result['recording']} {result['stage']}"
+        if result["error"] and not base["error"]:
+            regressions.append(f"{name}: now fails ({result['error']})")
+            continue
+        if base["wall_seconds"] is not None and not np.isnan(result["wall_seconds"]):
+            slowdown = result["wall_seconds"] - base["wall_seconds"]
+            if slowdown > min_seconds and slowdown > time_threshold * base["wall_seconds"]:
+                regressions.append(
+                    f"{name}: {result['wall_seconds']:.3f} s vs {base['wall_seconds']:.3f} s baseline"
+                    f" (+{100 * slowdown / base['wall_seconds']:.1f}%)"
+                )
+        if base["peak_rss_mb"] is not None and not np.isnan(result["peak_rss_mb"]):
+            growth = result["peak_rss_mb"] - base["peak_rss_mb"]
+            if growth > memory_threshold * base["peak_rss_mb"]:
+                regressions.append(
+                    f"{name}: peak {result['peak_rss_mb']:.1f} MB vs {base['peak_rss_mb']:.1f} MB baseline"
+                    f" (+{100 * growth / base['peak_rss_mb']:.1f}%)"
+                )
+    return regressions
+
+
+def write_results_csv(results: list, output_path: str):
+    with open(output_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every feature extractor and the preprocessing.")
+    parser.add_argument("--raw-audio", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "raw_audio"),
+                        help="directory of sample recordings (its *.wav files are benchmarked)")
+    parser.add_argument("--lengths", type=float, nargs="*", default=DEFAULT_LENGTHS_SECONDS,
+                        help="lengths in seconds of the synthetic recordings (default: 1 min, 30 min, 3 h)")
+    parser.add_argument("--synthetic-dir", default=os.path.join(tempfile.gettempdir(), "speech_benchmark_audio"),
+                        help="where the synthetic recordings are generated (and reused from)")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=1, help="runs per stage; the fastest is reported")
+    parser.add_argument("--output", default="", help="write the results to this csv file")
+    parser.add_argument("--save-baseline", default="", help="save the results as a baseline json file")
+    parser.add_argument("--baseline", default="", help="compare against this baseline json file")
+    parser.add_argument("--time-threshold", type=float, default=0.10)
+    parser.add_argument("--memory-threshold", type=float, default=0.10)
+    parser.add_argument("--min-seconds", type=float, default=0.05)
+    parser.add_argument("--imports", action="store_true", help="only check the import time of the library modules")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_SECONDS, help="seconds per module")
+    parser.add_argument("--equivalence", nargs="*", choices=list(EQUIVALENCE_CHECKS),
+                        help="only run these equivalence checks (all if none are named)")
+    args = parser.parse_args()
+
+    if args.imports:
+        failures = check_imports(IMPORT_MODULES, args.import_budget, args.repeat)
+        for failure in failures:
+            print(f"REGRESSION {failure}")
+        if failures:
+            sys.exit(1)
+        print("imports within budget")
+        return
+
+    if args.equivalence is not None:
+        failures = check_equivalence(args.equivalence or list(EQUIVALENCE_CHECKS))
+        for failure in failures:
+            print(f"MISMATCH {failure}")
+        if failures:
+            sys.exit(1)
+        print("all equivalent")
+        return
+
+    sound_paths = find_recordings(args.raw_audio, "*.wav") if args.raw_audio else []
+    sound_paths += synthetic_recordings(args.synthetic_dir, args.lengths)
+
+    results = run_benchmarks(sound_paths, args.stages, args.repeat)
+    if args.output:
+        write_results_csv(results, args.output)
+    if args.save_baseline:
+        save_baseline(results, args.save_baseline)
+    if args.baseline:
+        regressions = compare_to_baseline(
+            results, args.baseline, args.time_threshold, args.memory_threshold, args.min_seconds
+        )
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("no regressions")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import parselmouth
+import numpy as np
+import functools
+import hashlib
+import inspect
+import pickle
+import shutil
+import glob
+import os
+from analysis import as_analysis
+from tracing import span
+
+
+# Content-addressed, size-bounded cache of feature results and of the Praat analyses they are built from.
+#
+# Entries are keyed on the content hash of the input recording plus the stage name and its exact parameters,
+# so re-running a batch reuses everything whose inputs did not change, and changing one parameter (e.g.
+# max_formant_hz) recomputes only the stages that take it (the Formant track and the features using it),
+# while the Pitch, Spectrogram, ... entries are reused. The least recently used entries are evicted once the
+# cache grows beyond max_bytes.
+#
+# Usage: RecordingAnalysis(sound_path, cache=FeatureCache("/scratch/feature_cache")), or run_batch(..., cache_dir=...).
+
+
+def _key_value(value):
+    """value with its NumPy arrays replaced by their dtype, shape and a hash of their bytes (repr elides long arrays)."""
+    if isinstance(value, np.ndarray):
+        return ("ndarray", value.dtype.str, value.shape, hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest())
+    if isinstance(value, (tuple, list)):
+        return type(value)(_key_value(v) for v in value)
+    if isinstance(value, dict):
+        return {k: _key_value(v) for k, v in value.items()}
+    return value
+
+
+class FeatureCache:
+    def __init__(self, cache_dir: str, max_bytes: int = 20 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(cache_dir, "entries"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "hashes"), exist_ok=True)
+
+    def file_hash(self, sound_path: str) -> str:
+        """
+        sha256 of the file contents. Remembered per (path, mtime, size) so unchanged files are not read again.
+        """
+        st = os.stat(sound_path)
+        path_key = hashlib.sha256(os.path.abspath(sound_path).encode()).hexdigest()
+        stamp = f"{st.st_mtime_ns} {st.st_size}"
+        hash_path = os.path.join(self.cache_dir, "hashes", path_key)
+        if os.path.exists(hash_path):
+            with open(hash_path) as f:
+                saved_stamp, _, content_hash = f.read().rpartition(" ")
+            if saved_stamp == stamp:
+                return content_hash
+
+        h = hashlib.sha256()
+        with open(sound_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        content_hash = h.hexdigest()
+        self._write_atomic(hash_path, f"{stamp} {content_hash}".encode())
+        return content_hash
+
+    def key(self, content_hash: str, stage: str, params: tuple) -> str:
+        return hashlib.sha256(repr((content_hash, stage, _key_value(params))).encode()).hexdigest()
+
+    def _entry_path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, "entries", key[:2], key + suffix)
+
+    def _write_atomic(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path) # concurrent workers never see a half-written entry
+
+    def _touch(self, path: str):
+        try:
+            os.utime(path) # mtime = last use, for LRU eviction
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str):
+        """Cached Python value (pickled) for key, or None."""
+        path = self._entry_path(key, ".pkl")
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        self._touch(path)
+        return value
+
+    def put(self, key: str, value):
+        self._write_atomic(self._entry_path(key, ".pkl"), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        self.evict()
+
+    def get_praat(self, key: str):
+        """Cached Praat object (Pitch, Formant, ...) for key, or None."""
+        path = self._entry_path(key, ".praat")
+        if not os.path.exists(path):
+            return None
+        try:
+            obj = parselmouth.read(path)
+        except parselmouth.PraatError:
+            return None
+        self._touch(path)
+        return obj
+
+    def put_praat(self, key: str, obj):
+        path = self._entry_path(key, ".praat")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        obj.save(tmp_path, parselmouth.Data.FileFormat.BINARY)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache is at most max_bytes."""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "entries", "*", "*")):
+            if path.endswith(".tmp"):
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue # evicted by another worker
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def _stats_output_path(csv_folder_name: str, wav_base: str, func_name: str, output_format: str) -> str:
+    if output_format == "npy":
+        return os.path.join(csv_folder_name, f"{wav_base}_{func_name}")
+    return os.path.join(csv_folder_name, f"{wav_base}_{func_name}.csv")
+
+
+def _read_stats_output(path: str) -> dict:
+    """relative file name -> bytes of a stats csv file, or of every file in an npy store folder."""
+    if os.path.isdir(path):
+        files = {}
+        for name in sorted(os.listdir(path)):
+            with open(os.path.join(path, name), "rb") as f:
+                files[name] = f.read()
+        return files
+    with open(path, "rb") as f:
+        return {"": f.read()}
+
+
+def _restore_stats_output(path: str, files: dict):
+    if "" in files:
+        with open(path, "xb") as f:
+            f.write(files[""])
+        return
+    os.makedirs(path, exist_ok=False)
+    for name, data in files.items():
+        with open(os.path.join(path, name), "xb") as f:
+            f.write(data)
+
+
+def _remove_stats_output(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+# arguments of the feature functions that do not change the returned values
+_NON_RESULT_ARGS = ("sound_path", "csv_folder_name", "stats", "sample_rate_hz", "output_format")
+
+
+def _call_cached(func, bound, analysis):
+    """Runs func with the bound arguments, going through analysis.cache (if any); see cached_feature."""
+    cache = analysis.cache
+    if cache is None:
+        return func(*bound.args, **bound.kwargs)
+
+    params = tuple((name, value) for name, value in bound.arguments.items() if name not in _NON_RESULT_ARGS)
+    stats = bound.arguments["stats"]
+    output_format = bound.arguments.get("output_format", "csv")
+    params += (
+        ("output_format", output_format),
+        ("spectrogram_engine", analysis.spectrogram_engine),
+        ("chunk_seconds", analysis.chunk_seconds), # chunked tracks are close to, not equal to, unchunked ones
+    )
+    key = cache.key(analysis.analysis_hash, func.__name__, params)
+    stats_path = _stats_output_path(bound.arguments["csv_folder_name"], analysis.wav_base, func.__name__, output_format)
+
+    with span(func.__name__, "cache"):
+        entry = cache.get(key)
+    if entry is not None:
+        result, files = entry
+        if not stats or os.path.exists(stats_path):
+            return result
+        if files:
+            _restore_stats_output(stats_path, files)
+            return result
+        # cached without stats output (stats=False): recompute to write it
+
+    if stats and os.path.exists(stats_path):
+        _remove_stats_output(stats_path) # stale: written with other parameters, or its entry was evicted
+    result = func(*bound.args, **bound.kwargs)
+    files = _read_stats_output(stats_path) if stats and os.path.exists(stats_path) else {}
+    with span(func.__name__, "cache"):
+        cache.put(key, (result, files))
+    return result
+
+
+def cached_feature(func):
+    """
+    Decorator for the feature functions (pitches, alpha_ratio, ...). When the recording's RecordingAnalysis
+    has a cache, the return value and the stats output the function wrote are stored under the recording's
+    content hash plus every argument that affects the result. On a hit the stored value is returned without
+    recomputing, and the stats output is restored byte for byte if it is missing (or left alone if present).
+    On a miss, stats output already at the path (from a call with other parameters, or whose entry was
+    evicted) is replaced instead of failing on the "x" mode of the csv files.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        analysis = as_analysis(bound.arguments["sound_path"], bound.arguments.get("sample_rate_hz", 0.0))
+        bound.arguments["sound_path"] = analysis
+        with span(func.__name__, "feature", sound_path=analysis.file_name):
+            return _call_cached(func, bound, analysis)
+
+    return wrapper
@@ -0,0 +1,290 @@
+import multiprocessing
+import warnings
+import math
+import parselmouth
+import numpy as np
+from parselmouth.praat import call
+import os
+
+
+# Chunked, multi-core Praat analyses of one long recording.
+#
+# Praat's pitch tracker, Burg formants and intensity run single-threaded over the whole signal, so one
+# 3-hour session becomes the tail of every batch. analyse_chunked splits the recording into chunks
+# (cut at the quietest point near every chunk_seconds), pads each chunk with margin_seconds of its neighbours
+# on both sides, analyses the chunks on a process pool and keeps from each chunk only the frames of its own
+# core, giving one continuous track without duplicated frames.
+#
+# Chunks start at a multiple of the time step (in samples) and their length is congruent to the recording's
+# length modulo the time step, so Praat's centred frame grid of every chunk is exactly the grid of the whole
+# recording. Each pitch chunk also gets one sample at the recording's absolute peak in its margin, since
+# Praat's voicing/silence decisions are relative to the global peak. Burg formants resample the sound to
+# twice the maximum formant, and resampling is not local, so the whole recording is resampled once and the
+# resampled signal is split. When the length minus the analysis window is a whole number of time steps,
+# floating point rounding decides between two grids half a step apart, so the grids of the whole recording
+# and of every chunk are computed the way Praat computes them (_frame_grid) and chunks that would land on
+# the other grid are lengthened by a few time steps.
+#
+# How close the stitched tracks are to the unchunked ones (checked by python benchmark.py --equivalence):
+#   pitch      equal
+#   formant    equal
+#   intensity  within CHUNKED_INTENSITY_TOLERANCE_DB: its windows are centred exactly on a sample and can
+#              start one sample apart from the unchunked ones
+# Spectrograms are not chunked: their window edges fall between samples whenever window_length times the
+# sampling rate is not whole, and rounding a chunk's frame times then moves windows by one sample (relative
+# differences above 1e-3 in many cells). Use spectrogram_engine="numpy" (stft.py) for fast spectrograms.
+#
+# A recording that cannot be split this way (shorter than two chunks, a time step that is not a whole number
+# of samples, e.g. 0.01 s at 22050 Hz, or no chunking on the recording's frame grid) is analysed unchunked,
+# with a warning.
+#
+# The stitched tracks (Track, PitchTrack, FormantTrack) provide the parts of the Praat Sampled interface the
+# feature functions use (values, xs(), ys(), x1, dx, nx, xmin, xmax, selected_array for pitch).
+# Usage: RecordingAnalysis(sound_path, chunk_seconds=300, jobs=8), or run_batch(..., chunk_seconds=300).
+
+
+class Track:
+    """A frame track stitched from chunk analyses; values has one column per frame."""
+
+    def __init__(self, values: np.ndarray, x1: float, dx: float, xmin: float, xmax: float, y1: float = 0.0, dy: float = 1.0):
+        self.values = values
+        self.x1 = x1
+        self.dx = dx
+        self.nx = values.shape[-1]
+        self.xmin = xmin
+        self.xmax = xmax
+        self.y1 = y1
+        self.dy = dy
+
+    def xs(self) -> np.ndarray:
+        return self.x1 + self.dx * np.arange(self.nx)
+
+    def ys(self) -> np.ndarray:
+        return self.y1 + self.dy * np.arange(self.values.shape[0])
+
+    def x_grid(self) -> np.ndarray:
+        """Frame edges, for plotting (as Praat's x_grid)."""
+        return self.x1 - 0.5 * self.dx + self.dx * np.arange(self.nx + 1)
+
+    def y_grid(self) -> np.ndarray:
+        return self.y1 - 0.5 * self.dy + self.dy * np.arange(self.values.shape[0] + 1)
+
+
+class PitchTrack(Track):
+    """values rows: frequency (Hz, 0 where unvoiced), strength."""
+
+    @property
+    def selected_array(self) -> np.ndarray:
+        selected = np.empty(self.nx, dtype=[("frequency", "<f8"), ("strength", "<f8")])
+        selected["frequency"] = self.values[0]
+        selected["strength"] = self.values[1]
+        return selected
+
+
+class FormantTrack(Track):
+    """values rows: frequency (Hz, 0 where undefined) of formant 1, 2, ..."""
+
+    def frequencies(self, formant_number: int) -> np.ndarray:
+        return self.values[formant_number - 1]
+
+
+_TRACK_TYPES = {"pitch": PitchTrack, "formant": FormantTrack, "intensity": Track}
+
+CHUNKED_INTENSITY_TOLERANCE_DB = 0.2
+
+
+def chunk_bounds(
+    samples: np.ndarray,
+    sampling_hz: float,
+    time_step: float,
+    chunk_seconds: float,
+    margin_seconds: float,
+    search_seconds: float = 10.0,
+) -> np.ndarray:
+    """
+    Returns: np.ndarray (n_chunks x 4) of sample indices: start, core start, core end, stop of every chunk,
+    or None if the time step is not a whole number of samples or the recording is too short to split.
+    """
+    q = time_step * sampling_hz
+    if abs(q - round(q)) > 1e-6:
+        return None
+    q = int(round(q))
+    n = samples.shape[-1]
+    chunk = max(1, int(round(chunk_seconds * sampling_hz / q))) * q
+    margin = int(np.ceil(margin_seconds * sampling_hz / q)) * q
+    if n < 2 * chunk:
+        return None
+
+    # cut at the quietest 0.3 s near each nominal boundary
+    x = samples if samples.ndim == 1 else samples.mean(axis=0)
+    n_frames = n // q
+    frame_energy = np.sum(x[: n_frames * q].reshape(n_frames, q) ** 2, axis=1)
+    smooth = max(1, int(round(0.3 * sampling_hz / q)))
+    cum = np.concatenate([[0.0], np.cumsum(frame_energy)])
+    window_energy = cum[smooth:] - cum[:-smooth] # energy of frames j .. j + smooth
+    search = max(1, int(round(min(search_seconds, chunk_seconds / 4) * sampling_hz / q)))
+    cores = [0]
+    for nominal in range(chunk // q, (n - chunk // 2) // q, chunk // q):
+        lo = max(cores[-1] // q + 1, nominal - search)
+        hi = min(window_energy.size, nominal + search)
+        if lo >= hi:
+            continue
+        cores.append((lo + int(np.argmin(window_energy[lo:hi])) + smooth // 2) * q)
+    cores.append(n)
+
+    bounds = []
+    for core_start, core_end in zip(cores[:-1], cores[1:]):
+        start = max(0, core_start - margin)
+        length = core_end + margin - start
+        length += (n - length) % q # same length modulo the time step as the recording: same frame grid
+        bounds.append((start, core_start, core_end, min(n, start + length)))
+    return np.array(bounds, dtype=np.int64)
+
+
+def _frame_grid(stage: str, params: tuple, time_step: float, xmin: float, xmax: float, x1: float, dx: float, nx: int):
+    """
+    Number of frames and first frame time of the Praat analysis of a sound with this time domain and sampling,
+    computed as Praat computes them (same floating point operations).
+    """
+    if stage == "pitch":
+        window = 3.0 / params[1] # 3 periods of the pitch floor (autocorrelation method)
+    elif stage == "intensity":
+        window = 6.4 / params[0]
+    else:
+        window = 2.0 * params[3 if stage == "formant" else 0] # Gaussian windows are twice the effective length
+    if stage == "formant":
+        # Burg formants run on the sound resampled to twice the maximum formant
+        resampled_hz = 2.0 * params[2]
+        duration = round((xmax - xmin) * resampled_hz) * (1.0 / resampled_hz)
+    else:
+        duration = dx * nx
+    n_frames = math.floor((duration - window) / time_step) + 1
+    if stage in ("pitch", "intensity"):
+        mid = x1 - 0.5 * dx + 0.5 * duration
+        first_time = mid - 0.5 * (n_frames * time_step) + 0.5 * time_step
+    elif stage == "spectrogram": # not chunked, but stft.py lays out its frames on this grid
+        first_time = x1 + 0.5 * ((nx - 1) * dx - (n_frames - 1) * time_step)
+    else:
+        first_time = 0.5 * (xmin + xmax) - (n_frames - 1) * time_step / 2
+    return n_frames, first_time
+
+
+def _analyse_chunk(args):
+    """Worker: runs one Praat analysis on one chunk and returns its frames."""
+    from analysis import RecordingAnalysis
+
+    stage, params, values, sampling_hz, start_time, peak_at = args
+    if peak_at is not None:
+        index, value = peak_at
+        values = values.copy()
+        values[:, index] = value
+    sound = parselmouth.Sound(values, sampling_frequency=sampling_hz, start_time=start_time)
+    analysis = RecordingAnalysis("chunk", sound)
+    if stage == "pitch":
+        obj = analysis.pitch(*params)
+        selected = obj.selected_array
+        frames = np.vstack([selected["frequency"], selected["strength"]])
+    elif stage == "formant":
+        obj = analysis.formant(*params)
+        n_formants = int(np.ceil(params[1]))
+        frames = np.vstack([call(obj, "To Matrix...", k).values[0] for k in range(1, n_formants + 1)])
+    else:
+        obj = analysis.intensity(*params)
+        frames = obj.values
+    return obj.x1, obj.dx, frames
+
+
+def _unchunked(stage: str, reason: str):
+    warnings.warn(f"{stage} analysed unchunked: {reason}", stacklevel=3)
+    return None
+
+
+def analyse_chunked(
+    sound: parselmouth.Sound,
+    stage: str,
+    params: tuple,
+    time_step: float,
+    chunk_seconds: float = 300.0,
+    margin_seconds: float = 2.0,
+    jobs: int = os.cpu_count(),
+):
+    """
+    Runs RecordingAnalysis.<stage>(*params) (stage: pitch, formant or intensity) on the chunks of sound in
+    parallel and stitches the frames.
+
+    Returns: a PitchTrack, FormantTrack or Track, or None (with a warning) if the sound cannot be chunked;
+    then run the analysis unchunked.
+    """
+    if stage == "formant":
+        # Burg resamples to twice the maximum formant; resampling the chunks separately changes the frames
+        resampled_hz = 2.0 * params[2]
+        if abs(sound.sampling_frequency - resampled_hz) > 1e-6:
+            sound = call(sound, "Resample...", resampled_hz, 50)
+    values = sound.values
+    sampling_hz = sound.sampling_frequency
+    q = time_step * sampling_hz
+    if abs(q - round(q)) > 1e-6:
+        return _unchunked(stage, f"the time step {time_step} s is not a whole number of samples at {sampling_hz:g} Hz")
+    bounds = chunk_bounds(values, sampling_hz, time_step, chunk_seconds, margin_seconds)
+    if bounds is None:
+        return _unchunked(stage, f"shorter than two chunks of {chunk_seconds} s")
+
+    # When (length - window) is a whole number of time steps, floating point rounding puts Praat's grid on
+    # one of two grids half a step apart. Lengthen the chunks whose grid would not be that of the whole
+    # recording by a few time steps until it is.
+    n = values.shape[-1]
+    n_frames, x1 = _frame_grid(stage, params, time_step, sound.xmin, sound.xmax, sound.x1, sound.dx, sound.nx)
+    q = int(round(q))
+
+    def aligned(first_time):
+        steps = (first_time - x1) / time_step
+        return abs(steps - round(steps)) < 1e-6
+
+    def chunk_grid(start, stop):
+        # the time domain of parselmouth.Sound(values[:, start:stop], sampling_hz, start_time)
+        xmin = sound.xmin + start / sampling_hz
+        xmax = xmin + (stop - start) / sampling_hz
+        return _frame_grid(stage, params, time_step, xmin, xmax, xmin + 0.5 / sampling_hz, 1.0 / sampling_hz, stop - start)
+
+    for bound in bounds:
+        start, _, _, stop = bound
+        for k in range(16):
+            candidates = [(start, stop + k * q)] if stop + k * q <= n else []
+            candidates += [(start - k * q, stop)] if start - k * q >= 0 else []
+            aligned_bounds = [c for c in candidates if aligned(chunk_grid(*c)[1])]
+            if aligned_bounds:
+                bound[[0, 3]] = aligned_bounds[0]
+                break
+        else:
+            return _unchunked(stage, "no chunking on the frame grid of the recording")
+
+    peak_index = int(np.argmax(np.max(np.abs(values), axis=0)))
+
+    def task(start, stop):
+        peak_at = None
+        if stage == "pitch" and not start <= peak_index < stop:
+            # the pitch tracker's thresholds are relative to the global peak: put it in a margin
+            peak_at = (0 if start > 0 else stop - start - 1, values[:, peak_index])
+        return stage, params, values[:, start:stop], sampling_hz, sound.xmin + start / sampling_hz, peak_at
+
+    with multiprocessing.Pool(max(1, min(jobs, bounds.shape[0]))) as pool:
+        results = pool.map(_analyse_chunk, [task(start, stop) for start, _, _, stop in bounds])
+    if not all(aligned(result[0]) for result in results):
+        return _unchunked(stage, "the chunks are not on the frame grid of the recording")
+
+    # every chunk is on the same frame grid: keep the frames centred in each chunk's core
+    kept = []
+    for (start, core_start, core_end, stop), (chunk_x1, dx, frames) in zip(bounds, results):
+        times = chunk_x1 + dx * np.arange(frames.shape[-1])
+        eps = 1e-6 * dx
+        keep = np.ones(times.size, dtype=bool)
+        if core_start > 0:
+            keep &= times >= sound.xmin + core_start / sampling_hz - eps
+        if core_end < n:
+            keep &= times < sound.xmin + core_end / sampling_hz - eps
+        kept.append(frames[:, keep])
+    stitched = np.concatenate(kept, axis=1)
+    if stitched.shape[1] != n_frames:
+        return _unchunked(stage, f"{stitched.shape[1]} frames stitched instead of {n_frames}")
+
+    return _TRACK_TYPES[stage](stitched, x1, results[0][1], sound.xmin, sound.xmax)
@@ -1,8 +1,37 @@
+import multiprocessing
 import parselmouth
+import numpy as np
 from parselmouth.praat import call
+import argparse
+import hashlib
 import time
 import os
 import csv
+import re
+from cache import FeatureCache
+from pcm_cache import load_sound, read_pcm, praat_sample_values
+from preprocessing import _open_wav_blocks, _close_wav_blocks
+from tracing import span
+
+
+# Batch denoising of many recordings with one noise profile per device/session group.
+#
+# At-home sessions recorded on the same device in the same room share a noise floor, so the noise is estimated
+# once per group (recording_group: a regex on the file name, or the recording's folder) instead of once per
+# file: from a supplied interval of the group's first recording, or automatically from the quietest
+# noise_seconds of its first search_recordings recordings (find_noise_interval; digital silence is skipped).
+# The profile (the noise-only samples) is kept in a FeatureCache keyed on the content of the recordings it was
+# taken from, so re-runs reuse it (as do runs over later sessions of the group: its first recordings stay the same).
+#
+# denoise_with_profile applies a profile with Praat's "Remove noise..." (as denoise_sound_praat_remove_noise)
+# on the noise excerpt followed by the recording, so every recording of the group has the same noise spectrum
+# subtracted. Long recordings are denoised in chunks of chunk_seconds overlapping by overlap_seconds on both
+# sides, cross-faded over the overlaps and written to the output WAV block by block, so memory does not depend
+# on the recording length. (Praat's result depends slightly on where a chunk starts, about 70 dB below the
+# peak, so the overlaps are faded rather than cut.) denoise_batch runs the groups' profiles and then the
+# recordings on a process pool:
+#     python denoising.py /data/PR05/home --output-dir /userdata/msharma --group-pattern "(sub-[^_]+_stage-[^_]+)"
+
 
 def denoise_sound_praat_remove_noise(
     sound_path: str,
@@ -24,7 +53,7 @@ def denoise_sound_praat_remove_noise(
     - Smoothing hz is applied to the NOISE SPECTRUM ESTIMATE, NOT THE ENTIRE SPEECH SIGNAL.
     """
     
-    sound = parselmouth.Sound(sound_path)
+    sound = load_sound(sound_path)
     
     sampling_hz = sound.sampling_frequency
     
@@ -42,17 +71,409 @@ def denoise_sound_praat_remove_noise(
     return denoised, sampling_hz
 
 
-snd = "raw_audio/testsoundmono.mp3"
+def recording_group(sound_path: str, group_pattern: str = "") -> str:
+    """
+    Device/session group of a recording: the first group (or the whole match) of the regex group_pattern in
+    its file name, or its folder if group_pattern is empty or does not match.
+    """
+    if group_pattern:
+        match = re.search(group_pattern, os.path.basename(sound_path))
+        if match:
+            return match.group(1) if match.groups() else match.group(0)
+    return os.path.dirname(os.path.abspath(sound_path))
+
+
+def _channels(data: np.ndarray) -> np.ndarray:
+    """Samples as read by read_pcm, as Praat values of shape (n_channels, n_samples)."""
+    values = praat_sample_values(data)
+    return values.T if values.ndim == 2 else values[None, :]
+
+
+def find_noise_interval(
+    sound_path: str,
+    noise_seconds: float = 0.5,
+    time_step: float = 0.01,
+    block_seconds: float = 600.0, # the frame energies are computed block by block of this length
+):
+    """
+    The quietest noise_seconds of a recording (lowest mean energy over all channels). Windows touching
+    digital silence (frames of exact zeros, e.g. padding) are skipped: they hold no noise to estimate.
+
+    Returns: start (s), end (s), level (dB re full scale)
+    """
+    sampling_hz, data = read_pcm(sound_path, mmap=True)
+    hop = max(1, int(round(time_step * sampling_hz)))
+    n_frames = data.shape[0] // hop
+    width = max(1, int(round(noise_seconds / time_step)))
+    if n_frames < width:
+        raise ValueError(f"recording is shorter than noise_seconds ({noise_seconds} s)")
+
+    frame_energy = np.empty(n_frames)
+    block_frames = max(1, int(block_seconds / time_step))
+    with span("noise_interval", "numpy", sound_path=os.path.basename(sound_path)):
+        for start in range(0, n_frames, block_frames):
+            stop = min(n_frames, start + block_frames)
+            x = _channels(data[start * hop:stop * hop])
+            frame_energy[start:stop] = np.mean(x.reshape(x.shape[0], stop - start, hop) ** 2, axis=(0, 2))
+        cum = np.concatenate([[0.0], np.cumsum(frame_energy)])
+        window_energy = (cum[width:] - cum[:-width]) / width
+        silent = np.concatenate([[0], np.cumsum(frame_energy == 0)])
+        window_energy[silent[width:] - silent[:-width] > 0] = np.inf
+    if not np.isfinite(window_energy).any():
+        raise ValueError("no noise interval without digital silence")
+    i = int(np.argmin(window_energy))
+    return i * hop / sampling_hz, (i + width) * hop / sampling_hz, float(10 * np.log10(window_energy[i]))
+
+
+class NoiseProfile:
+    """Noise-only samples (n_channels x n_samples, Praat values) of a device/session group and where they come from."""
+
+    def __init__(self, samples: np.ndarray, sampling_hz: float, source_path: str, start_seconds: float, end_seconds: float, level_db: float):
+        self.samples = samples
+        self.sampling_hz = sampling_hz
+        self.source_path = source_path
+        self.start_seconds = start_seconds
+        self.end_seconds = end_seconds
+        self.level_db = level_db
+
+
+def noise_profile(
+    sound_paths: list,
+    noise_interval: tuple = None, # (start s, end s) of a noise-only part of sound_paths[0]; None finds one
+    noise_seconds: float = 0.5,
+    search_recordings: int = 3, # recordings searched for the quietest interval
+    time_step: float = 0.01,
+    cache: FeatureCache = None,
+) -> NoiseProfile:
+    """The noise profile of a group of recordings (see the top of this file), from cache if it was computed before."""
+    sources = sound_paths[:1] if noise_interval is not None else sound_paths[:max(1, search_recordings)]
+    if cache is not None:
+        content_hash = hashlib.sha256(" ".join(cache.file_hash(p) for p in sources).encode()).hexdigest()
+        key = cache.key(content_hash, "noise_profile", (noise_interval, noise_seconds, time_step))
+        cached = cache.get(key)
+        if cached is not None:
+            return NoiseProfile(*cached)
+
+    if noise_interval is not None:
+        source_path, (start_seconds, end_seconds) = sources[0], noise_interval
+        level_db = None
+    else:
+        candidates, errors = [], []
+        for sound_path in sources:
+            try:
+                candidates.append((sound_path, *find_noise_interval(sound_path, noise_seconds, time_step)))
+            except (ValueError, parselmouth.PraatError) as e:
+                errors.append(e) # e.g. unreadable or all digital silence: search the others
+        if not candidates:
+            raise errors[0]
+        source_path, start_seconds, end_seconds, level_db = min(candidates, key=lambda c: c[3])
+    sampling_hz, data = read_pcm(source_path, mmap=True)
+    start, end = int(round(start_seconds * sampling_hz)), min(data.shape[0], int(round(end_seconds * sampling_hz)))
+    if end <= start:
+        raise ValueError(f"empty noise interval {start_seconds}-{end_seconds} s")
+    samples = _channels(data[start:end])
+    if level_db is None:
+        level_db = float(10 * np.log10(np.mean(samples**2) + 1e-20))
+    profile = NoiseProfile(samples, sampling_hz, source_path, start_seconds, end_seconds, level_db)
+    if cache is not None:
+        cache.put(key, (samples, sampling_hz, source_path, start_seconds, end_seconds, level_db)) # no class: also read by python denoising.py
+    return profile
+
+
+def _remove_noise(noise: np.ndarray, x: np.ndarray, sampling_hz: float, remove_noise_args: tuple) -> np.ndarray:
+    """
+    "Remove noise..." on every channel of x (n_channels x n_samples) with the noise spectrum of noise (one row
+    per channel). Praat mixes the channels of a multi-channel Sound, so each channel is denoised on its own.
+    """
+    # silence between the noise, x and the end: Praat's band filter runs over the whole Sound and wraps around
+    padding = np.zeros(int(round(0.1 * sampling_hz)))
+    offset = noise.shape[1] + padding.size
+    y = np.empty_like(x)
+    for channel in range(x.shape[0]):
+        sound = parselmouth.Sound(
+            np.concatenate([noise[channel], padding, x[channel], padding]), sampling_frequency=sampling_hz
+        )
+        denoised = call(sound, "Remove noise...", 0.0, noise.shape[1] / sampling_hz, *remove_noise_args)
+        y[channel] = denoised.values[0, offset:offset + x.shape[1]]
+    # Praat (6.1) now and then returns one window of NaNs: keep the input samples there
+    return np.where(np.isnan(y), x, y)
+
+
+def denoise_with_profile(
+    sound_path: str,
+    output_path: str,
+    profile: NoiseProfile,
+    csv_folder_name: str,
+    window_length_s: float = 0.025,
+    filter_low_hz: float = 0.0,
+    filter_high_hz: float = 20000.0,
+    smoothing_hz: float = 40.0,
+    method: str = "spectral-subtraction",
+    chunk_seconds: float = 60.0,
+    overlap_seconds: float = 0.5, # on both sides of every chunk boundary, cross-faded
+    stats: bool = True,
+):
+    """
+    Denoise a recording with the noise spectrum of profile (see denoise_sound_praat_remove_noise for the
+    parameters) and write it to output_path: integer WAVs keep their sample format, the rest is written as float32.
+    The recording is read and denoised chunk by chunk, so peak memory is a few copies of one chunk.
+
+    Returns: sampling_hz
+    """
+    if(stats):
+        start_time = time.perf_counter()
+        wav_base = os.path.splitext(os.path.basename(sound_path))[0]
+        func_name = denoise_with_profile.__name__
+        stats_csv_file_name = f"{csv_folder_name}/{wav_base}_{func_name}.csv"
+        if os.path.exists(stats_csv_file_name):
+            raise FileExistsError(f"{stats_csv_file_name} exists") # before the denoising, not after it
+
+    sampling_hz, data = read_pcm(sound_path, mmap=True)
+    if sampling_hz != profile.sampling_hz:
+        raise ValueError(f"sampling rate {sampling_hz} Hz differs from the noise profile's {profile.sampling_hz} Hz")
+    n_samples = data.shape[0]
+    n_channels = 1 if data.ndim == 1 else data.shape[1]
+    noise = profile.samples
+    if noise.shape[0] != n_channels:
+        noise = np.repeat(noise.mean(axis=0, keepdims=True), n_channels, axis=0)
+    chunk = max(1, int(round(chunk_seconds * sampling_hz)))
+    overlap = int(round(overlap_seconds * sampling_hz))
+    if chunk <= 2 * overlap:
+        raise ValueError("chunk_seconds must be more than twice overlap_seconds")
+    fade_in = (np.arange(2 * overlap) + 0.5) / (2 * overlap)
+    remove_noise_args = (window_length_s, filter_low_hz, filter_high_hz, smoothing_hz, method)
+
+    is_int = np.issubdtype(data.dtype, np.integer) and data.dtype != np.uint8
+    out_dtype = data.dtype if is_int else np.dtype(np.float32)
+    f = _open_wav_blocks(output_path, sampling_hz, n_channels, out_dtype)
+    data_bytes = 0
+    try:
+        tail = None # the previous chunk's denoised samples over the overlap with this one
+        for core_start in range(0, n_samples, chunk):
+            core_end = min(n_samples, core_start + chunk)
+            lo, hi = max(0, core_start - overlap), min(n_samples, core_end + overlap)
+            with span("remove_noise", "praat", seconds=(hi - lo) / sampling_hz):
+                y = _remove_noise(noise, _channels(data[lo:hi]), sampling_hz, remove_noise_args)
+            if tail is not None:
+                k = tail.shape[1]
+                y[:, :k] = tail * (1 - fade_in[:k]) + y[:, :k] * fade_in[:k]
+            keep = core_end - overlap - lo if core_end < n_samples else y.shape[1]
+            tail = y[:, keep:]
+
+            y = y[:, :keep].T
+            if is_int:
+                info = np.iinfo(out_dtype)
+                y = np.clip(np.rint(y * -float(info.min)), info.min, info.max)
+            out_bytes = y.astype(out_dtype.newbyteorder("<")).tobytes()
+            f.write(out_bytes)
+            data_bytes += len(out_bytes)
+    finally:
+        _close_wav_blocks(f, data_bytes)
+
+    if not stats:
+        return sampling_hz
+    # Timing:
+    elapsed_sec = time.perf_counter() - start_time
+    with span("stats_csv", "io"), open(stats_csv_file_name, "x", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([
+            "sound_path",
+            "output_path",
+            "sample_rate_hz",
+            "noise_source",
+            "noise_start_seconds",
+            "noise_end_seconds",
+            "noise_level_db",
+            "window_length_s",
+            "filter_low_hz",
+            "filter_high_hz",
+            "smoothing_hz",
+            "method",
+            "chunk_seconds",
+            "overlap_seconds",
+            "elapsed_seconds",
+        ])
+        writer.writerow([
+            os.path.basename(sound_path),
+            os.path.basename(output_path),
+            sampling_hz,
+            os.path.basename(profile.source_path),
+            f"{profile.start_seconds:.6f}",
+            f"{profile.end_seconds:.6f}",
+            f"{profile.level_db:.3f}",
+            window_length_s,
+            filter_low_hz,
+            filter_high_hz,
+            smoothing_hz,
+            method,
+            chunk_seconds,
+            overlap_seconds,
+            f"{elapsed_sec:.6f}",
+        ])
+    return sampling_hz
+
+
+def _profile_task(args):
+    """Worker: the noise profile of one group. Returns group, profile (None on error), error ("" if none)."""
+    group, sound_paths, profile_kwargs, cache_dir, cache_max_bytes = args
+    try:
+        cache = FeatureCache(cache_dir, cache_max_bytes) if cache_dir else None
+        return group, noise_profile(sound_paths, cache=cache, **profile_kwargs), ""
+    except Exception as e:
+        return group, None, f"{type(e).__name__}: {' '.join(str(e).split())}"
+
+
+def _denoise_task(args):
+    """Worker: denoises one recording. Returns sound_path, error ("" if none), elapsed seconds."""
+    sound_path, output_path, profile, csv_folder_name, denoise_kwargs = args
+    start = time.perf_counter()
+    try:
+        denoise_with_profile(sound_path, output_path, profile, csv_folder_name, **denoise_kwargs)
+        error = ""
+    except Exception as e:
+        error = f"{type(e).__name__}: {' '.join(str(e).split())}"
+    return sound_path, error, time.perf_counter() - start
+
+
+def denoise_batch(
+    sound_paths: list,
+    output_directory: str,
+    prefix: str = "",
+    group_pattern: str = "", # regex on the file names giving the device/session group (see recording_group)
+    noise_interval: tuple = None, # (start s, end s) in the first recording of every group; None finds one
+    noise_seconds: float = 0.5,
+    search_recordings: int = 3,
+    jobs: int = os.cpu_count(),
+    cache_dir: str = "", # if given, keep the noise profiles there (see cache.py)
+    cache_size_gb: float = 20.0,
+    chunk_seconds: float = 60.0,
+    overlap_seconds: float = 0.5,
+    overwrite: bool = False, # denoise recordings whose outputs exist again instead of skipping them
+    **remove_noise_kwargs, # window_length_s, filter_low_hz, filter_high_hz, smoothing_hz, method
+) -> list:
+    """
+    Denoises every recording with the noise profile of its group, on jobs worker processes.
+
+    Writes {prefix}denoised_audio/<name>_denoised.wav and {prefix}denoise_metadata/ (one csv per recording) in
+    output_directory, plus {prefix}noise_profiles.csv (one row per group) and {prefix}denoise_summary.csv.
+    Recordings whose metadata csv exists (it is written last) are skipped, unless overwrite is set.
+
+    Returns: list of dicts (sound_path, group, status "ok", "skipped" or "failed", error, elapsed_seconds)
+    """
+    audio_folder_name = os.path.join(output_directory, f"{prefix}denoised_audio")
+    csv_folder_name = os.path.join(output_directory, f"{prefix}denoise_metadata")
+    os.makedirs(audio_folder_name, exist_ok=True)
+    os.makedirs(csv_folder_name, exist_ok=True)
+
+    groups = {}
+    for sound_path in sorted(sound_paths):
+        groups.setdefault(recording_group(sound_path, group_pattern), []).append(sound_path)
+    profile_kwargs = {"noise_interval": noise_interval, "noise_seconds": noise_seconds, "search_recordings": search_recordings}
+    denoise_kwargs = {"chunk_seconds": chunk_seconds, "overlap_seconds": overlap_seconds, **remove_noise_kwargs}
+    cache_max_bytes = int(cache_size_gb * 1024**3)
+
+    results = []
+    profile_rows = []
+    with multiprocessing.Pool(max(1, min(jobs, len(sound_paths) or 1))) as pool:
+        profile_tasks = [(group, paths, profile_kwargs, cache_dir, cache_max_bytes) for group, paths in groups.items()]
+        denoise_tasks = []
+        for group, profile, error in pool.imap_unordered(_profile_task, profile_tasks):
+            if error:
+                print(f"failed: noise profile of {group}: {error}")
+                results += [
+                    {"sound_path": p, "group": group, "status": "failed", "error": f"noise profile: {error}", "elapsed_seconds": 0.0}
+                    for p in groups[group]
+                ]
+                continue
+            profile_rows.append([group, profile.source_path, profile.start_seconds, profile.end_seconds, profile.level_db])
+            for sound_path in groups[group]:
+                wav_base = os.path.splitext(os.path.basename(sound_path))[0]
+                output_path = os.path.join(audio_folder_name, f"{wav_base}_denoised.wav")
+                stats_path = os.path.join(csv_folder_name, f"{wav_base}_{denoise_with_profile.__name__}.csv")
+                if os.path.exists(stats_path):
+                    if not overwrite:
+                        results.append({"sound_path": sound_path, "group": group, "status": "skipped", "error": "", "elapsed_seconds": 0.0})
+                        continue
+                    os.remove(stats_path)
+                denoise_tasks.append((sound_path, output_path, profile, csv_folder_name, denoise_kwargs))
+
+        group_of = {p: group for group, paths in groups.items() for p in paths}
+        for sound_path, error, elapsed_sec in pool.imap_unordered(_denoise_task, denoise_tasks):
+            if error:
+                print(f"failed: {sound_path}: {error}")
+            results.append({
+                "sound_path": sound_path,
+                "group": group_of[sound_path],
+                "status": "failed" if error else "ok",
+                "error": error,
+                "elapsed_seconds": elapsed_sec,
+            })
+
+    with open(os.path.join(output_directory, f"{prefix}noise_profiles.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["group", "noise_source", "noise_start_seconds", "noise_end_seconds", "noise_level_db"])
+        for group, source_path, start_seconds, end_seconds, level_db in sorted(profile_rows):
+            writer.writerow([group, source_path, f"{start_seconds:.6f}", f"{end_seconds:.6f}", f"{level_db:.3f}"])
+    results.sort(key=lambda r: r["sound_path"])
+    with open(os.path.join(output_directory, f"{prefix}denoise_summary.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["sound_path", "group", "status", "errors", "elapsed_seconds"])
+        for result in results:
+            writer.writerow([
+                result["sound_path"], result["group"], result["status"], result["error"], f"{result['elapsed_seconds']:.6f}"
+            ])
+    ok = sum(r["status"] == "ok" for r in results)
+    skipped = sum(r["status"] == "skipped" for r in results)
+    print(f"{ok} of {len(results)} recordings denoised ({skipped} already done) with {len(profile_rows)} noise profiles")
+    return results
+
+
+def main():
+    from batch import find_recordings
+
+    parser = argparse.ArgumentParser(description="Denoise many recordings with one noise profile per device/session group.")
+    parser.add_argument("input", help="patient directory (all *.wav files in it) or a glob of recordings")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--prefix", default="", help="prefix of the output folder names")
+    parser.add_argument("--group-pattern", default="", help="regex on the file names giving the group (default: the folder)")
+    parser.add_argument("--noise-interval", type=float, nargs=2, metavar=("START", "END"), default=None,
+                        help="noise-only interval (s) of each group's first recording (default: the quietest one)")
+    parser.add_argument("--noise-seconds", type=float, default=0.5, help="length of the automatically found noise interval")
+    parser.add_argument("--search-recordings", type=int, default=3, help="recordings per group searched for the noise interval")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--cache-dir", default="", help="cache of the noise profiles (cache.py)")
+    parser.add_argument("--cache-size-gb", type=float, default=20.0)
+    parser.add_argument("--chunk-seconds", type=float, default=60.0)
+    parser.add_argument("--overlap-seconds", type=float, default=0.5)
+    parser.add_argument("--window-length", type=float, default=0.025)
+    parser.add_argument("--filter-low-hz", type=float, default=0.0)
+    parser.add_argument("--filter-high-hz", type=float, default=20000.0)
+    parser.add_argument("--smoothing-hz", type=float, default=40.0)
+    parser.add_argument("--overwrite", action="store_true", help="denoise recordings already denoised in output-dir again")
+    args = parser.parse_args()
+
+    results = denoise_batch(
+        find_recordings(args.input),
+        args.output_dir,
+        prefix=args.prefix,
+        group_pattern=args.group_pattern,
+        noise_interval=tuple(args.noise_interval) if args.noise_interval else None,
+        noise_seconds=args.noise_seconds,
+        search_recordings=args.search_recordings,
+        jobs=args.jobs,
+        cache_dir=args.cache_dir,
+        cache_size_gb=args.cache_size_gb,
+        chunk_seconds=args.chunk_seconds,
+        overlap_seconds=args.overlap_seconds,
+        window_length_s=args.window_length,
+        filter_low_hz=args.filter_low_hz,
+        filter_high_hz=args.filter_high_hz,
+        smoothing_hz=args.smoothing_hz,
+        overwrite=args.overwrite,
+    )
+    if any(r["status"] not in ("ok", "skipped") for r in results):
+        raise SystemExit(1)
 
-# Pick a noise-only segment (e.g., first 250 ms).
-snd_denoised, s_hz = denoise_sound_praat_remove_noise(
-    snd,
-    noise_start_s=0.00,
-    noise_end_s=0.25,
-    window_length_s=0.025,
-    filter_low_hz=0.0,
-    filter_high_hz=20000.0,
-    smoothing_hz=40.0
-)
 
-# snd_denoised.save("processed_audio/denoised.wav", "WAV")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import numpy as np
+import json
+import glob
+import os
+from tracing import span
+
+
+# Columnar binary alternative to the per-recording stats csv files.
+#
+# Each feature function called with output_format="npy" writes, instead of {wav_base}_{func_name}.csv,
+# a folder {wav_base}_{func_name}/ inside csv_folder_name holding one .npy file per per-frame column
+# (e.g. time_seconds.npy, f0_hz.npy) and a metadata.json with the run parameters, summary values and
+# timing. .npy files load without parsing and can be memory-mapped, so a cohort analysis can pull one
+# column out of hundreds of sessions cheaply (see load_column).
+
+OUTPUT_FORMATS = ["csv", "npy"]
+
+
+def check_output_format(output_format: str):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {OUTPUT_FORMATS}")
+
+
+def _json_value(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    if isinstance(value, (list, tuple)):
+        return [_json_value(v) for v in value]
+    return value
+
+
+def save_feature(
+    folder_name: str,
+    wav_base: str,
+    func_name: str,
+    metadata: dict,
+    columns: dict,
+) -> str:
+    """
+    Writes one recording's feature output to {folder_name}/{wav_base}_{func_name}/.
+
+    Args:
+        metadata (dict): run parameters, summary values and elapsed_seconds (JSON-serialisable scalars or lists).
+        columns (dict): column name -> 1-D np.ndarray (one value per frame), or 2-D (frames x k).
+
+    Returns: path of the written folder
+    """
+    store_path = os.path.join(folder_name, f"{wav_base}_{func_name}")
+    with span("save_feature", "io"):
+        os.makedirs(store_path, exist_ok=False) # same as the "x" mode of the csv files: never overwrite a result
+        for column, values in columns.items():
+            np.save(os.path.join(store_path, f"{column}.npy"), np.ascontiguousarray(values))
+        with open(os.path.join(store_path, "metadata.json"), "w") as f:
+            json.dump(
+                {
+                    "wav_base": wav_base,
+                    "func_name": func_name,
+                    "columns": list(columns),
+                    **{k: _json_value(v) for k, v in metadata.items()},
+                },
+                f,
+                indent=1,
+            )
+    return store_path
+
+
+def load_feature(store_path: str, mmap: bool = True):
+    """
+    Loads a folder written by save_feature.
+
+    Returns: metadata (dict), columns (dict of column name -> np.ndarray, memory-mapped if mmap)
+    """
+    with open(os.path.join(store_path, "metadata.json")) as f:
+        metadata = json.load(f)
+    columns = {
+        column: np.load(os.path.join(store_path, f"{column}.npy"), mmap_mode="r" if mmap else None)
+        for column in metadata["columns"]
+    }
+    return metadata, columns
+
+
+def load_column(folder_name: str, func_name: str, column: str, mmap: bool = True) -> dict:
+    """
+    Loads one column of one feature for every recording stored in folder_name.
+
+    e.g. load_column(pitch_folder, "pitches", "f0_hz") -> {"579_audio": array([...]), ...}
+    """
+    result = {}
+    for store_path in sorted(glob.glob(os.path.join(folder_name, f"*_{func_name}", "metadata.json"))):
+        store_path = os.path.dirname(store_path)
+        wav_base = os.path.basename(store_path)[: -len(func_name) - 1]
+        result[wav_base] = np.load(os.path.join(store_path, f"{column}.npy"), mmap_mode="r" if mmap else None)
+    return result
+
+
+def load_metadata(folder_name: str, func_name: str) -> list:
+    """metadata.json of every recording of one feature stored in folder_name (e.g. to collect the per-session means)."""
+    result = []
+    for metadata_path in sorted(glob.glob(os.path.join(folder_name, f"*_{func_name}", "metadata.json"))):
+        with open(metadata_path) as f:
+            result.append(json.load(f))
+    return result
@@ -1,18 +1,19 @@
 import numpy as np
 import parselmouth
 from parselmouth.praat import call
-import matplotlib.pyplot as plt
 import time
 import os
 import csv
-
-# snd = "raw_audio/hoarse_test_voice.wav" # jitter value: 0.07892894876979728 (higher, as expected)
-snd = "raw_audio/testsoundmono.mp3" # jitter value: 0.02721768951093052
-# snd = "raw_audio/high_pitch.wav"
+from analysis import RecordingAnalysis, as_analysis
+from feature_store import check_output_format, save_feature
+from cache import cached_feature
+from tracing import span
+from pulses import check_engine, pulse_times, jitter_values
 
 
+@cached_feature
 def jitter(
-    sound_path: str,
+    sound_path: str | RecordingAnalysis | parselmouth.Sound | np.ndarray,
     csv_folder_name: str,
     kind : str = "local",
     pitch_floor: float = 75.0, #currently set to 75Hz, seems to work well
@@ -23,44 +24,81 @@ def jitter(
     period_floor: float = 0.0001, # this and below are default praat vals
     period_ceiling: float = 0.02,
     maximum_period_factor: float = 1.3,
-    stats: bool = True
+    engine: str = "praat", # or "numpy": pulses.jitter_values on the pulse times (same values to within 1e-9)
+    stats: bool = True,
+    sample_rate_hz: float = 0.0, # only needed when sound_path is a NumPy array of samples
+    output_format: str = "csv" # "csv", or "npy" for the columnar binary store in feature_store.py
 ):
     """
     Returns jitter of sound.
+    sound_path may be a path, a RecordingAnalysis shared with the other feature functions, or an in-memory
+    parselmouth.Sound or NumPy array of samples (with sample_rate_hz).
     
     kind options: "local", "local, absolute", "rap", "ppq5", "ddp"
+    engine options: "praat", "numpy"
     """
     
+    analysis = as_analysis(sound_path, sample_rate_hz)
+    check_output_format(output_format)
+    check_engine(engine)
+
     if(stats):
         start_time = time.perf_counter()
-        wav_base = os.path.splitext(os.path.basename(sound_path))[0]
+        wav_base = analysis.wav_base
         func_name = jitter.__name__
         stats_csv_file_name = f"{csv_folder_name}/{wav_base}_{func_name}.csv"
     
-    sound = parselmouth.Sound(sound_path)
-    sampling_hz = sound.sampling_frequency
+    sampling_hz = analysis.sampling_hz
 
     if kind not in ["local", "local, absolute", "rap", "ppq5", "ddp"]:
         raise ValueError("Kind option not one of those allowed. Look at docstring for kind options.")
     
-    pitch = sound.to_pitch(time_step=pitch_time_step, pitch_floor=pitch_floor, pitch_ceiling=pitch_ceiling)
-    
-    point = call([sound, pitch], "To PointProcess (cc)")
+    point = analysis.point_process(pitch_time_step, pitch_floor, pitch_ceiling)
+    analysed_range = (from_time, to_time) # on the timeline of the analyses (the concatenated speech with speech_only)
+    if from_time != to_time:
+        analysed_range = tuple(analysis.analysed_times([from_time, to_time]))
 
-    jtr = call(
-        point,
-        f"Get jitter ({kind})",
-        from_time,
-        to_time,
-        period_floor,
-        period_ceiling,
-        maximum_period_factor,
-    )
+    if engine == "numpy":
+        with span(f"jitter ({kind})", "numpy"):
+            jtr = jitter_values(pulse_times(point), [kind], *analysed_range, period_floor, period_ceiling, maximum_period_factor)[kind]
+    else:
+        with span(f"Get jitter ({kind})", "praat"):
+            jtr = call(
+                point,
+                f"Get jitter ({kind})",
+                *analysed_range,
+                period_floor,
+                period_ceiling,
+                maximum_period_factor,
+            )
     
-    if stats:
+    if stats and output_format == "npy":
+        elapsed_sec = time.perf_counter() - start_time
+        save_feature(
+            csv_folder_name,
+            wav_base,
+            func_name,
+            {
+                "sound_path": analysis.file_name,
+                "sample_rate_hz": sampling_hz,
+                "kind": kind,
+                "pitch_floor": pitch_floor,
+                "pitch_ceiling": pitch_ceiling,
+                "pitch_time_step": pitch_time_step,
+                "from_time": from_time,
+                "to_time": to_time,
+                "period_floor": period_floor,
+                "period_ceiling": period_ceiling,
+                "maximum_period_factor": maximum_period_factor,
+                "jitter_val": jtr,
+                "elapsed_seconds": elapsed_sec,
+            },
+            {},
+        )
+    elif stats:
         # Timing:
         elapsed_sec = time.perf_counter() - start_time
-        with open(stats_csv_file_name, "x", newline="") as f:
+        with span("stats_csv", "io"), open(stats_csv_file_name, "x", newline="") as f:
             writer = csv.writer(f)
             writer.writerow([
                 "sound_path",
@@ -78,7 +116,7 @@ def jitter(
                 "elapsed_seconds",
             ])
             writer.writerow([
-                os.path.basename(sound_path),
+                analysis.file_name,
                 sampling_hz,
                 kind,
                 pitch_floor,
@@ -95,6 +133,10 @@ def jitter(
     
     return jtr, sampling_hz
 
-jtr_val, s_hz = jitter(snd, 'function_output_data')
+if __name__ == "__main__":
+    # snd = "raw_audio/hoarse_test_voice.wav" # jitter value: 0.07892894876979728 (higher, as expected)
+    snd = "raw_audio/testsoundmono.mp3" # jitter value: 0.02721768951093052
+    # snd = "raw_audio/high_pitch.wav"
+    jtr_val, s_hz = jitter(snd, 'function_output_data')
 
-print(jtr_val)
\ No newline at end of file
+    print(jtr_val)
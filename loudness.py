@@ -1,10 +1,12 @@
 import numpy as np
 import parselmouth
-from parselmouth.praat import call
-import matplotlib.pyplot as plt
 import time
 import os
 import csv
+from analysis import RecordingAnalysis, as_analysis
+from feature_store import check_output_format, save_feature
+from cache import cached_feature
+from tracing import span
 
 
 # BE CAREFUL BECAUSE LOUDNESS CAN CHANGE BASED ON MICROPHONE, AND LOUDNESS IS NOT ROBUST TO CONTEXT
@@ -13,43 +15,72 @@ import csv
 # snd = "raw_audio/testsoundmono.mp3" # mean intensity was 57.78
 # snd = "raw_audio/high_pitch.wav"
 
+@cached_feature
 def loudness_in_db(
-    sound_path: str,
+    sound_path: str | RecordingAnalysis | parselmouth.Sound | np.ndarray,
     csv_folder_name: str,
     time_step: float = 0.01,
     pitch_floor: float = 75.0,
     subtract_mean: bool = True,
     activity_threshold_db: float = 40.0, # CAN ADJUST THIS VALUE (NORMALLY AROUND 40)
-    stats: bool = True
+    stats: bool = True,
+    sample_rate_hz: float = 0.0, # only needed when sound_path is a NumPy array of samples
+    output_format: str = "csv" # "csv", or "npy" for the columnar binary store in feature_store.py
 ):
     """
     Mean intensity (dB) over active frames only.
+    sound_path may be a path, a RecordingAnalysis shared with the other feature functions, or an in-memory
+    parselmouth.Sound or NumPy array of samples (with sample_rate_hz).
     Returns times (s), intensity_per_frame, mean_intensity
     """
     
+    analysis = as_analysis(sound_path, sample_rate_hz)
+    check_output_format(output_format)
+
     if(stats):
         start_time = time.perf_counter()
-        wav_base = os.path.splitext(os.path.basename(sound_path))[0]
+        wav_base = analysis.wav_base
         func_name = loudness_in_db.__name__
         stats_csv_file_name = f"{csv_folder_name}/{wav_base}_{func_name}.csv"
     
-    sound = parselmouth.Sound(sound_path)
-    sampling_hz = sound.sampling_frequency
+    sampling_hz = analysis.sampling_hz
     
-    intensity = call(sound, "To Intensity...", pitch_floor, time_step, subtract_mean) #
-    vals = intensity.values[0, :]
-    times = intensity.xs()
+    intensity = analysis.intensity(pitch_floor, time_step, subtract_mean)
+    with span("loudness_in_db", "numpy"):
+        vals = intensity.values[0, :]
+        times = intensity.xs()
     
-    active_mask = vals >= activity_threshold_db
-    active_times = times[active_mask]
-    active_intensity_vals = vals[active_mask]
+        active_mask = vals >= activity_threshold_db
+        active_times = analysis.original_times(times[active_mask])
+        active_intensity_vals = vals[active_mask]
     
-    active_intensity_vals_mean = float(np.mean(active_intensity_vals)) if active_intensity_vals.size else float("nan")
+        active_intensity_vals_mean = float(np.mean(active_intensity_vals)) if active_intensity_vals.size else float("nan")
     
-    if stats:
+    if stats and output_format == "npy":
+        elapsed_sec = time.perf_counter() - start_time
+        save_feature(
+            csv_folder_name,
+            wav_base,
+            func_name,
+            {
+                "sound_path": analysis.file_name,
+                "sample_rate_hz": sampling_hz,
+                "time_step": time_step,
+                "pitch_floor": pitch_floor,
+                "subtract_mean": subtract_mean,
+                "activity_threshold_db": activity_threshold_db,
+                "active_intensity_vals_mean": active_intensity_vals_mean,
+                "elapsed_seconds": elapsed_sec,
+            },
+            {
+                "time_seconds": active_times,
+                "intensity_db": active_intensity_vals,
+            },
+        )
+    elif stats:
         # Timing:
         elapsed_sec = time.perf_counter() - start_time
-        with open(stats_csv_file_name, "x", newline="") as f:
+        with span("stats_csv", "io"), open(stats_csv_file_name, "x", newline="") as f:
             writer = csv.writer(f)
             writer.writerow([
                 "sound_path",
@@ -65,7 +96,7 @@ def loudness_in_db(
             ])
             if active_times.size == 0:
                 writer.writerow([
-                    os.path.basename(sound_path),
+                    analysis.file_name,
                     sampling_hz,
                     time_step,
                     pitch_floor,
@@ -79,7 +110,7 @@ def loudness_in_db(
             else:
                 for i, (t, v) in enumerate(zip(active_times, active_intensity_vals)):
                     writer.writerow([
-                        os.path.basename(sound_path) if i == 0 else "",
+                        analysis.file_name if i == 0 else "",
                         sampling_hz if i == 0 else "",
                         time_step if i == 0 else "",
                         pitch_floor if i == 0 else "",
@@ -99,50 +130,41 @@ def save_loudness_plot(
     intensity_db: np.ndarray,
     mean_intensity_db: float,
     output_path: str,
+    ax=None, # draw on these (reused) axes instead of a new figure, see render.py
 ):
     """Save loudness plot in the same format as the TESTING section."""
+    import matplotlib.pyplot as plt
     if ts.size == 0 or intensity_db.size == 0:
         return
 
-    plt.figure()
-    plt.scatter(ts, intensity_db, color='blue', label='Data Points')
-    plt.axhline(y=mean_intensity_db, color='r', linestyle='-',
-                label=f'Intensity mean: {mean_intensity_db}')
-    plt.title("Intensities over time")
-    plt.xlabel("Time (in seconds)")
-    plt.ylabel("Intensity (dB)")
-    plt.legend()
-    plt.savefig(output_path, dpi=300, bbox_inches='tight')
-    plt.close()
+    reuse = ax is not None
+    fig, ax = (ax.figure, ax) if reuse else plt.subplots()
+    ax.scatter(ts, intensity_db, color='blue', label='Data Points')
+    ax.axhline(y=mean_intensity_db, color='r', linestyle='-',
+               label=f'Intensity mean: {mean_intensity_db}')
+    ax.set_title("Intensities over time")
+    ax.set_xlabel("Time (in seconds)")
+    ax.set_ylabel("Intensity (dB)")
+    ax.legend()
+    fig.savefig(output_path, dpi=300, bbox_inches='tight')
+    if not reuse:
+        plt.close(fig)
 
 
 def main():
-    patient_raw_data_directory = '/data_store2/resection/neuropsych_video/presidio/Stage2/PR05/home/'
-
-    loudness_csv_output_directory = '/userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_loudness_metadata'
-    loudness_plot_output_directory = '/userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_loudness_plots'
-
-    os.makedirs(loudness_csv_output_directory, exist_ok=True)
-    os.makedirs(loudness_plot_output_directory, exist_ok=True)
+    from batch import find_recordings, run_batch
 
-    for num in range(579, 611):
-        audio_name_without_wav = str(num)
-        audio_name = audio_name_without_wav + '_audio.wav'
-        sound_path = os.path.join(patient_raw_data_directory, audio_name)
-
-        if not os.path.exists(sound_path):
-            continue
-
-        ts, intensity_db, mean_intensity_db, sampling_hz = loudness_in_db(
-            sound_path,
-            loudness_csv_output_directory,
-        )
+    patient_raw_data_directory = '/data_store2/resection/neuropsych_video/presidio/Stage2/PR05/home/'
 
-        plot_path = os.path.join(
-            loudness_plot_output_directory,
-            'sub-PR05_stage-2_audio-audiotype_preproc_' + audio_name_without_wav + '_loudness.png'
-        )
-        save_loudness_plot(ts, intensity_db, mean_intensity_db, plot_path)
+    # Outputs go to /userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_loudness_metadata and /userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_loudness_plots
+    # Plots are named sub-PR05_stage-2_audio-audiotype_preproc_<recording>_loudness.png (e.g. ..._579_audio_loudness.png); the old loop wrote ..._579_loudness.png
+    run_batch(
+        find_recordings(patient_raw_data_directory, '*_audio.wav'),
+        ['loudness'],
+        '/userdata/msharma',
+        prefix='sub-PR05_stage-2_audio-audiotype_preproc_',
+        jobs=os.cpu_count(),
+    )
 
 
 if __name__ == "__main__":
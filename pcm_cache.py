@@ -0,0 +1,168 @@
+import parselmouth
+import contextlib
+import numpy as np
+import hashlib
+import glob
+import os
+from scipy.io import wavfile
+from tracing import span
+
+
+# Local cache of decoded audio.
+#
+# parselmouth.Sound(path) decodes the whole input on every call, which is slow for MP3s and for WAVs read over
+# the network mount. With a PCMCache configured (set_pcm_cache_dir, the PCM_CACHE_DIR environment variable or
+# run_batch(..., pcm_cache_dir=...)), every input is decoded once into a PCM WAV file in the cache directory,
+# keyed by its absolute path, mtime and size, and later loads memory-map that file: no decoding, no network
+# reads and no copy until the samples are used. Integer WAVs are stored with their own sample format; anything
+# scipy cannot read (MP3, FLAC, unusual WAVs) is decoded by Praat and stored as float64 samples.
+#
+# read_pcm (like scipy.io.wavfile.read) and load_sound (like parselmouth.Sound(path), same sample values) are
+# what the other modules load recordings with; without a cache directory they read the file directly.
+# The least recently used entries are evicted once the cache grows beyond max_bytes.
+
+
+PCM_CACHE_ENV = "PCM_CACHE_DIR"
+PCM_CACHE_SIZE_ENV = "PCM_CACHE_MAX_BYTES" # max_bytes of the cache in PCM_CACHE_DIR
+
+
+def praat_sample_values(data: np.ndarray) -> np.ndarray:
+    """
+    The float samples (in [-1, 1]) that parselmouth.Sound reads from a WAV file holding data (as returned by
+    scipy.io.wavfile.read), so in-memory results match analysing the file.
+    """
+    if data.dtype == np.uint8:
+        return (data.astype(np.float64) - 128.0) / 128.0
+    if np.issubdtype(data.dtype, np.integer):
+        return data.astype(np.float64) / -float(np.iinfo(data.dtype).min)
+    return data.astype(np.float64)
+
+
+def _decode(sound_path: str):
+    """sampling_hz and samples ((n_samples,) or (n_samples, n_channels)) of any file scipy or Praat can read."""
+    try:
+        return wavfile.read(sound_path)
+    except ValueError:
+        pass # not a WAV scipy can read
+    sound = parselmouth.Sound(sound_path)
+    values = sound.values.T
+    return sound.sampling_frequency, values[:, 0].copy() if values.shape[1] == 1 else values.copy()
+
+
+class PCMCache:
+    def __init__(self, cache_dir: str, max_bytes: int = 100 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, sound_path: str) -> str:
+        """The decoded WAV of sound_path, for its current mtime and size."""
+        st = os.stat(sound_path)
+        key = hashlib.sha256(repr((os.path.abspath(sound_path), st.st_mtime_ns, st.st_size)).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + ".wav")
+
+    def read(self, sound_path: str):
+        """
+        Returns: sampling_hz and the samples of sound_path as a read-only memory map of the cached PCM
+        (decoded and stored first if needed), with the layout of scipy.io.wavfile.read.
+        """
+        path = self.entry_path(sound_path)
+        try:
+            sampling_hz, data = wavfile.read(path, mmap=True)
+            os.utime(path) # mtime = last use, for LRU eviction
+            return sampling_hz, data
+        except (FileNotFoundError, ValueError):
+            pass
+        with span("decode", "load", sound_path=sound_path):
+            sampling_hz, data = _decode(sound_path)
+        if sampling_hz != int(sampling_hz):
+            return sampling_hz, data # WAV headers hold whole sampling rates: not cached
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with span("store", "io", sound_path=sound_path):
+            wavfile.write(tmp_path, int(sampling_hz), data)
+            os.replace(tmp_path, path) # concurrent workers never see a half-written entry
+        self.evict()
+        return wavfile.read(path, mmap=True)
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache is at most max_bytes."""
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, "*", "*.wav")):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue # evicted by another worker
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_caches = {} # cache_dir -> PCMCache
+
+
+def set_pcm_cache_dir(cache_dir: str, max_bytes: int = 100 * 1024**3):
+    """Loads every recording of this process and its child processes through a PCMCache in cache_dir ("" to read files directly)."""
+    if cache_dir:
+        _caches[cache_dir] = PCMCache(cache_dir, max_bytes)
+        os.environ[PCM_CACHE_ENV] = cache_dir
+        os.environ[PCM_CACHE_SIZE_ENV] = str(max_bytes)
+    else:
+        os.environ.pop(PCM_CACHE_ENV, None)
+        os.environ.pop(PCM_CACHE_SIZE_ENV, None)
+
+
+@contextlib.contextmanager
+def using_pcm_cache_dir(cache_dir: str, max_bytes: int = 100 * 1024**3):
+    """set_pcm_cache_dir for the duration of a with block, then back to the previous setting."""
+    previous = {name: os.environ.get(name) for name in (PCM_CACHE_ENV, PCM_CACHE_SIZE_ENV)}
+    set_pcm_cache_dir(cache_dir, max_bytes)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def pcm_cache() -> PCMCache:
+    """The PCMCache in $PCM_CACHE_DIR, or None."""
+    cache_dir = os.environ.get(PCM_CACHE_ENV, "")
+    if not cache_dir:
+        return None
+    if cache_dir not in _caches:
+        _caches[cache_dir] = PCMCache(cache_dir, int(os.environ.get(PCM_CACHE_SIZE_ENV, 100 * 1024**3)))
+    return _caches[cache_dir]
+
+
+def read_pcm(sound_path: str, mmap: bool = False):
+    """
+    scipy.io.wavfile.read(sound_path, mmap) through the PCM cache, for any format Praat can read.
+    The samples are a read-only memory map when they come from the cache or mmap is True.
+    """
+    cache = pcm_cache()
+    if cache is not None:
+        return cache.read(sound_path)
+    try:
+        return wavfile.read(sound_path, mmap=mmap)
+    except ValueError:
+        return _decode(sound_path)
+
+
+def load_sound(sound_path: str) -> parselmouth.Sound:
+    """parselmouth.Sound(sound_path) through the PCM cache (the same samples)."""
+    cache = pcm_cache()
+    if cache is None:
+        return parselmouth.Sound(sound_path)
+    sampling_hz, data = cache.read(sound_path)
+    values = praat_sample_values(data)
+    return parselmouth.Sound(values.T if values.ndim == 2 else values, sampling_frequency=sampling_hz)
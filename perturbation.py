@@ -0,0 +1,318 @@
+import numpy as np
+import parselmouth
+from parselmouth.praat import call
+import time
+import os
+import csv
+from analysis import RecordingAnalysis, as_analysis
+from feature_store import check_output_format, save_feature
+from cache import cached_feature
+from tracing import span
+from pulses import check_engine, pulse_times, number_of_periods, jitter_values, shimmer_values
+
+# record key -> Praat kind, for every jitter and shimmer variant
+JITTER_KINDS = {
+    "jitter_local": "local",
+    "jitter_local_absolute": "local, absolute",
+    "jitter_rap": "rap",
+    "jitter_ppq5": "ppq5",
+    "jitter_ddp": "ddp",
+}
+SHIMMER_KINDS = {
+    "shimmer_local": "local",
+    "shimmer_local_db": "local_dB",
+    "shimmer_apq3": "apq3",
+    "shimmer_apq5": "apq5",
+    "shimmer_apq11": "apq11",
+}
+
+
+def sliding_windows(duration: float, window_seconds: float, hop_seconds: float = 0.0) -> np.ndarray:
+    """(n, 2) start and end times (s) of windows of window_seconds every hop_seconds (default: window_seconds)."""
+    hop_seconds = hop_seconds or window_seconds
+    starts = np.arange(0.0, max(duration - window_seconds, 0.0) + hop_seconds / 2, hop_seconds)
+    return np.column_stack((starts, np.minimum(starts + window_seconds, duration)))
+
+
+@cached_feature
+def jitter_shimmer_windows(
+    sound_path: str | RecordingAnalysis | parselmouth.Sound | np.ndarray,
+    csv_folder_name: str,
+    window_seconds: float = 60.0,
+    hop_seconds: float = 0.0, # 0: windows do not overlap
+    windows: list = None, # (start, end) times (s), e.g. utterances; replaces window_seconds / hop_seconds
+    jitter_kind: str = "local",
+    shimmer_N: int = 5,
+    pitch_floor: float = 75.0,
+    pitch_ceiling: float = 500.0,
+    pitch_time_step = 0.01,
+    period_floor: float = 0.0001, # all of these are default praat values
+    period_ceiling: float = 0.02,
+    maximum_period_factor: float = 1.3,
+    maximum_amplitude_factor: float = 1.6,
+    engine: str = "praat", # or "numpy" (pulses.py)
+    stats: bool = True,
+    sample_rate_hz: float = 0.0, # only needed when sound_path is a NumPy array of samples
+    output_format: str = "csv" # "csv", or "npy" for the columnar binary store in feature_store.py
+):
+    """
+    Jitter (jitter_kind, as in jitter()) and apqN shimmer (shimmer_N, as in shimmer_apqN()) of every window,
+    from one PointProcess of the whole recording, with the number of voiced periods each value is based on.
+    sound_path may be a path, a RecordingAnalysis shared with the other feature functions, or an in-memory
+    parselmouth.Sound or NumPy array of samples (with sample_rate_hz).
+
+    Returns:
+      window_starts: np.ndarray (s)
+      window_ends: np.ndarray (s)
+      n_periods: np.ndarray, voiced periods in each window (jitter and shimmer are NaN where there are too few)
+      jitter_vals: np.ndarray
+      shimmer_vals: np.ndarray
+      sampling_hz: float
+    """
+
+    analysis = as_analysis(sound_path, sample_rate_hz)
+    check_output_format(output_format)
+    check_engine(engine)
+
+    if(stats):
+        start_time = time.perf_counter()
+        wav_base = analysis.wav_base
+        func_name = jitter_shimmer_windows.__name__
+        stats_csv_file_name = f"{csv_folder_name}/{wav_base}_{func_name}.csv"
+
+    sampling_hz = analysis.sampling_hz
+
+    if jitter_kind not in ["local", "local, absolute", "rap", "ppq5", "ddp"]:
+        raise ValueError("Kind option not one of those allowed. Look at jitter's docstring for kind options.")
+    if shimmer_N not in [3, 5, 11]:
+        raise ValueError("shimmer_N can only be 3, 5, or 11")
+
+    if windows is None:
+        windows = sliding_windows(analysis.duration, window_seconds, hop_seconds)
+    windows = np.asarray(windows, dtype=np.float64).reshape(-1, 2)
+    window_starts, window_ends = windows[:, 0], windows[:, 1]
+    # the point process of a speech_only analysis is on the concatenated speech
+    from_times = analysis.analysed_times(window_starts)
+    to_times = analysis.analysed_times(window_ends)
+
+    point = analysis.point_process(pitch_time_step, pitch_floor, pitch_ceiling)
+    sound = analysis.analysed_sound
+
+    n_periods = np.zeros(windows.shape[0], dtype=np.int64)
+    jitter_vals = np.full(windows.shape[0], np.nan)
+    shimmer_vals = np.full(windows.shape[0], np.nan)
+    if engine == "numpy":
+        times = pulse_times(point)
+        with span("jitter_shimmer_windows", "numpy", n_windows=windows.shape[0]):
+            for i, (from_time, to_time) in enumerate(zip(from_times, to_times)):
+                if to_time <= from_time:
+                    continue
+                period_args = (from_time, to_time, period_floor, period_ceiling, maximum_period_factor)
+                n_periods[i] = number_of_periods(times, *period_args)
+                if n_periods[i] == 0:
+                    continue
+                jitter_vals[i] = jitter_values(times, [jitter_kind], *period_args)[jitter_kind]
+                shimmer_vals[i] = shimmer_values(
+                    times, sound.values[0], sound.x1, sound.dx, [f"apq{shimmer_N}"], *period_args, maximum_amplitude_factor
+                )[f"apq{shimmer_N}"]
+    else:
+        with span("jitter_shimmer_windows", "praat", n_windows=windows.shape[0]):
+            for i, (from_time, to_time) in enumerate(zip(from_times, to_times)):
+                if to_time <= from_time:
+                    continue # no speech in this window (from_time == to_time would mean the whole recording to Praat)
+                period_args = (from_time, to_time, period_floor, period_ceiling, maximum_period_factor)
+                n_periods[i] = call(point, "Get number of periods...", *period_args)
+                if n_periods[i] == 0:
+                    continue
+                jitter_vals[i] = call(point, f"Get jitter ({jitter_kind})", *period_args)
+                shimmer_vals[i] = call([sound, point], f"Get shimmer (apq{shimmer_N})", *period_args, maximum_amplitude_factor)
+
+    if stats and output_format == "npy":
+        elapsed_sec = time.perf_counter() - start_time
+        save_feature(
+            csv_folder_name,
+            wav_base,
+            func_name,
+            {
+                "sound_path": analysis.file_name,
+                "sample_rate_hz": sampling_hz,
+                "jitter_kind": jitter_kind,
+                "shimmer_N": shimmer_N,
+                "pitch_floor": pitch_floor,
+                "pitch_ceiling": pitch_ceiling,
+                "pitch_time_step": pitch_time_step,
+                "period_floor": period_floor,
+                "period_ceiling": period_ceiling,
+                "maximum_period_factor": maximum_period_factor,
+                "maximum_amplitude_factor": maximum_amplitude_factor,
+                "elapsed_seconds": elapsed_sec,
+            },
+            {
+                "window_start_seconds": window_starts,
+                "window_end_seconds": window_ends,
+                "n_periods": n_periods,
+                "jitter_val": jitter_vals,
+                "shimmer_val": shimmer_vals,
+            },
+        )
+    elif stats:
+        # Timing:
+        elapsed_sec = time.perf_counter() - start_time
+        with span("stats_csv", "io"), open(stats_csv_file_name, "x", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([
+                "sound_path",
+                "sample_rate_hz",
+                "jitter_kind",
+                "shimmer_N",
+                "pitch_floor",
+                "pitch_ceiling",
+                "pitch_time_step",
+                "period_floor",
+                "period_ceiling",
+                "maximum_period_factor",
+                "maximum_amplitude_factor",
+                "elapsed_seconds",
+                "window_start_seconds",
+                "window_end_seconds",
+                "n_periods",
+                "jitter_val",
+                "shimmer_val",
+            ])
+            metadata = [
+                analysis.file_name,
+                sampling_hz,
+                jitter_kind,
+                shimmer_N,
+                pitch_floor,
+                pitch_ceiling,
+                pitch_time_step,
+                period_floor,
+                period_ceiling,
+                maximum_period_factor,
+                maximum_amplitude_factor,
+                f"{elapsed_sec:.6f}",
+            ]
+            if windows.shape[0] == 0:
+                writer.writerow(metadata + ["", "", "", "", ""])
+            for i in range(windows.shape[0]):
+                writer.writerow((metadata if i == 0 else [""] * len(metadata)) + [
+                    f"{window_starts[i]:.6f}",
+                    f"{window_ends[i]:.6f}",
+                    n_periods[i],
+                    f"{jitter_vals[i]:.6f}" if np.isfinite(jitter_vals[i]) else "",
+                    f"{shimmer_vals[i]:.6f}" if np.isfinite(shimmer_vals[i]) else "",
+                ])
+
+    return window_starts, window_ends, n_periods, jitter_vals, shimmer_vals, sampling_hz
+
+@cached_feature
+def perturbation(
+    sound_path: str | RecordingAnalysis | parselmouth.Sound | np.ndarray,
+    csv_folder_name: str,
+    pitch_floor: float = 75.0,
+    pitch_ceiling: float = 500.0,
+    pitch_time_step = 0.01,
+    from_time: float = 0.0, # if "from time" and "to time" are same it goes for the entire audio recording
+    to_time: float = 0.0,
+    period_floor: float = 0.0001, # all of these are default praat values
+    period_ceiling: float = 0.02,
+    maximum_period_factor: float = 1.3,
+    maximum_amplitude_factor: float = 1.6,
+    engine: str = "praat", # or "numpy" (pulses.py)
+    stats: bool = True,
+    sample_rate_hz: float = 0.0, # only needed when sound_path is a NumPy array of samples
+    output_format: str = "csv" # "csv", or "npy" for the columnar binary store in feature_store.py
+):
+    """
+    Every jitter variant (local, local absolute, rap, ppq5, ddp) and every shimmer variant (local, local dB,
+    apq3, apq5, apq11) from one Sound / Pitch / PointProcess, with the same arguments as jitter() and
+    shimmer_apqN(), written as one stats row.
+    sound_path may be a path, a RecordingAnalysis shared with the other feature functions, or an in-memory
+    parselmouth.Sound or NumPy array of samples (with sample_rate_hz).
+
+    Returns:
+      record: dict of n_periods and the keys of JITTER_KINDS and SHIMMER_KINDS -> value (NaN if undefined)
+      sampling_hz: float
+    """
+
+    analysis = as_analysis(sound_path, sample_rate_hz)
+    check_output_format(output_format)
+    check_engine(engine)
+
+    if(stats):
+        start_time = time.perf_counter()
+        wav_base = analysis.wav_base
+        func_name = perturbation.__name__
+        stats_csv_file_name = f"{csv_folder_name}/{wav_base}_{func_name}.csv"
+
+    sampling_hz = analysis.sampling_hz
+
+    point = analysis.point_process(pitch_time_step, pitch_floor, pitch_ceiling)
+    sound = analysis.analysed_sound
+    analysed_range = (from_time, to_time)
+    if from_time != to_time:
+        analysed_range = tuple(analysis.analysed_times([from_time, to_time]))
+
+    period_args = (*analysed_range, period_floor, period_ceiling, maximum_period_factor)
+    if engine == "numpy":
+        times = pulse_times(point)
+        with span("perturbation", "numpy"):
+            jitters = jitter_values(times, list(JITTER_KINDS.values()), *period_args)
+            shimmers = shimmer_values(
+                times, sound.values[0], sound.x1, sound.dx, list(SHIMMER_KINDS.values()), *period_args, maximum_amplitude_factor
+            )
+            record = {
+                "n_periods": number_of_periods(times, *period_args),
+                **{key: jitters[kind] for key, kind in JITTER_KINDS.items()},
+                **{key: shimmers[kind] for key, kind in SHIMMER_KINDS.items()},
+            }
+    else:
+        with span("perturbation", "praat"):
+            record = {"n_periods": call(point, "Get number of periods...", *period_args)}
+            for key, kind in JITTER_KINDS.items():
+                record[key] = call(point, f"Get jitter ({kind})", *period_args)
+            for key, kind in SHIMMER_KINDS.items():
+                record[key] = call([sound, point], f"Get shimmer ({kind})", *period_args, maximum_amplitude_factor)
+
+    parameters = {
+        "sound_path": analysis.file_name,
+        "sample_rate_hz": sampling_hz,
+        "pitch_floor": pitch_floor,
+        "pitch_ceiling": pitch_ceiling,
+        "pitch_time_step": pitch_time_step,
+        "from_time": from_time,
+        "to_time": to_time,
+        "period_floor": period_floor,
+        "period_ceiling": period_ceiling,
+        "maximum_period_factor": maximum_period_factor,
+        "maximum_amplitude_factor": maximum_amplitude_factor,
+    }
+    if stats and output_format == "npy":
+        elapsed_sec = time.perf_counter() - start_time
+        save_feature(
+            csv_folder_name,
+            wav_base,
+            func_name,
+            {**parameters, **record, "elapsed_seconds": elapsed_sec},
+            {},
+        )
+    elif stats:
+        # Timing:
+        elapsed_sec = time.perf_counter() - start_time
+        with span("stats_csv", "io"), open(stats_csv_file_name, "x", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow([*parameters, *record, "elapsed_seconds"])
+            writer.writerow([
+                *parameters.values(),
+                *(value if np.isfinite(value) else "" for value in record.values()),
+                f"{elapsed_sec:.6f}",
+            ])
+
+    return record, sampling_hz
+
+if __name__ == "__main__":
+    snd = "raw_audio/hoarse_test_voice.wav"
+    starts, ends, n_periods, jitter_vals, shimmer_vals, s_hz = jitter_shimmer_windows(snd, 'function_output_data', window_seconds=1.0)
+    for row in zip(starts, ends, n_periods, jitter_vals, shimmer_vals):
+        print(row)
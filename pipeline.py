@@ -0,0 +1,145 @@
+import multiprocessing
+from multiprocessing.connection import wait
+import inspect
+import tempfile
+import shutil
+import time
+import os
+from cache import FeatureCache
+from tracing import take_spans
+
+
+# Dependency-aware scheduler of the stages of one recording.
+#
+# A recording's work is a DAG of stages: the Praat analyses (pitch, point process, formant, spectrogram,
+# intensity) and the features reading them, e.g. the formant energies depend on the spectrogram, formant and
+# pitch stages, the jitter on the point process, which depends on the pitch. run_stages runs every stage as
+# soon as its inputs are done, with independent stages in concurrent processes forked from the recording's
+# worker (Praat is single-threaded and not thread-safe, so threads would not overlap). The stages hand their
+# Praat objects on through the recording's FeatureCache (cache.py; a scratch one for the duration of the run
+# when the batch has no cache_dir), so every analysis still runs once, and analyses already in the cache
+# are loaded instead of recomputed. A full run over one recording then takes about as long as its critical
+# path (e.g. the slowest of pitch, formant and spectrogram, then the formant energies) instead of the sum of
+# its stages.
+#
+# Usage: run_batch(..., stage_jobs=4), where the stage inputs of every feature are declared in batch.FEATURE_INPUTS.
+
+
+def analysis_stage(method: str, params: tuple) -> str:
+    """Name of the stage computing RecordingAnalysis.<method>(*params)."""
+    return f"{method}{params!r}"
+
+
+def analysis_inputs(func, inputs: list, task_kwargs: dict = None) -> list:
+    """
+    The analysis stages that func reads when called with task_kwargs (and its defaults otherwise): inputs
+    lists (RecordingAnalysis method, names of the func arguments the method is called with). func None: the
+    arguments are all in task_kwargs.
+
+    Returns: list of (stage name, method, params)
+    """
+    arguments = {name: p.default for name, p in inspect.signature(func).parameters.items()} if func is not None else {}
+    arguments.update(task_kwargs or {})
+    stages = []
+    for method, names in inputs:
+        params = tuple(arguments[name] for name in names)
+        stages.append((analysis_stage(method, params), method, params))
+    return stages
+
+
+def _run_stage(run, analysis, conn):
+    """Stage process: runs one stage and sends its error ("" if none), elapsed seconds and tracing spans."""
+    take_spans() # drop any inherited from the parent
+    start = time.perf_counter()
+    try:
+        run(analysis)
+        error = ""
+    except Exception as e:
+        error = f"{type(e).__name__}: {' '.join(str(e).split())}"
+    conn.send((error, time.perf_counter() - start, take_spans()))
+    conn.close()
+
+
+def run_stages(analysis, stages: dict, jobs: int = os.cpu_count(), on_start=None, on_done=None) -> dict:
+    """
+    Runs the stages of one recording in dependency order, up to jobs of them at a time in forked processes.
+
+    Args:
+        analysis: the recording's RecordingAnalysis
+        stages (dict): stage name -> (names of the stages it reads, function(analysis) running it), in the order
+            in which ready stages are started
+        on_start, on_done: called here with (name) when a stage starts, and (name, error or "", elapsed seconds,
+            tracing spans) when it ends; a stage whose input failed is not run and ends with that error
+
+    Returns: stage name -> error ("" if none)
+    """
+    for name, (inputs, _) in stages.items():
+        unknown = [i for i in inputs if i not in stages]
+        if unknown:
+            raise ValueError(f"stage {name!r} reads unknown stages {unknown}")
+    errors = {}
+
+    def finish(name, error, elapsed_sec=0.0, spans=()):
+        errors[name] = error
+        if on_done is not None:
+            on_done(name, error, elapsed_sec, list(spans))
+
+    scratch_dir = ""
+    if analysis.cache is None:
+        scratch_dir = tempfile.mkdtemp(prefix=f"{analysis.wav_base}_stages_")
+        analysis.cache = FeatureCache(scratch_dir, max_bytes=1 << 62) # evicts nothing before the run ends
+    try:
+        try:
+            # decode (and find the speech) once here: the stage processes inherit it
+            analysis.analysed_sound
+            analysis.analysis_hash
+        except Exception as e:
+            error = f"{type(e).__name__}: {' '.join(str(e).split())}"
+            for name in stages:
+                finish(name, error, spans=take_spans())
+            return errors
+
+        context = multiprocessing.get_context("fork") # the stages are closures over this process's analysis
+        waiting = list(stages)
+        running = {} # parent conn -> (process, stage name)
+        while waiting or running:
+            progressed = False
+            for name in list(waiting):
+                if len(running) >= max(1, jobs):
+                    break
+                inputs, run = stages[name]
+                failed = [i for i in inputs if errors.get(i)]
+                if failed:
+                    waiting.remove(name)
+                    progressed = True
+                    finish(name, f"{failed[0]}: {errors[failed[0]]}")
+                elif all(i in errors for i in inputs):
+                    waiting.remove(name)
+                    progressed = True
+                    if on_start is not None:
+                        on_start(name)
+                    parent_conn, child_conn = context.Pipe(duplex=False)
+                    process = context.Process(target=_run_stage, args=(run, analysis, child_conn))
+                    process.start()
+                    child_conn.close()
+                    running[parent_conn] = (process, name)
+            if not running:
+                if not progressed:
+                    raise ValueError(f"stages {waiting} depend on each other")
+                continue # stages were failed by their inputs: look at the rest again
+            for parent_conn in wait(list(running)):
+                process, name = running.pop(parent_conn)
+                try:
+                    error, elapsed_sec, spans = parent_conn.recv()
+                except EOFError:
+                    error, elapsed_sec, spans = None, 0.0, []
+                parent_conn.close()
+                process.join()
+                if error is None:
+                    error = f"stage process exited with code {process.exitcode}"
+                finish(name, error, elapsed_sec, spans)
+        return errors
+    finally:
+        if scratch_dir:
+            analysis.cache = None
+            shutil.rmtree(scratch_dir, ignore_errors=True)
@@ -1,25 +1,34 @@
 import parselmouth
 import numpy as np
 from numpy.linalg import lstsq
-import matplotlib.pyplot as plt
 import time
 import os
 import csv
+from analysis import RecordingAnalysis, as_analysis
+from feature_store import check_output_format, save_feature
+from cache import cached_feature
+from tracing import span
 
 # snd = "raw_audio/hoarse_test_voice.wav" # pitch mean: 287.3200488390224 (couldn't reliably find pitch though)
 snd = "raw_audio/testsoundmono.mp3" # pitch mean: 116
 
 
 
+@cached_feature
 def pitches(
-    sound_path: str,
+    sound_path: str | RecordingAnalysis | parselmouth.Sound | np.ndarray,
     csv_folder_name: str,
     time_step: float = 0.01,
     pitch_floor: float = 75.0,
     pitch_ceiling: float = 500.0,
-    stats: bool = True
+    stats: bool = True,
+    sample_rate_hz: float = 0.0, # only needed when sound_path is a NumPy array of samples
+    output_format: str = "csv" # "csv", or "npy" for the columnar binary store in feature_store.py
 ):
     """
+    sound_path may be a path, a RecordingAnalysis shared with the other feature functions, or an in-memory
+    parselmouth.Sound or NumPy array of samples (with sample_rate_hz).
+
     Returns:
       times: np.ndarray (s)
       f0_values: np.ndarray
@@ -27,39 +36,63 @@ def pitches(
       f0_lstsq_intercept: float
     """
     
-    sound = parselmouth.Sound(sound_path)
-    sampling_hz = sound.sampling_frequency
-    #uses praat's autocorrelation method (instead of cc [cross correlation])
+    analysis = as_analysis(sound_path, sample_rate_hz)
+    check_output_format(output_format)
     
     if(stats):
-        start_time = time.perf_counter()
-        wav_base = os.path.splitext(os.path.basename(sound_path))[0]
+        start_time = time.perf_counter() # before the recording is loaded, as in the other feature functions
+        wav_base = analysis.wav_base
         func_name = pitches.__name__
         stats_csv_file_name = f"{csv_folder_name}/{wav_base}_{func_name}.csv"
     
-    pitch = sound.to_pitch(time_step=time_step, pitch_floor=pitch_floor, pitch_ceiling=pitch_ceiling) 
+    sampling_hz = analysis.sampling_hz
+    #uses praat's autocorrelation method (instead of cc [cross correlation])
+    pitch = analysis.pitch(time_step, pitch_floor, pitch_ceiling)
     # Extract the frequencies (Hz) and corresponding times
-    f0_values = pitch.selected_array["frequency"]  # (in Hz)
-    times = pitch.xs()                             # time pts (s)
-    nonzero_mask = f0_values != 0
-    nonzero_f0_values = f0_values[nonzero_mask]
-    nonzero_xs = times[nonzero_mask]
+    with span("pitches", "numpy"):
+        f0_values = pitch.selected_array["frequency"]  # (in Hz)
+        times = pitch.xs()                             # time pts (s)
+        nonzero_mask = f0_values != 0
+        nonzero_f0_values = f0_values[nonzero_mask]
+        nonzero_xs = analysis.original_times(times[nonzero_mask])
 
-    pitch_mean = float(np.mean(nonzero_f0_values)) if nonzero_f0_values.size else float("nan")
+        pitch_mean = float(np.mean(nonzero_f0_values)) if nonzero_f0_values.size else float("nan")
 
-    # least squares Ax = b
-    A = np.column_stack((nonzero_xs, np.ones(len(nonzero_xs))))
-    b = nonzero_f0_values
+        # least squares Ax = b
+        A = np.column_stack((nonzero_xs, np.ones(len(nonzero_xs))))
+        b = nonzero_f0_values
 
-    lstsqsoln = lstsq(A, b)[0]
+        lstsqsoln = lstsq(A, b)[0]
 
-    f0_lstsq_slope = lstsqsoln[0] #measure referenced in paper as a strong feature
-    f0_lstsq_intercept = lstsqsoln[1]
+        f0_lstsq_slope = lstsqsoln[0] #measure referenced in paper as a strong feature
+        f0_lstsq_intercept = lstsqsoln[1]
     
-    if stats:
+    if stats and output_format == "npy":
+        elapsed_sec = time.perf_counter() - start_time
+        save_feature(
+            csv_folder_name,
+            wav_base,
+            func_name,
+            {
+                "sound_path": analysis.file_name,
+                "sample_rate_hz": sampling_hz,
+                "time_step": time_step,
+                "pitch_floor": pitch_floor,
+                "pitch_ceiling": pitch_ceiling,
+                "f0_lstsq_slope": f0_lstsq_slope,
+                "f0_lstsq_intercept": f0_lstsq_intercept,
+                "pitch_mean": pitch_mean,
+                "elapsed_seconds": elapsed_sec,
+            },
+            {
+                "time_seconds": nonzero_xs,
+                "f0_hz": nonzero_f0_values,
+            },
+        )
+    elif stats:
         # Timing:
         elapsed_sec = time.perf_counter() - start_time
-        with open(stats_csv_file_name, "x", newline="") as f:
+        with span("stats_csv", "io"), open(stats_csv_file_name, "x", newline="") as f:
             writer = csv.writer(f)
             writer.writerow([
                 "sound_path",
@@ -76,7 +109,7 @@ def pitches(
             if nonzero_xs.size == 0:
                 # No nonzero pitch frames: write a single row with metadata + blanks for time-varying columns.
                 writer.writerow([
-                    os.path.basename(sound_path),
+                    analysis.file_name,
                     sampling_hz,
                     time_step,
                     pitch_floor,
@@ -90,7 +123,7 @@ def pitches(
             else:
                 for i, (t, f0) in enumerate(zip(nonzero_xs, nonzero_f0_values)):
                     writer.writerow([
-                        os.path.basename(sound_path) if i == 0 else "",
+                        analysis.file_name if i == 0 else "",
                         sampling_hz if i == 0 else "",
                         time_step if i == 0 else "",
                         pitch_floor if i == 0 else "",
@@ -112,54 +145,44 @@ def save_pitch_plot(
     f0_lstsq_slope: float,
     f0_lstsq_intercept: float,
     output_path: str,
+    ax=None, # draw on these (reused) axes instead of a new figure, see render.py
 ):
     """Save a pitch scatter plot + line of best fit in the same format as the TESTING section."""
+    import matplotlib.pyplot as plt
     if nonzero_xs.size == 0 or nonzero_f0_values.size == 0:
         return
 
     line_y_values = f0_lstsq_slope * nonzero_xs + f0_lstsq_intercept
-    plt.figure()
-    plt.scatter(nonzero_xs, nonzero_f0_values, color='blue', label='Data Points')
-    plt.plot(nonzero_xs, line_y_values, color='red', linestyle='-', label='Line of Best Fit')
-    plt.title("Nonzero f0 values")
-    plt.xlabel("Time (in seconds)")
-    plt.ylabel("Hertz")
-    plt.legend()
-    plt.savefig(output_path, dpi=300, bbox_inches='tight')
-    plt.close()
+    reuse = ax is not None
+    fig, ax = (ax.figure, ax) if reuse else plt.subplots()
+    ax.scatter(nonzero_xs, nonzero_f0_values, color='blue', label='Data Points')
+    ax.plot(nonzero_xs, line_y_values, color='red', linestyle='-', label='Line of Best Fit')
+    ax.set_title("Nonzero f0 values")
+    ax.set_xlabel("Time (in seconds)")
+    ax.set_ylabel("Hertz")
+    ax.legend()
+    fig.savefig(output_path, dpi=300, bbox_inches='tight')
+    if not reuse:
+        plt.close(fig)
 
 
  # nonzero_xs, nonzero_f0_values, f0_lstsq_slope, f0_lstsq_intercept, s_hz = pitches(snd, 'function_output_data')
 
 def main():
+    from batch import find_recordings, run_batch
+
     # Input directory and naming convention must match the provided patient script
     patient_raw_data_directory = '/data_store2/resection/neuropsych_video/presidio/Stage2/PR05/home/'
 
-    # Output directories (as requested)
-    pitch_csv_output_directory = '/userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_pitch_metadata'
-    pitch_plot_output_directory = '/userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_pitch_plots'
-
-    os.makedirs(pitch_csv_output_directory, exist_ok=True)
-    os.makedirs(pitch_plot_output_directory, exist_ok=True)
-
-    for num in range(579, 611):
-        audio_name_without_wav = str(num)
-        audio_name = audio_name_without_wav + '_audio.wav'
-        sound_path = os.path.join(patient_raw_data_directory, audio_name)
-
-        if not os.path.exists(sound_path):
-            continue
-
-        nonzero_xs, nonzero_f0_values, f0_lstsq_slope, f0_lstsq_intercept, s_hz = pitches(
-            sound_path,
-            pitch_csv_output_directory,
-        )
-
-        plot_path = os.path.join(
-            pitch_plot_output_directory,
-            'sub-PR05_stage-2_audio-audiotype_preproc_' + audio_name_without_wav + '_pitch.png'
-        )
-        save_pitch_plot(nonzero_xs, nonzero_f0_values, f0_lstsq_slope, f0_lstsq_intercept, plot_path)
+    # Outputs go to /userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_pitch_metadata and /userdata/msharma/sub-PR05_stage-2_audio-audiotype_preproc_pitch_plots
+    # Plots are named sub-PR05_stage-2_audio-audiotype_preproc_<recording>_pitch.png (e.g. ..._579_audio_pitch.png); the old loop wrote ..._579_pitch.png
+    run_batch(
+        find_recordings(patient_raw_data_directory, '*_audio.wav'),
+        ['pitch'],
+        '/userdata/msharma',
+        prefix='sub-PR05_stage-2_audio-audiotype_preproc_',
+        jobs=os.cpu_count(),
+    )
 
 
 if __name__ == "__main__":
@@ -1,108 +1,264 @@
 import parselmouth
-import matplotlib.pyplot as plt
 import numpy as np
-import seaborn as sns
+import contextlib
 import os
+from analysis import as_analysis
+from feature_store import save_feature
 
-sns.set_theme()
-plt.rcParams['figure.dpi'] = 100
 
+FIGURE_DPI = 100
 
-def save_waveform_plot(audio_path, output_folder="/userdata/msharma/PR05_audio_plots", name="PR05"):
+
+@contextlib.contextmanager
+def audio_plot_theme():
+    """
+    The seaborn theme of the waveform and spectrogram plots, for the duration of the with block only: matplotlib
+    and seaborn are imported here, and the other plots of the process keep matplotlib's defaults.
+    """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    with plt.rc_context():
+        sns.set_theme(color_codes=False) # color codes ("r", "b", ...) are global, not rcParams: left alone
+        plt.rcParams["figure.dpi"] = FIGURE_DPI
+        yield
+
+
+def min_max_envelope(values: np.ndarray, x1: float, dx: float, n_columns: int):
+    """
+    Min/max envelope of samples for plotting at n_columns pixel columns: each column's samples reduced to their
+    minimum and maximum, interleaved so the polyline covers the same pixels as plotting every sample.
+
+    Args:
+        values (np.ndarray): samples, shape (n_channels, n_samples) as Sound.values.
+
+    Returns: times (2 * n_columns,) and envelope (n_channels, 2 * n_columns), or the samples themselves if there
+    are fewer than two per column.
+    """
+    n_samples = values.shape[-1]
+    if n_samples < 2 * n_columns:
+        return x1 + dx * np.arange(n_samples), values
+    starts = (np.arange(n_columns) * n_samples) // n_columns
+    mins = np.minimum.reduceat(values, starts, axis=-1)
+    maxs = np.maximum.reduceat(values, starts, axis=-1)
+    envelope = np.empty(values.shape[:-1] + (2 * n_columns,), dtype=values.dtype)
+    envelope[..., 0::2] = mins
+    envelope[..., 1::2] = maxs
+    centres = x1 + dx * (starts + 0.5 * (np.diff(np.append(starts, n_samples)) - 1))
+    return np.repeat(centres, 2), envelope
+
+
+def downsampled_power(values: np.ndarray, x_edges: np.ndarray, n_columns: int):
+    """
+    Mean power of groups of consecutive frames of a spectrogram, so there are at most n_columns frames.
+
+    Returns: the frame edges (n_frames + 1,) and values (n_bands, n_frames) of the downsampled spectrogram.
+    """
+    n_frames = values.shape[-1]
+    if n_frames <= n_columns:
+        return x_edges, values
+    group = -(-n_frames // n_columns)
+    n_full = n_frames // group
+    power = values[:, :n_full * group].reshape(values.shape[0], n_full, group).mean(axis=-1, dtype=np.float64)
+    if n_frames > n_full * group:
+        power = np.hstack([power, values[:, n_full * group:].mean(axis=-1, dtype=np.float64, keepdims=True)])
+    return np.append(x_edges[0:n_frames:group], x_edges[-1]), power
+
+
+SPECTROGRAM_DPI = 300
+
+
+def _image_columns(dpi: float = 0.0) -> int:
+    """Pixel width of a default-size figure saved at dpi (FIGURE_DPI if 0)."""
+    import matplotlib
+    width, _ = matplotlib.rcParams["figure.figsize"]
+    return int(width * (dpi or FIGURE_DPI))
+
+
+def waveform_plot_data(audio_path):
+    """
+    The arrays save_waveform_plot draws: a min/max envelope of the samples at the pixel width of the image.
+
+    Returns: times, envelope (n_channels, n_points), and the time domain (xmin, xmax) of the recording
+    """
+    snd = as_analysis(audio_path).sound
+    times, envelope = min_max_envelope(snd.values, snd.x1, snd.dx, _image_columns())
+    return times, envelope, snd.xmin, snd.xmax
+
+
+def render_waveform_plot(times, envelope, xmin, xmax, file_name, output_path, ax=None):
+    """Draws waveform_plot_data on ax (a new figure if None) and saves it to output_path."""
+    import matplotlib.pyplot as plt
+    with audio_plot_theme():
+        reuse = ax is not None
+        fig, ax = (ax.figure, ax) if reuse else plt.subplots()
+        ax.plot(times, envelope.T)
+        ax.set_xlim([xmin, xmax])
+        ax.set_xlabel("Time [s]")
+        ax.set_ylabel("Amplitude")
+        ax.set_title(f"Waveform: {file_name}")
+        fig.savefig(output_path)
+        if not reuse:
+            plt.close(fig)
+
+
+AUDIO_PLOT_NAME = "PR05" # tag in the audio plot file names: <recording>_<tag>_waveform.png, <recording>_<tag>_spectrogram.png
+
+
+def save_waveform_plot(audio_path, output_folder="/userdata/msharma/PR05_audio_plots", name=AUDIO_PLOT_NAME):
     """
     Saves a waveform plot for audio file.
 
+    The samples are reduced to a min/max envelope at the pixel width of the image (min_max_envelope), so the
+    plotting time depends on the image size rather than on the length of the recording.
+
     Parameters:
-        audio_path (str): Path to the audio file.
+        audio_path (str): Path to the audio file, or a RecordingAnalysis / parselmouth.Sound already in memory.
         output_folder (str): Folder where plots will be saved.
     """
     # Load sound
-    snd = parselmouth.Sound(audio_path)
+    analysis = as_analysis(audio_path)
 
     # Create output folder if needed
     os.makedirs(output_folder, exist_ok=True)
 
-    # Create plot
-    plt.figure()
-    plt.plot(snd.xs(), snd.values.T)
-    plt.xlim([snd.xmin, snd.xmax])
-    plt.xlabel("Time [s]")
-    plt.ylabel("Amplitude")
-    plt.title(f"Waveform: {os.path.basename(audio_path)}")
-
     # Generate output filename
-    filename = os.path.splitext(os.path.basename(audio_path))[0]
+    filename = analysis.wav_base
     output_path = os.path.join(output_folder, f"{filename}_{name}_waveform.png")
 
-    # Save and close
-    plt.savefig(output_path)
-    plt.close()
+    render_waveform_plot(*waveform_plot_data(analysis), analysis.file_name, output_path)
 
     # print(f"Saved: {output_path}")
-    
+
+
+def spectrogram_plot_data(audio_path, window_length=0.005, time_step=0.002, maximum_frequency=5000.0):
+    """
+    The arrays save_spectrogram_plot draws: the spectrogram (memoized in the RecordingAnalysis) in dB, with its
+    frames averaged down to the pixel width of the image (downsampled_power).
+
+    The spectrogram is always of the whole recording, so it lines up with the waveform plot: with speech_only
+    it is not the one of the concatenated speech the features use.
+
+    Returns: frame edges (n_frames + 1,), band edges (n_bands + 1,) and intensities (n_bands, n_frames) in dB
+    """
+    spectrogram = as_analysis(audio_path).whole_recording().spectrogram(window_length, time_step, maximum_frequency)
+    X, Z = downsampled_power(spectrogram.values, spectrogram.x_grid(), _image_columns(SPECTROGRAM_DPI))
+    Y = spectrogram.y_grid()        # frequency axis
+
+    # Convert to dB
+    Z_db = 10 * np.log10(np.maximum(Z, 1e-10))
+    return X, Y, Z_db
+
+
+def render_spectrogram_plot(X, Y, Z_db, file_name, output_path, ax=None, cax=None):
+    """
+    Draws spectrogram_plot_data on ax, with its colorbar on cax (a new figure if ax is None) and saves it to
+    output_path.
+    """
+    import matplotlib.pyplot as plt
+    with audio_plot_theme():
+        reuse = ax is not None
+        fig, ax = (ax.figure, ax) if reuse else plt.subplots()
+        # frames and bands are evenly spaced: an image is drawn much faster than a mesh of cells
+        image = ax.imshow(Z_db, origin="lower", aspect="auto", extent=(X[0], X[-1], Y[0], Y[-1]), interpolation="nearest")
+        ax.grid(False) # the theme's grid would be drawn over the image
+        ax.set_ylim(0, 5000)  # limit to speech range (adjust if needed)
+        ax.set_xlabel("Time [s]")
+        ax.set_ylabel("Frequency [Hz]")
+        ax.set_title(f"Spectrogram: {file_name}")
+        fig.colorbar(image, ax=None if cax is not None else ax, cax=cax, label="Intensity [dB]")
+        fig.savefig(output_path, dpi=SPECTROGRAM_DPI, bbox_inches="tight")
+        if not reuse:
+            plt.close(fig)
+
+
 def save_spectrogram_plot(audio_path,
                           output_folder="/userdata/msharma/PR05_audio_plots",
-                          name="PR05"):
+                          name=AUDIO_PLOT_NAME,
+                          window_length=0.005,
+                          time_step=0.002,
+                          maximum_frequency=5000.0):
     """
     Saves a spectrogram plot for an audio file.
 
     Parameters:
-        audio_path (str): Path to the audio file.
+        audio_path (str): Path to the audio file, or a RecordingAnalysis / parselmouth.Sound already in memory.
         output_folder (str): Folder where plots will be saved.
         name (str): Custom name tag for output file.
-    """
-    import parselmouth
-    import matplotlib.pyplot as plt
-    import numpy as np
-    import os
+        window_length, time_step, maximum_frequency: spectrogram settings (Praat's defaults). With the settings
+            of alpha_ratio / the formant energies, a shared RecordingAnalysis reuses their spectrogram.
 
+    Frames are averaged down to the pixel width of the image (downsampled_power) before drawing, so the
+    plotting time depends on the image size rather than on the length of the recording.
+    """
     # Load sound
-    snd = parselmouth.Sound(audio_path)
-
-    # Create spectrogram
-    spectrogram = snd.to_spectrogram()
-
-    # Extract values
-    X = spectrogram.x_grid()        # time axis
-    Y = spectrogram.y_grid()        # frequency axis
-    Z = spectrogram.values          # intensity values
-
-    # Convert to dB
-    Z_db = 10 * np.log10(np.maximum(Z, 1e-10))
+    analysis = as_analysis(audio_path)
 
     # Create output folder if needed
     os.makedirs(output_folder, exist_ok=True)
 
-    # Plot
-    plt.figure()
-    plt.pcolormesh(X, Y, Z_db, shading='auto')
-    plt.ylim(0, 5000)  # limit to speech range (adjust if needed)
-    plt.xlabel("Time [s]")
-    plt.ylabel("Frequency [Hz]")
-    plt.title(f"Spectrogram: {os.path.basename(audio_path)}")
-    plt.colorbar(label="Intensity [dB]")
-
     # Generate output filename
-    filename = os.path.splitext(os.path.basename(audio_path))[0]
+    filename = analysis.wav_base
     output_path = os.path.join(output_folder,
                                f"{filename}_{name}_spectrogram.png")
 
-    # Save and close
-    plt.savefig(output_path, dpi=300, bbox_inches="tight")
-    plt.close()
+    X, Y, Z_db = spectrogram_plot_data(analysis, window_length, time_step, maximum_frequency)
+    render_spectrogram_plot(X, Y, Z_db, analysis.file_name, output_path)
+
+
+def save_audio_plot_data(
+    audio_path,
+    csv_folder_name: str,
+    window_length: float = 0.005,
+    time_step: float = 0.002,
+    maximum_frequency: float = 5000.0,
+) -> str:
+    """
+    Stores the arrays of the waveform and spectrogram plots (waveform_plot_data, spectrogram_plot_data) as
+    {csv_folder_name}/{wav_base}_audio_plot_data/ (feature_store.save_feature), for render.py to draw without
+    reading the audio again.
+
+    Returns: path of the written folder
+    """
+    analysis = as_analysis(audio_path)
+    times, envelope, xmin, xmax = waveform_plot_data(analysis)
+    X, Y, Z_db = spectrogram_plot_data(analysis, window_length, time_step, maximum_frequency)
+    return save_feature(
+        csv_folder_name,
+        analysis.wav_base,
+        "audio_plot_data",
+        {
+            "sound_path": analysis.file_name,
+            "window_length": window_length,
+            "time_step": time_step,
+            "maximum_frequency": maximum_frequency,
+            "xmin": xmin,
+            "xmax": xmax,
+        },
+        {
+            "waveform_time": times,
+            "waveform_envelope": envelope.T,
+            "spectrogram_time_edges": X,
+            "spectrogram_frequency_edges": Y,
+            "spectrogram_db": Z_db.T,
+        },
+    )
+
 
 def main():
+    from batch import find_recordings, run_batch
 
     # patient_raw_data_directory = '/data_store2/resection/neuropsych_video/presidio/Stage2/PR05/home/'
     patient_raw_data_directory = '/data_store2/resection/neuropsych_video/presidio/Stage2/PR05/home/sub-PR05_stage-2_audio-athome_signal-preproc/'
-    plot_output_directory = '/userdata/msharma/sub-PR05_stage-2_audio-audiotype_raw_audio_plots'
-    
-    for num in range(579, 611):
-        # audio_name = str(num) + '_audio.wav'
-        audio_name = 'sub-PR05_stage-2_audio-athome_signal-preproc_' + str(num) + '.wav'
-        if os.path.exists(patient_raw_data_directory + audio_name):
-            save_waveform_plot(patient_raw_data_directory + audio_name, plot_output_directory)
-            save_spectrogram_plot(patient_raw_data_directory + audio_name, plot_output_directory)
+
+    # Plots go to /userdata/msharma/sub-PR05_stage-2_audio-audiotype_raw_audio_plots
+    run_batch(
+        find_recordings(patient_raw_data_directory, 'sub-PR05_stage-2_audio-athome_signal-preproc_*.wav'),
+        ['audio'],
+        '/userdata/msharma',
+        prefix='sub-PR05_stage-2_audio-audiotype_raw_',
+        jobs=os.cpu_count(),
+    )
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
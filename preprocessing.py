@@ -4,9 +4,11 @@ import scipy
 import time
 import os
 import csv
-from scipy.signal import butter, sosfiltfilt
+import struct
 from scipy.io import wavfile
 from parselmouth.praat import call
+from tracing import span
+from pcm_cache import read_pcm, praat_sample_values
 # import matplotlib.pyplot as plt
 
 
@@ -14,16 +16,15 @@ def demean_wav_sound(sound_path, output_path):
     """
     Removes any DC offset from the sound wav file
     """
-    sampling_hz, data = wavfile.read(sound_path)
+    sampling_hz, data = read_pcm(sound_path)
     original_dtype = data.dtype
-    data_float = data.astype(np.float64)
+    demeaned_data = data.astype(np.float64)
     
-    mean_val = np.mean(data_float, axis=0)
-    demeaned_data = data_float - mean_val
+    demeaned_data -= np.mean(demeaned_data, axis=0)
     
     if np.issubdtype(original_dtype, np.integer):
         typ = np.iinfo(original_dtype)
-        demeaned_data = np.clip(demeaned_data, typ.min, typ.max)
+        np.clip(demeaned_data, typ.min, typ.max, out=demeaned_data)
     
     output_data = demeaned_data.astype(original_dtype)
     
@@ -31,7 +32,7 @@ def demean_wav_sound(sound_path, output_path):
     
     
     
-def wav_butterworth_highpass_filter(sound_path, output_path, cutoff=80, order=5):
+def wav_butterworth_highpass_filter(sound_path, output_path, cutoff=80, order=5, dtype="float64"):
     """
     Read a WAV file, apply a Butterworth high-pass filter, and write a WAV file.
 
@@ -40,8 +41,11 @@ def wav_butterworth_highpass_filter(sound_path, output_path, cutoff=80, order=5)
         output_path (str): output .wav path
         cutoff (float): cutoff frequency in Hz
         order (int): Butterworth filter order
+        dtype (str): float type the filter runs in, "float64" or "float32" (half the memory, faster; float WAVs
+            are then written as float32)
     """
-    sampling_hz, data = wavfile.read(sound_path)
+    from scipy.signal import butter
+    sampling_hz, data = read_pcm(sound_path)
 
     if cutoff <= 0:
         raise ValueError("cutoff must be > 0")
@@ -54,30 +58,200 @@ def wav_butterworth_highpass_filter(sound_path, output_path, cutoff=80, order=5)
 
     orig_dtype = data.dtype
     is_int = np.issubdtype(orig_dtype, np.integer)
+    max_abs = float(np.iinfo(orig_dtype).max) if is_int else 1.0
 
-    if is_int:
-        max_abs = float(np.iinfo(orig_dtype).max)
-        x = data.astype(np.float64) / max_abs
-    else:
-        x = data.astype(np.float64)
+    y = _scaled_zero_phase_highpass(data, sos, None, max_abs, dtype)
+    wavfile.write(output_path, sampling_hz, _output_samples(y, orig_dtype, max_abs))
+    
+    
+    
+    
+def _highpass_settling_samples(sos: np.ndarray, tol: float = 1e-10) -> int:
+    """
+    Number of samples after which the impulse response of the filter stays below tol (relative to its peak).
+    Used as the overlap between blocks so each block's filter transient has died out before the kept samples.
+    """
+    from scipy.signal import sosfilt
+    n = 1024
+    while True:
+        impulse = np.zeros(n)
+        impulse[0] = 1.0
+        h = np.abs(sosfilt(sos, impulse))
+        above = np.flatnonzero(h > tol * h.max())
+        if above[-1] < n // 2:
+            return int(above[-1]) + 1
+        n *= 2
 
-    if x.ndim == 1:
-        y = sosfiltfilt(sos, x)
-    else:
-        y = np.empty_like(x, dtype=np.float64)
-        for ch in range(x.shape[1]):
-            y[:, ch] = sosfiltfilt(sos, x[:, ch])
-            
-    y = np.clip(y, -1.0, 1.0)
 
-    if is_int:
-        y_out = (y * max_abs).round().astype(orig_dtype)
-    else:
-        y_out = y.astype(np.float64)
+def _scaled_zero_phase_highpass(
+    data: np.ndarray,
+    sos: np.ndarray,
+    mean_val,
+    max_abs: float,
+    dtype="float64",
+    block: int = 1 << 16,
+) -> np.ndarray:
+    """
+    clip(sosfiltfilt(sos, (data - mean_val) / max_abs, axis=0), -1, 1) (no demeaning if mean_val is None), in dtype.
+
+    Computed in one channel-major working copy of data, with sosfiltfilt's odd edge padding: demeaning, scaling,
+    both filter passes (all channels per sosfilt call, block by block with the filter state carried over) and
+    clipping run in place, so peak memory is about one copy of the signal instead of one per step. In float64
+    the result is the same as scipy's sosfiltfilt.
+
+    Returns: the filtered samples, shape data.shape (a view of the working copy).
+    """
+    from scipy.signal import sosfilt, sosfilt_zi
+    dtype = np.dtype(dtype)
+    n = data.shape[0]
+    n_sections = sos.shape[0]
+    ntaps = 2 * n_sections + 1 - min(np.sum(sos[:, 2] == 0), np.sum(sos[:, 5] == 0))
+    pad = 3 * ntaps
+    if n <= pad:
+        raise ValueError(f"The length of the input vector x must be greater than padlen, which is {pad}.")
+
+    x = np.empty((int(np.prod(data.shape[1:])), n + 2 * pad), dtype=dtype)
+    body = x[:, pad:pad + n]
+    body[...] = data.reshape(n, -1).T
+    if mean_val is not None:
+        body -= np.reshape(mean_val, (-1, 1))
+    if max_abs != 1.0:
+        body /= max_abs
+    x[:, :pad] = 2 * body[:, :1] - body[:, pad:0:-1]
+    x[:, pad + n:] = 2 * body[:, -1:] - body[:, -2:-pad - 2:-1]
+
+    sos = sos.astype(dtype, copy=False)
+    zi = sosfilt_zi(sos).astype(dtype)[:, None, :]
+    state = zi * x[:, :1]
+    for start in range(0, x.shape[1], block):
+        x[:, start:start + block], state = sosfilt(sos, x[:, start:start + block], axis=-1, zi=state)
+    state = zi * x[:, -1:]
+    for stop in range(x.shape[1], 0, -block):
+        start = max(0, stop - block)
+        y, state = sosfilt(sos, x[:, stop - 1:start - 1 if start else None:-1], axis=-1, zi=state)
+        x[:, start:stop] = y[:, ::-1]
+
+    np.clip(body, -1.0, 1.0, out=body)
+    return body.T if data.ndim > 1 else body[0]
+
+
+def _output_samples(y: np.ndarray, orig_dtype: np.dtype, max_abs: float) -> np.ndarray:
+    """The filtered samples y in the WAV sample format: rounded in place to orig_dtype, or y itself for float WAVs."""
+    if not np.issubdtype(orig_dtype, np.integer):
+        return y
+    y *= max_abs
+    np.rint(y, out=y)
+    return y.astype(orig_dtype)
+
+
+def _open_wav_blocks(output_path: str, sampling_hz: int, n_channels: int, dtype: np.dtype):
+    """
+    Opens output_path and writes a WAV header whose sizes are filled in by _close_wav_blocks, so the
+    samples can be appended block by block (wavfile.write needs the whole signal at once).
+    """
+    f = open(output_path, "wb")
+    bytes_per_sample = dtype.itemsize
+    format_tag = 3 if np.issubdtype(dtype, np.floating) else 1 # WAVE_FORMAT_IEEE_FLOAT or WAVE_FORMAT_PCM
+    f.write(b"RIFF" + struct.pack("<I", 0) + b"WAVE")
+    f.write(b"fmt " + struct.pack(
+        "<IHHIIHH",
+        16,
+        format_tag,
+        n_channels,
+        int(sampling_hz),
+        int(sampling_hz) * n_channels * bytes_per_sample,
+        n_channels * bytes_per_sample,
+        8 * bytes_per_sample,
+    ))
+    f.write(b"data" + struct.pack("<I", 0))
+    return f
+
+
+def _close_wav_blocks(f, data_bytes: int):
+    if data_bytes % 2:
+        f.write(b"\x00") # chunks are word aligned
+    f.seek(4)
+    f.write(struct.pack("<I", 36 + data_bytes + data_bytes % 2))
+    f.seek(40)
+    f.write(struct.pack("<I", data_bytes))
+    f.close()
+
+
+def _demean_and_butterworth_highpass_filter_blocks(
+    sound_path: str,
+    output_path: str,
+    cutoff: float,
+    order: int,
+    block_seconds: float,
+    return_samples: bool = False,
+    dtype="float64",
+):
+    """
+    Bounded-memory version of demean_and_butterworth_highpass_filter.
+
+    The WAV file is memory-mapped. A first pass computes the DC mean block by block; the second pass
+    demeans, scales and zero-phase filters each block together with a margin of neighbouring samples on
+    both sides (long enough for the filter's impulse response to die out), keeps only the block itself and
+    appends it to output_path (if given). Blocks that touch the start or end of the file get the same edge padding
+    as sosfiltfilt on the whole signal. Peak memory is a few copies of one block plus its margins,
+    whatever the file length, and the output matches the in-memory path to within one integer step
+    (rounding) for integer WAVs and about 1e-12 for float WAVs.
+
+    Returns: sampling_hz, and the filtered samples (see demean_and_butterworth_highpass_filter) if
+    return_samples is True, otherwise None. Returning the samples needs memory for the whole signal.
+    """
+    from scipy.signal import butter
+    sampling_hz, data_orig = read_pcm(sound_path, mmap=True)
+    orig_dtype = data_orig.dtype
+    
+    if cutoff <= 0:
+        raise ValueError("cutoff must be > 0")
+    nyq = 0.5 * sampling_hz
+    if cutoff >= nyq:
+        raise ValueError(f"cutoff must be < Nyquist ({nyq} Hz)")
+    
+    n_samples = data_orig.shape[0]
+    n_channels = 1 if data_orig.ndim == 1 else data_orig.shape[1]
+    block = max(1, int(block_seconds * sampling_hz))
+    
+    # first pass: DC mean
+    total = np.zeros(data_orig.shape[1:], dtype=np.float64)
+    for start in range(0, n_samples, block):
+        total += np.sum(data_orig[start:start + block], axis=0, dtype=np.float64)
+    mean_val = total / n_samples
+    
+    normal_cutoff = cutoff / nyq
+    sos = butter(order, normal_cutoff, btype="highpass", output="sos")
+    margin = 2 * _highpass_settling_samples(sos)
 
-    wavfile.write(output_path, sampling_hz, y_out)
+    is_int = np.issubdtype(orig_dtype, np.integer)
+    max_abs = float(np.iinfo(orig_dtype).max) if is_int else 1.0
+    out_dtype = orig_dtype if is_int else np.dtype(dtype)
     
+    samples = np.empty(data_orig.shape, dtype=np.float64) if return_samples else None
+    
+    # second pass: demean, scale, filter block + margins, keep the block
+    f = _open_wav_blocks(output_path, sampling_hz, n_channels, out_dtype) if output_path else None
+    data_bytes = 0
+    try:
+        for start in range(0, n_samples, block):
+            stop = min(n_samples, start + block)
+            lo = max(0, start - margin)
+            hi = min(n_samples, stop + margin)
+            
+            y = _scaled_zero_phase_highpass(data_orig[lo:hi], sos, mean_val, max_abs, dtype)[start - lo:stop - lo]
+            y_out = _output_samples(y, orig_dtype, max_abs)
+            if return_samples:
+                samples[start:stop] = praat_sample_values(y_out)
+            if f is not None:
+                out_bytes = y_out.astype(out_dtype.newbyteorder("<"), copy=False).tobytes()
+                f.write(out_bytes)
+                data_bytes += len(out_bytes)
+    finally:
+        if f is not None:
+            _close_wav_blocks(f, data_bytes)
     
+    return sampling_hz, samples
     
     
 def demean_and_butterworth_highpass_filter(
@@ -86,19 +260,36 @@ def demean_and_butterworth_highpass_filter(
     csv_folder_name: str,
     cutoff: float = 80,
     order: int = 5,
-    stats: bool = True
+    block_seconds: float = 0.0, # if > 0, stream the file in blocks of this many seconds (bounded memory); 0 reads the whole file
+    dtype: str = "float64", # float type the filtering runs in; "float32" halves the working memory
+    stats: bool = True,
+    return_samples: bool = False
 ):
     """
     Read a WAV file, demean, then apply a Butterworth high-pass filter, and write a WAV file.
+    
+    With return_samples=True the filtered samples are also returned, so feature extraction can run on them
+    directly (every feature function accepts a NumPy array plus sample_rate_hz) without writing and re-reading
+    a processed WAV; pass output_path="" to skip writing it at all.
 
     Args:
         sound_path (str): input .wav path
-        output_path (str): output .wav path
+        output_path (str): output .wav path ("" to not write one)
         csv_folder_name (str): name of folder where stats csv file should be placed (doesn't matter if stats is False).
         cutoff (float): cutoff frequency in Hz
         order (int): Butterworth filter order
+        block_seconds (float): if > 0, process the file in blocks of this length so peak memory does not depend on
+            file length (see _demean_and_butterworth_highpass_filter_blocks); 0 reads the whole file into memory.
+        dtype (str): "float64" or "float32". The demeaning, scaling, filtering (all channels at once) and clipping run
+            in place in one working copy of this type (see _scaled_zero_phase_highpass); float WAVs are written in it.
         stats (bool): Whether the function should output a csv including time taken to execute and other metadata.
+        return_samples (bool): Whether to return the filtered samples.
+    
+    Returns:
+        if return_samples: samples (np.ndarray, float64 in [-1, 1], shape (n_samples,) or (n_samples, n_channels), exactly
+        what parselmouth.Sound would read back from output_path), sampling_hz. Otherwise None.
     """
+    from scipy.signal import butter
     
     if(stats):
         start_time = time.perf_counter()
@@ -106,53 +297,45 @@ def demean_and_butterworth_highpass_filter(
         func_name = demean_and_butterworth_highpass_filter.__name__
         stats_csv_file_name = f"{csv_folder_name}/{wav_base}_{func_name}.csv"
     
-    # demeaning data
-    sampling_hz, data_orig = wavfile.read(sound_path)
-    orig_dtype = data_orig.dtype
-    
-    if cutoff <= 0:
-        raise ValueError("cutoff must be > 0")
-    nyq = 0.5 * sampling_hz
-    if cutoff >= nyq:
-        raise ValueError(f"cutoff must be < Nyquist ({nyq} Hz)")
-    data_float = data_orig.astype(np.float64)
+    if block_seconds > 0:
+        with span("demean_and_highpass_blocks", "numpy", block_seconds=block_seconds): # reads and writes block by block
+            sampling_hz, samples = _demean_and_butterworth_highpass_filter_blocks(
+                sound_path, output_path, cutoff, order, block_seconds, return_samples, dtype
+            )
+    else:
+        # demeaning data
+        with span("load", "load", sound_path=sound_path):
+            sampling_hz, data_orig = read_pcm(sound_path)
+        orig_dtype = data_orig.dtype
     
-    mean_val = np.mean(data_float, axis=0)
-    demeaned_data = data_float - mean_val
+        if cutoff <= 0:
+            raise ValueError("cutoff must be > 0")
+        nyq = 0.5 * sampling_hz
+        if cutoff >= nyq:
+            raise ValueError(f"cutoff must be < Nyquist ({nyq} Hz)")
+        with span("demean_and_highpass", "numpy", dtype=np.dtype(dtype).name):
+            mean_val = np.mean(data_orig, axis=0, dtype=np.float64)
     
-    # applying butterworth highpass filter
-    normal_cutoff = cutoff / nyq
-    sos = butter(order, normal_cutoff, btype="highpass", output="sos")
+            # applying butterworth highpass filter
+            normal_cutoff = cutoff / nyq
+            sos = butter(order, normal_cutoff, btype="highpass", output="sos")
 
-    is_int = np.issubdtype(orig_dtype, np.integer)
-
-    if is_int:
-        max_abs = float(np.iinfo(orig_dtype).max)
-        x = demeaned_data.astype(np.float64) / max_abs
-    else:
-        x = demeaned_data.astype(np.float64)
-
-    if x.ndim == 1:
-        y = sosfiltfilt(sos, x)
-    else:
-        y = np.empty_like(x, dtype=np.float64)
-        for ch in range(x.shape[1]):
-            y[:, ch] = sosfiltfilt(sos, x[:, ch])
-            
-    y = np.clip(y, -1.0, 1.0)
+            is_int = np.issubdtype(orig_dtype, np.integer)
+            max_abs = float(np.iinfo(orig_dtype).max) if is_int else 1.0
 
-    if is_int:
-        y_out = (y * max_abs).round().astype(orig_dtype)
-    else:
-        y_out = y.astype(np.float64)
+            y = _scaled_zero_phase_highpass(data_orig, sos, mean_val, max_abs, dtype)
+            y_out = _output_samples(y, orig_dtype, max_abs)
 
-    wavfile.write(output_path, sampling_hz, y_out)
+        if output_path:
+            with span("write_wav", "io"):
+                wavfile.write(output_path, sampling_hz, y_out)
+        samples = praat_sample_values(y_out) if return_samples else None
     
     if not stats:
-        return
+        return (samples, sampling_hz) if return_samples else None
     # Timing:
     elapsed_sec = time.perf_counter() - start_time
-    with open(stats_csv_file_name, "x", newline="") as f:
+    with span("stats_csv", "io"), open(stats_csv_file_name, "x", newline="") as f:
         writer = csv.writer(f)
         writer.writerow([
             "sound_path",
@@ -160,6 +343,8 @@ def demean_and_butterworth_highpass_filter(
             "sample_rate_hz",
             "cutoff_hz",
             "order",
+            "block_seconds",
+            "dtype",
             "elapsed_seconds",
         ])
         writer.writerow([
@@ -168,8 +353,13 @@ def demean_and_butterworth_highpass_filter(
             sampling_hz,
             cutoff,
             order,
+            block_seconds,
+            np.dtype(dtype).name,
             f"{elapsed_sec:.6f}",
         ])
+    
+    if return_samples:
+        return samples, sampling_hz
 
     
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+import multiprocessing
+import contextlib
+import argparse
+import numpy as np
+import csv
+import os
+from numpy.linalg import lstsq
+from feature_store import load_feature
+from tracing import span, take_spans
+
+
+# Plot-rendering stage of the batch.
+#
+# The feature tasks only write their stats (csv files or npy stores, see feature_store.py; the audio plots store
+# their reduced arrays with plotting.save_audio_plot_data). render_plots then draws every plot from those stored
+# arrays on a process pool: the workers use the non-interactive Agg backend and keep one figure (with its axes)
+# per kind of plot, cleared and redrawn for every recording, instead of going through pyplot's global figure
+# state for hundreds of figures. Since only stored arrays are read, plots can be regenerated or restyled
+# without touching the audio or rerunning any analysis:
+#     python render.py /userdata/msharma --prefix sub-PR05_stage-2_audio-audiotype_preproc_ --features pitch loudness
+#
+# A plot job is (key, feature, stats path, plot paths); key identifies the job for the caller (e.g. the recording).
+
+
+def load_stats(stats_path: str):
+    """
+    Loads the stats a feature function wrote: an npy store (feature_store.load_feature) or a csv file with the
+    metadata in its first row and one row per frame.
+
+    Returns: metadata (dict, NaN for missing values), columns (dict of column name -> np.ndarray; empty csv values are left out)
+    """
+    if os.path.isdir(stats_path):
+        metadata, columns = load_feature(stats_path, mmap=False)
+        return {name: float("nan") if value is None else value for name, value in metadata.items()}, columns
+    with open(stats_path, newline="") as f:
+        rows = list(csv.reader(f))
+    header, rows = rows[0], rows[1:]
+    metadata = {}
+    for name, value in zip(header, rows[0] if rows else []):
+        try:
+            metadata[name] = float(value) if value != "" else float("nan")
+        except ValueError:
+            metadata[name] = value
+    columns = {}
+    for i, name in enumerate(header):
+        try:
+            columns[name] = np.array([float(row[i]) for row in rows if row[i] != ""])
+        except ValueError:
+            pass # text (sound_path): metadata only
+    return metadata, columns
+
+
+def _render_pitch(stats, plot_paths, axes):
+    from pitch import save_pitch_plot
+    metadata, columns = stats
+    xs, f0 = columns["time_seconds"], columns["f0_hz"]
+    if "f0_lstsq_intercept" in metadata:
+        slope, intercept = metadata["f0_lstsq_slope"], metadata["f0_lstsq_intercept"]
+    elif xs.size:
+        # the csv files keep the slope only: refit the line the same way as pitches
+        slope, intercept = lstsq(np.column_stack((xs, np.ones(len(xs)))), f0)[0]
+    else:
+        slope, intercept = np.nan, np.nan
+    save_pitch_plot(xs, f0, slope, intercept, plot_paths[0], ax=axes[0])
+
+
+def _render_f3(stats, plot_paths, axes):
+    from formants import save_f3_plot
+    metadata, columns = stats
+    save_f3_plot(columns["time_seconds"], columns["relative_energy"], metadata["mean_rel_energy_f_i"], plot_paths[0], ax=axes[0])
+
+
+def _render_alpha_ratio(stats, plot_paths, axes):
+    from alpha_ratio import save_alpha_ratio_plot
+    metadata, columns = stats
+    save_alpha_ratio_plot(columns["time_seconds"], columns["alpha_ratio"], metadata["alpha_ratio_mean"], plot_paths[0], ax=axes[0])
+
+
+def _render_loudness(stats, plot_paths, axes):
+    from loudness import save_loudness_plot
+    metadata, columns = stats
+    save_loudness_plot(
+        columns["time_seconds"], columns["intensity_db"], metadata["active_intensity_vals_mean"], plot_paths[0], ax=axes[0]
+    )
+
+
+def _render_audio(stats, plot_paths, axes):
+    from plotting import render_waveform_plot, render_spectrogram_plot
+    metadata, columns = stats
+    file_name = metadata["sound_path"]
+    render_waveform_plot(
+        columns["waveform_time"], columns["waveform_envelope"].T, metadata["xmin"], metadata["xmax"], file_name,
+        plot_paths[0], ax=axes[0],
+    )
+    render_spectrogram_plot(
+        columns["spectrogram_time_edges"], columns["spectrogram_frequency_edges"], columns["spectrogram_db"].T,
+        file_name, plot_paths[1], ax=axes[1], cax=axes[2],
+    )
+
+
+# feature -> function drawing its plots from the stored stats
+RENDERERS = {
+    "pitch": _render_pitch,
+    "f3": _render_f3,
+    "alpha_ratio": _render_alpha_ratio,
+    "loudness": _render_loudness,
+    "audio": _render_audio,
+}
+
+_axes = {} # feature -> the axes its plots are drawn on, in this worker
+
+
+def _feature_axes(feature: str) -> list:
+    """The reused axes of feature's plots: [axes] per plot, plus the colorbar axes of the spectrogram."""
+    import matplotlib.colorbar
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    if feature not in _axes:
+        if feature == "audio":
+            waveform_figure, spectrogram_figure = Figure(), Figure()
+            spectrogram_axes = spectrogram_figure.add_subplot()
+            colorbar_axes, _ = matplotlib.colorbar.make_axes(spectrogram_axes) # where fig.colorbar(ax=...) puts it
+            axes = [waveform_figure.add_subplot(), spectrogram_axes, colorbar_axes]
+        else:
+            axes = [Figure().add_subplot()]
+        for ax in axes:
+            if not isinstance(ax.figure.canvas, FigureCanvasAgg):
+                FigureCanvasAgg(ax.figure)
+        _axes[feature] = axes
+    for ax in _axes[feature]:
+        ax.clear()
+    return _axes[feature]
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+    take_spans() # drop any inherited from the parent
+
+
+def _render(job):
+    """Worker: draws the plots of one job. Returns key, error ("" if none) and the tracing spans."""
+    key, feature, stats_path, plot_paths = job
+    try:
+        if feature == "audio":
+            from plotting import audio_plot_theme
+            theme = audio_plot_theme() # also while the reused axes are made and cleared
+        else:
+            theme = contextlib.nullcontext()
+        with span(f"{feature}_plot", "plot", stats_path=os.path.basename(stats_path)), theme:
+            RENDERERS[feature](load_stats(stats_path), plot_paths, _feature_axes(feature))
+        error = ""
+    except Exception as e:
+        error = f"{type(e).__name__}: {' '.join(str(e).split())}"
+    return key, error, take_spans()
+
+
+def render_plots(plot_jobs: list, jobs: int = os.cpu_count()):
+    """
+    Draws the plots of every job (key, feature, stats path, plot paths) on jobs worker processes.
+
+    Returns: iterator over (key, error or "", tracing spans) in completion order
+    """
+    if not plot_jobs:
+        return
+    with multiprocessing.Pool(max(1, min(jobs, len(plot_jobs))), initializer=_init_worker) as pool:
+        yield from pool.imap_unordered(_render, plot_jobs)
+
+
+def main():
+    from batch import FEATURES, find_plot_jobs
+
+    parser = argparse.ArgumentParser(description="Draw the plots of a batch run again from its stored stats.")
+    parser.add_argument("output_dir", help="output directory of the batch run")
+    parser.add_argument("--prefix", default="", help="prefix of the output folder names")
+    parser.add_argument("--features", nargs="+", default=list(RENDERERS), choices=[f for f in FEATURES if f in RENDERERS])
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    plot_jobs = find_plot_jobs(args.output_dir, args.prefix, args.features)
+    failed = 0
+    for key, error, _ in render_plots(plot_jobs, args.jobs):
+        if error:
+            failed += 1
+            print(f"failed: {key}: {error}")
+    print(f"{len(plot_jobs) - failed} of {len(plot_jobs)} recordings' plots drawn")
+
+
+if __name__ == "__main__":
+    main()
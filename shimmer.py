@@ -3,17 +3,18 @@
 import numpy as np
 import parselmouth
 from parselmouth.praat import call
-import matplotlib.pyplot as plt
 import time
 import os
 import csv
+from analysis import RecordingAnalysis, as_analysis
+from feature_store import check_output_format, save_feature
+from cache import cached_feature
+from tracing import span
+from pulses import check_engine, pulse_times, shimmer_values
 
-snd = "raw_audio/hoarse_test_voice.wav" # apq5 shimmer value: 0.11146423422694232 (higher, as expected)
-# snd = "raw_audio/testsoundmono.mp3" # apq5 shimmer value: 0.05805759435795879
-# snd = "raw_audio/high_pitch.wav"
-
+@cached_feature
 def shimmer_apqN(
-    sound_path: str,
+    sound_path: str | RecordingAnalysis | parselmouth.Sound | np.ndarray,
     csv_folder_name: str,
     N: int, # N can only be 3, 5, or 11
     *,
@@ -26,44 +27,94 @@ def shimmer_apqN(
     period_ceiling: float = 0.02,
     maximum_period_factor: float = 1.3,
     maximum_amplitude_factor: float = 1.6,
-    stats: bool = True
+    engine: str = "praat", # or "numpy": pulses.shimmer_values on the pulse times and samples (same values to within 1e-9)
+    stats: bool = True,
+    sample_rate_hz: float = 0.0, # only needed when sound_path is a NumPy array of samples
+    output_format: str = "csv" # "csv", or "npy" for the columnar binary store in feature_store.py
 ) -> float:
     """
     Compute N-point Amplitude Perturbation Quotient (aqpN shimmer)
+    sound_path may be a path, a RecordingAnalysis shared with the other feature functions, or an in-memory
+    parselmouth.Sound or NumPy array of samples (with sample_rate_hz).
+    engine options: "praat", "numpy"
     """
     
-    sound = parselmouth.Sound(sound_path)
-    sampling_hz = sound.sampling_frequency
+    analysis = as_analysis(sound_path, sample_rate_hz)
+    check_output_format(output_format)
+    check_engine(engine)
     
     if(stats):
-        start_time = time.perf_counter()
-        wav_base = os.path.splitext(os.path.basename(sound_path))[0]
+        start_time = time.perf_counter() # before the recording is loaded, as in the other feature functions
+        wav_base = analysis.wav_base
         func_name = shimmer_apqN.__name__
         stats_csv_file_name = f"{csv_folder_name}/{wav_base}_{func_name}.csv"
     
+    sampling_hz = analysis.sampling_hz
+    
     if N not in [3, 5, 11]:
         raise ValueError("N can only be 3, 5, or 11")
     
-    pitch = sound.to_pitch(time_step=pitch_time_step, pitch_floor=pitch_floor, pitch_ceiling=pitch_ceiling)
-    
-    point = call([sound, pitch], "To PointProcess (cc)")
+    point = analysis.point_process(pitch_time_step, pitch_floor, pitch_ceiling)
+    analysed_range = (from_time, to_time) # on the timeline of the analyses (the concatenated speech with speech_only)
+    if from_time != to_time:
+        analysed_range = tuple(analysis.analysed_times([from_time, to_time]))
 
-    apqN = call(
-        [sound, point],
-        f"Get shimmer (apq{N})",
-        from_time,
-        to_time,
-        period_floor,
-        period_ceiling,
-        maximum_period_factor,
-        maximum_amplitude_factor,
-    )
+    if engine == "numpy":
+        sound = analysis.analysed_sound
+        with span(f"shimmer (apq{N})", "numpy"):
+            apqN = shimmer_values(
+                pulse_times(point),
+                sound.values[0],
+                sound.x1,
+                sound.dx,
+                [f"apq{N}"],
+                *analysed_range,
+                period_floor,
+                period_ceiling,
+                maximum_period_factor,
+                maximum_amplitude_factor,
+            )[f"apq{N}"]
+    else:
+        with span(f"Get shimmer (apq{N})", "praat"):
+            apqN = call(
+                [analysis.analysed_sound, point],
+                f"Get shimmer (apq{N})",
+                *analysed_range,
+                period_floor,
+                period_ceiling,
+                maximum_period_factor,
+                maximum_amplitude_factor,
+            )
     
     
-    if stats:
+    if stats and output_format == "npy":
+        elapsed_sec = time.perf_counter() - start_time
+        save_feature(
+            csv_folder_name,
+            wav_base,
+            func_name,
+            {
+                "sound_path": analysis.file_name,
+                "sample_rate_hz": sampling_hz,
+                "N": N,
+                "pitch_floor": pitch_floor,
+                "pitch_ceiling": pitch_ceiling,
+                "pitch_time_step": pitch_time_step,
+                "from_time": from_time,
+                "to_time": to_time,
+                "period_floor": period_floor,
+                "period_ceiling": period_ceiling,
+                "maximum_period_factor": maximum_period_factor,
+                "maximum_amplitude_factor": maximum_amplitude_factor,
+                "shimmer_val": apqN,
+                "elapsed_seconds": elapsed_sec,
+            },
+            {},
+        )
+    elif stats:
         # Timing:
         elapsed_sec = time.perf_counter() - start_time
-        with open(stats_csv_file_name, "x", newline="") as f:
+        with span("stats_csv", "io"), open(stats_csv_file_name, "x", newline="") as f:
             writer = csv.writer(f)
             writer.writerow([
                 "sound_path",
@@ -81,7 +132,7 @@ def shimmer_apqN(
                 "elapsed_seconds"
             ])
             writer.writerow([
-                os.path.basename(sound_path),
+                analysis.file_name,
                 sampling_hz,
                 pitch_floor,
                 pitch_ceiling,
@@ -98,6 +149,11 @@ def shimmer_apqN(
             
     return apqN, sampling_hz
 
-apq5_shimmer, s_hz = shimmer_apqN(snd, 'function_output_data', 5)
-print(apq5_shimmer)
+if __name__ == "__main__":
+    snd = "raw_audio/hoarse_test_voice.wav" # apq5 shimmer value: 0.11146423422694232 (higher, as expected)
+    # snd = "raw_audio/testsoundmono.mp3" # apq5 shimmer value: 0.05805759435795879
+    # snd = "raw_audio/high_pitch.wav"
+    apq5_shimmer, s_hz = shimmer_apqN(snd, 'function_output_data', 5)
+    print(apq5_shimmer)
+
     
\ No newline at end of file
@@ -0,0 +1,95 @@
+import numpy as np
+import parselmouth
+import scipy.fft
+import math
+from numpy.lib.stride_tricks import sliding_window_view
+from chunked import Track, _frame_grid
+
+
+# NumPy/SciPy STFT replacement for Praat's Sound: To Spectrogram (Gaussian window).
+#
+# Praat's spectrogram of a long recording is a float64 (frequencies x frames) matrix computed frame by frame
+# and copied again into Python by .values. stft_spectrogram computes the same power spectral densities (same
+# frame grid, window, FFT length and frequency bands as Praat, equal to float rounding) with batched real
+# FFTs over blocks of frames, keeps only the bands up to maximum_frequency and stores them as float32 by
+# default, halving the memory of the matrix.
+#
+# RecordingAnalysis(..., spectrogram_engine="numpy") uses it for every spectrogram of the recording, so
+# alpha_ratio, the formant energies and the spectrogram plot share one result.
+
+
+def stft_spectrogram(
+    sound: parselmouth.Sound,
+    window_length: float = 0.005,
+    time_step: float = 0.002,
+    maximum_frequency: float = 5000.0,
+    frequency_step: float = 20.0,
+    dtype=np.float32,
+    block_frames: int = 512, # frames per batched FFT; small blocks stay in cache
+) -> Track:
+    """
+    Power spectral density (Pa^2/Hz) of sound, as sound.to_spectrogram(window_length, maximum_frequency,
+    time_step, frequency_step) with its default Gaussian window.
+
+    Returns: a chunked.Track with values (frequency bands x frames), xs() / ys() (frame times / band
+    frequencies) and x_grid() / y_grid() like a Praat Spectrogram.
+    """
+    dx = sound.dx
+    nyquist = 0.5 / dx
+    physical_width = 2.0 * window_length # Gaussian window
+    effective_time_width = window_length / math.sqrt(math.pi)
+    time_step = max(time_step, effective_time_width / 8.0, dx)
+    frequency_step = max(frequency_step, 1.0 / effective_time_width / 8.0)
+    if maximum_frequency <= 0.0 or maximum_frequency > nyquist:
+        maximum_frequency = nyquist
+
+    n_window = math.floor(physical_width / dx)
+    half_window = n_window // 2 - 1
+    n_window = 2 * half_window
+    if n_window < 1:
+        raise ValueError("window_length too short for the sampling frequency")
+    n_frames, x1 = _frame_grid(
+        "spectrogram", (window_length, time_step, maximum_frequency), time_step,
+        sound.xmin, sound.xmax, sound.x1, sound.dx, sound.nx,
+    )
+    if n_frames < 1:
+        raise ValueError("sound shorter than the spectrogram window")
+    n_bands = math.floor(maximum_frequency / frequency_step)
+    n_fft = 1
+    while n_fft < n_window or n_fft < 2 * n_bands * (nyquist / maximum_frequency):
+        n_fft *= 2
+    bins_per_band = max(1, math.floor(frequency_step * dx * n_fft))
+    frequency_step = bins_per_band / (dx * n_fft) # bands are whole FFT bins
+    n_bands = math.floor(maximum_frequency / frequency_step)
+
+    phase = (np.arange(1, n_window + 1) - 0.5 * (n_window + 1)) / (physical_width / dx)
+    edge = math.exp(-12.0)
+    window = (np.exp(-48.0 * phase * phase) - edge) / (1.0 - edge)
+    scale = 1.0 / (np.sum(window * window) * bins_per_band)
+    window = window.astype(dtype)
+
+    samples = sound.values.astype(dtype, copy=False)
+    times = x1 + time_step * np.arange(n_frames)
+    first_samples = np.floor((times - sound.x1) / dx).astype(np.int64) + 1 - half_window
+    hop = int(first_samples[1] - first_samples[0]) if n_frames > 1 else 1
+    # frames as strided views of the samples when they are evenly spaced (a whole number of samples per step)
+    evenly_spaced = hop > 0 and np.all(first_samples == first_samples[0] + hop * np.arange(n_frames))
+    n_bins = n_bands * bins_per_band
+    values = np.empty((n_bands, n_frames), dtype=dtype)
+    for start in range(0, n_frames, block_frames):
+        stop = min(start + block_frames, n_frames)
+        power = None
+        for channel in samples:
+            if evenly_spaced:
+                first = first_samples[start]
+                frames = sliding_window_view(channel[first:first + hop * (stop - start - 1) + n_window], n_window)[::hop]
+            else:
+                frames = channel[first_samples[start:stop, None] + np.arange(n_window)]
+            spectrum = scipy.fft.rfft(frames * window, n_fft, axis=1)[:, :n_bins]
+            channel_power = spectrum.real**2 + spectrum.imag**2
+            power = channel_power if power is None else power + channel_power
+        if bins_per_band > 1:
+            power = power.reshape(stop - start, n_bands, bins_per_band).sum(axis=2)
+        values[:, start:stop] = power.T
+    values *= scale / samples.shape[0]
+    return Track(values, x1, time_step, sound.xmin, sound.xmax, 0.0, frequency_step)
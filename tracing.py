@@ -0,0 +1,137 @@
+from contextlib import contextmanager
+import threading
+import json
+import time
+import os
+
+
+# Stage-level timing spans.
+#
+# Every piece of work a recording goes through is recorded as a span with a category:
+#   load     decoding the recording (RecordingAnalysis.sound)
+#   praat    each Praat analysis or query (To Pitch, To Formant (burg), Get jitter, ...)
+#   cache    FeatureCache lookups of Praat analyses
+#   numpy    NumPy post-processing of the Praat results
+#   io       writing the stats csv files / npy stores / preprocessed WAVs
+#   feature  one whole feature function call (contains the spans above)
+#   plot     rendering and saving a plot
+#   task     one feature of one recording in the batch runner, plot included (contains all of the above)
+#
+# Spans are only recorded inside a `with tracing():` block (and in the processes started in it), so
+# calling the feature functions directly does not grow the span list. Spans are collected per process.
+# The batch runner records them, sends its workers' spans to the parent, which can export them
+# (run_batch(..., trace_path=...)) as plain JSON or in Chrome trace format (open in chrome://tracing or
+# https://ui.perfetto.dev).
+
+TRACING_ENV = "TRACE_SPANS" # "1" while tracing; an environment variable so that child processes inherit it
+
+_spans = []
+_lock = threading.Lock()
+
+
+def tracing_enabled() -> bool:
+    return os.environ.get(TRACING_ENV) == "1"
+
+
+@contextmanager
+def tracing():
+    """Records spans in this process and the processes started from it within the with block."""
+    previous = os.environ.get(TRACING_ENV)
+    os.environ[TRACING_ENV] = "1"
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop(TRACING_ENV, None)
+        else:
+            os.environ[TRACING_ENV] = previous
+
+
+@contextmanager
+def span(name: str, category: str, **args):
+    """Records the time spent in the with block while tracing. args (e.g. parameters) are stored with the span."""
+    if not tracing_enabled():
+        yield
+        return
+    start_us = time.time_ns() // 1000
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration_us = (time.perf_counter() - start) * 1e6
+        with _lock:
+            _spans.append({
+                "name": name,
+                "category": category,
+                "start_us": start_us,
+                "duration_us": duration_us,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            })
+
+
+def get_spans() -> list:
+    """The spans recorded so far in this process."""
+    with _lock:
+        return list(_spans)
+
+
+def take_spans() -> list:
+    """Returns the spans recorded so far in this process and forgets them (e.g. to send them to another process)."""
+    with _lock:
+        spans = list(_spans)
+        _spans.clear()
+    return spans
+
+
+def summarize(spans: list) -> dict:
+    """
+    category -> total seconds, counting time covered by several spans of the same category on one
+    thread (nested or overlapping) once.
+    """
+    intervals = {}
+    for s in spans:
+        intervals.setdefault((s["category"], s["pid"], s["tid"]), []).append((s["start_us"], s["start_us"] + s["duration_us"]))
+    totals = {}
+    for (category, _, _), thread_intervals in intervals.items():
+        covered_us = 0.0
+        covered_until = float("-inf")
+        for start_us, end_us in sorted(thread_intervals):
+            if end_us > covered_until:
+                covered_us += end_us - max(start_us, covered_until)
+                covered_until = end_us
+        totals[category] = totals.get(category, 0.0) + covered_us / 1e6
+    return dict(sorted(totals.items()))
+
+
+def export_json(spans: list, output_path: str, throughput: dict = None):
+    with open(output_path, "w") as f:
+        json.dump({"throughput": throughput or {}, "totals_seconds": summarize(spans), "spans": spans}, f, indent=1)
+
+
+def export_chrome_trace(spans: list, output_path: str, throughput: dict = None):
+    events = [
+        {
+            "name": s["name"],
+            "cat": s["category"],
+            "ph": "X", # complete event
+            "ts": s["start_us"],
+            "dur": s["duration_us"],
+            "pid": s["pid"],
+            "tid": s["tid"],
+            "args": s["args"],
+        }
+        for s in spans
+    ]
+    with open(output_path, "w") as f:
+        json.dump(
+            {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {
+                **(throughput or {}),
+                **{f"{category}_seconds": seconds for category, seconds in summarize(spans).items()},
+            }},
+            f,
+        )
+
+
+TRACE_FORMATS = {"json": export_json, "chrome": export_chrome_trace}
@@ -0,0 +1,164 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# Energy / spectral-flux voice activity detection.
+#
+# At-home recordings are mostly silence and background noise. detect_speech finds the speech segments of a
+# recording in one vectorized pass, so that the Praat analyses (pitch tracking, Burg formants, ...) can run on
+# the speech only (RecordingAnalysis(..., speech_only=True), or run_batch(..., vad=True)).
+#
+# A frame is speech when its energy is energy_margin_db above the noise floor (a low percentile of the frame
+# energies), or half that much above it while the spectrum is changing quickly (spectral flux above
+# flux_threshold, e.g. at onsets of quiet syllables). Frames more than dynamic_range_db below the loudest frame
+# are never speech. Short gaps are closed, short bursts dropped and the segments padded.
+
+
+def _frame_features(
+    x: np.ndarray,
+    sampling_hz: float,
+    frame_length: float,
+    time_step: float,
+    block_frames: int = 6000,
+):
+    """Energy (dB) and normalized spectral flux of every frame, computed block by block to bound memory."""
+    n = int(round(frame_length * sampling_hz))
+    hop = int(round(time_step * sampling_hz))
+    if x.shape[0] < n:
+        return np.zeros(0), np.zeros(0), n, hop
+    frames = sliding_window_view(x, n)[::hop] # view, no copy
+    window = np.hanning(n)
+    energy_db = np.empty(frames.shape[0])
+    flux = np.empty(frames.shape[0])
+    previous = None
+    for start in range(0, frames.shape[0], block_frames):
+        block = frames[start:start + block_frames]
+        energy_db[start:start + block.shape[0]] = 10 * np.log10(np.mean(block**2, axis=1) + 1e-20)
+        magnitude = np.abs(np.fft.rfft(block * window, axis=1))
+        if previous is None:
+            previous = magnitude[:1]
+        diff = np.diff(np.concatenate([previous, magnitude]), axis=0)
+        flux[start:start + block.shape[0]] = np.sum(np.maximum(diff, 0.0), axis=1) / (np.sum(magnitude, axis=1) + 1e-12)
+        previous = magnitude[-1:]
+    return energy_db, flux, n, hop
+
+
+def _runs(mask: np.ndarray) -> np.ndarray:
+    """(start, stop) frame indices of the runs of True in mask."""
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    return np.column_stack((np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def detect_speech(
+    samples: np.ndarray,
+    sampling_hz: float,
+    frame_length: float = 0.025,
+    time_step: float = 0.01,
+    energy_margin_db: float = 12.0,
+    flux_threshold: float = 0.3,
+    dynamic_range_db: float = 50.0,
+    noise_percentile: float = 10.0,
+    min_silence: float = 0.3,
+    min_speech: float = 0.1,
+    padding: float = 0.1,
+) -> np.ndarray:
+    """
+    Speech segments of a recording.
+
+    Args:
+        samples (np.ndarray): shape (n_samples,) or (n_channels, n_samples) as in parselmouth.Sound.values; channels are averaged.
+        min_silence (float): gaps shorter than this (s) are bridged.
+        min_speech (float): speech bursts shorter than this (s) are dropped.
+        padding (float): seconds added before and after each segment.
+
+    Returns: np.ndarray of shape (n_segments, 2), start and end time (s) of each segment, sorted and non-overlapping.
+    An empty array if no speech was found.
+    """
+    x = np.asarray(samples, dtype=np.float64)
+    if x.ndim == 2:
+        x = x.mean(axis=0)
+    duration = x.shape[0] / sampling_hz
+    energy_db, flux, n, hop = _frame_features(x, sampling_hz, frame_length, time_step)
+    if energy_db.size == 0:
+        return np.zeros((0, 2))
+
+    noise_floor_db = np.percentile(energy_db, noise_percentile)
+    audible = energy_db > energy_db.max() - dynamic_range_db
+    speech = audible & (
+        (energy_db > noise_floor_db + energy_margin_db)
+        | ((energy_db > noise_floor_db + energy_margin_db / 2) & (flux > flux_threshold))
+    )
+
+    runs = _runs(speech)
+    if runs.shape[0] == 0:
+        return np.zeros((0, 2))
+    # bridge short gaps, then drop short bursts
+    gaps = runs[1:, 0] - runs[:-1, 1]
+    keep_gap = gaps * time_step >= min_silence
+    starts = runs[np.concatenate([[True], keep_gap]), 0]
+    stops = runs[np.concatenate([keep_gap, [True]]), 1]
+    long_enough = (stops - starts) * time_step >= min_speech
+    starts, stops = starts[long_enough], stops[long_enough]
+    if starts.size == 0:
+        return np.zeros((0, 2))
+
+    # frame k covers samples k * hop .. k * hop + n
+    start_times = np.maximum(starts * hop / sampling_hz - padding, 0.0)
+    end_times = np.minimum(((stops - 1) * hop + n) / sampling_hz + padding, duration)
+    # padding can make neighbours overlap
+    new_segment = np.concatenate([[True], start_times[1:] > end_times[:-1]])
+    merged_ends = np.maximum.reduceat(end_times, np.flatnonzero(new_segment))
+    return np.column_stack((start_times[new_segment], merged_ends))
+
+
+def speech_only_samples(
+    samples: np.ndarray,
+    sampling_hz: float,
+    segments: np.ndarray,
+    gap: float = 0.05,
+):
+    """
+    Concatenates the speech segments of samples (shape (n_channels, n_samples)), separated by gap seconds of
+    silence so that no glottal period or pitch candidate spans two segments.
+
+    Returns: the concatenated samples, and the sample offsets (original index - concatenated index) and
+    concatenated start index of every segment, used by original_times.
+    """
+    bounds = np.round(np.asarray(segments) * sampling_hz).astype(np.int64)
+    bounds = np.clip(bounds, 0, samples.shape[-1])
+    gap_samples = int(round(gap * sampling_hz))
+    lengths = bounds[:, 1] - bounds[:, 0]
+    concatenated_starts = np.concatenate([[0], np.cumsum(lengths + gap_samples)[:-1]])
+    out = np.zeros(samples.shape[:-1] + (int(lengths.sum() + gap_samples * max(0, len(lengths) - 1)),))
+    for (start, stop), at in zip(bounds, concatenated_starts):
+        out[..., at:at + stop - start] = samples[..., start:stop]
+    return out, bounds[:, 0] - concatenated_starts, concatenated_starts
+
+
+def original_times(
+    times: np.ndarray,
+    sampling_hz: float,
+    sample_offsets: np.ndarray,
+    concatenated_starts: np.ndarray,
+) -> np.ndarray:
+    """Maps times (s) on the concatenated speech back to the timeline of the original recording."""
+    times = np.asarray(times, dtype=np.float64)
+    segment = np.clip(np.searchsorted(concatenated_starts / sampling_hz, times, side="right") - 1, 0, None)
+    return times + sample_offsets[segment] / sampling_hz
+
+
+def concatenated_times(
+    times: np.ndarray,
+    sampling_hz: float,
+    sample_offsets: np.ndarray,
+    concatenated_starts: np.ndarray,
+) -> np.ndarray:
+    """
+    Inverse of original_times: maps times (s) of the original recording onto the concatenated speech. Times in
+    the silence after a segment map into the gap after it, so a time range maps onto the speech it contains.
+    """
+    times = np.asarray(times, dtype=np.float64)
+    original_starts = (concatenated_starts + sample_offsets) / sampling_hz
+    segment = np.clip(np.searchsorted(original_starts, times, side="right") - 1, 0, None)
+    next_starts = np.append(concatenated_starts[1:] / sampling_hz, np.inf)
+    return np.clip(times - sample_offsets[segment] / sampling_hz, 0.0, next_starts[segment])